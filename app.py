@@ -1,64 +1,151 @@
+import time
+STARTED = time.perf_counter()  # taken before the heavy imports below to measure import-to-ready time
+
 import streamlit as st
 import os
 import asyncio
+from functools import partial
 from dotenv import load_dotenv
-from langchain.chains import RetrievalQAWithSourcesChain, RetrievalQA
-from core import OpenRouterLLM, PDFProcessor
+from core import (
+    OpenRouterLLM, PDFProcessor, DocumentSummarizer, DocumentCorpus, ResponseCache, QAEngine, ContextAssembler,
+    close_async_clients, log_startup_time, metrics, sampling_profiler, stage_profiler, start_metrics_server,
+)
 
 # Load environment variables
 load_dotenv()
 
+@st.cache_resource
+def get_pdf_processor() -> PDFProcessor:
+    """One PDFProcessor per server process; Streamlit reruns this script on every interaction."""
+    processor = PDFProcessor()
+    log_startup_time("app ready", STARTED)
+    processor.preload(STARTED)
+    return processor
+
+@st.cache_resource
+def get_metrics_server(port: int):
+    """Prometheus endpoint for this server process, started once when METRICS_PORT is set."""
+    return start_metrics_server(port)
+
 # Initialize PDFProcessor
-pdf_processor = PDFProcessor()
+pdf_processor = get_pdf_processor()
+if os.getenv("METRICS_PORT"):
+    get_metrics_server(int(os.getenv("METRICS_PORT")))
+
+def show_diagnostics():
+    """Pipeline timings, cache hit rates and runtime profiling switches for this server process."""
+    snapshot = metrics.snapshot()
+    counters = snapshot["counters"]
+    if snapshot["histograms"]:
+        st.dataframe(
+            [{"metric": name, "count": int(h["count"]), "mean": round(h["mean"], 4), "p50": round(h["p50"], 4),
+              "p95": round(h["p95"], 4)} for name, h in snapshot["histograms"].items()],
+            hide_index=True,
+        )
+    else:
+        st.caption("No timings recorded yet")
+
+    hit_rates = {}
+    for cache in ("embedding", "response", "semantic"):
+        hits = counters.get(f'cache_requests_total{{cache="{cache}",result="hit"}}', 0)
+        misses = counters.get(f'cache_requests_total{{cache="{cache}",result="miss"}}', 0)
+        if hits + misses:
+            hit_rates[cache] = f"{hits / (hits + misses):.0%} of {int(hits + misses)}"
+    embed = snapshot["histograms"].get("embed_seconds")
+    if embed and embed["sum"]:
+        hit_rates["embedding throughput"] = f"{counters.get('embedded_texts_total', 0) / embed['sum']:.0f} texts/s"
+    if hit_rates:
+        st.json(hit_rates)
+    st.json({"counters": counters, "gauges": snapshot["gauges"]}, expanded=False)
 
-def get_tone_prompt(tone: str) -> str:
-    """Get the appropriate prompt prefix based on selected tone"""
-    tone_prompts = {
-        "formal": "Please summarize this document in a formal, professional tone:",
-        "casual": "Give me a relaxed, friendly summary of this document:",
-        "bullet": "Summarize this document using clear, concise bullet points:"
-    }
-    return tone_prompts.get(tone, tone_prompts["formal"])
+    col_sample, col_cprofile = st.columns(2)
+    with col_sample:
+        if sampling_profiler.running:
+            if st.button("⏹️ Stop sampling"):
+                sampling_profiler.stop()
+                st.rerun()
+        elif st.button("▶️ Sample stacks"):
+            sampling_profiler.reset()
+            sampling_profiler.start()
+            st.rerun()
+    with col_cprofile:
+        if stage_profiler.enabled:
+            if st.button("⏹️ Stop cProfile"):
+                stage_profiler.disable()
+                st.rerun()
+        elif st.button("▶️ cProfile stages"):
+            stage_profiler.enable()
+            st.rerun()
+
+    if sampling_profiler.samples:
+        st.caption(f"{sampling_profiler.samples} stack samples{' (running)' if sampling_profiler.running else ''}")
+        st.dataframe(
+            [{"function": name, "self": own, "total": total} for name, own, total in sampling_profiler.top(25)],
+            hide_index=True,
+        )
+    if stage_profiler.collected:
+        st.code(stage_profiler.report(25), language=None)
 
 async def process_pdfs(uploaded_files):
-    """Asynchronously process the uploaded PDF files."""
+    """Index newly uploaded PDFs into the corpus and drop the ones removed from the uploader."""
     loop = asyncio.get_event_loop()
-    
-    all_texts = {}
-    for uploaded_file in uploaded_files:
-        with st.spinner(f"🔄 Extracting text from {uploaded_file.name}..."):
-            pdf_bytes = uploaded_file.read()
-            text = await loop.run_in_executor(None, pdf_processor.extract_text_from_pdf, pdf_bytes)
-        
-        if not text:
-            st.error(f"❌ Could not extract text from {uploaded_file.name}")
-            continue
+    corpus = st.session_state.setdefault('corpus', DocumentCorpus(pdf_processor.embeddings))
+    all_texts = st.session_state.setdefault('all_texts', {}) # Store all texts for summarization
+    failed = st.session_state.setdefault('failed_uploads', set())
+    # PDF name -> the PDFs its near-duplicate chunks were skipped against (DEDUP=on)
+    dedup_basis = st.session_state.setdefault('dedup_basis', {})
 
-        st.info(f"📝 Extracted {len(text)} characters from {uploaded_file.name}")
-        all_texts[uploaded_file.name] = text
+    names = {uploaded_file.name for uploaded_file in uploaded_files}
+    failed.intersection_update(names)
+    removed = {source for source in all_texts if source not in names}
+    while removed:
+        for source in removed:
+            corpus.remove(source)
+            all_texts.pop(source, None)
+            dedup_basis.pop(source, None)
+        # A PDF deduplicated against a removed one lacks the chunks only that one held; index it again
+        removed = {source for source, basis in dedup_basis.items() if basis & removed}
 
-    if not all_texts:
-        st.error("❌ No text could be extracted from the uploaded PDFs.")
-        return
+    # Only files that are not indexed yet are processed; existing documents keep their vectors
+    new_files = [f for f in uploaded_files if f.name not in all_texts and f.name not in failed]
+    for uploaded_file in new_files:
+        with st.spinner(f"🔄 Extracting, chunking and embedding {uploaded_file.name}..."):
+            pdf_bytes = uploaded_file.getvalue()
+            basis = set(all_texts)
+            try:
+                # Pages stream through splitting and embedding instead of three separate phases
+                result = await loop.run_in_executor(
+                    None,
+                    partial(
+                        pdf_processor.ingest_stream, pdf_bytes, {"source": uploaded_file.name}, keep_text=True,
+                        known_signatures=corpus.signatures(),
+                    ),
+                )
+            except Exception as e:
+                st.error(f"❌ Could not process {uploaded_file.name}: {str(e)}")
+                failed.add(uploaded_file.name)
+                continue
 
-    with st.spinner("✂️ Processing text chunks..."):
-        # We need to pass metadata to the splitter
-        documents = []
-        for filename, text in all_texts.items():
-            docs = pdf_processor.split_text_with_metadata(text, {"source": filename})
-            documents.extend(docs)
-    
-    st.info(f"📊 Created {len(documents)} text chunks from {len(all_texts)} PDF(s)")
+        if result.text.strip() and result.vectorstore is None and result.duplicate_chunks:
+            # Everything in it is already indexed from the other PDFs; keep its text for summaries
+            all_texts[uploaded_file.name] = result.text
+            dedup_basis[uploaded_file.name] = basis
+            st.info(f"📝 {uploaded_file.name} adds no new passages: all {result.duplicate_chunks} chunks are already indexed")
+            continue
+        if not result.text.strip() or result.vectorstore is None:
+            st.error(f"❌ Could not extract text from {uploaded_file.name}")
+            failed.add(uploaded_file.name)
+            continue
 
-    with st.spinner("🧠 Building vector database..."):
-        vectorstore = await loop.run_in_executor(None, pdf_processor.create_vector_store_with_metadata, documents)
+        corpus.add_vectorstore(uploaded_file.name, result.vectorstore, result.lexical_index, result.signatures)
+        all_texts[uploaded_file.name] = result.text
+        if result.duplicate_chunks:
+            dedup_basis[uploaded_file.name] = basis
+        skipped = f", {result.duplicate_chunks} near-duplicates skipped" if result.duplicate_chunks else ""
+        st.info(f"📝 Extracted {result.char_count} characters ({result.chunk_count} chunks{skipped}) from {uploaded_file.name}")
 
-    if vectorstore:
-        st.success("✅ Vector database ready!")
-        st.session_state['vectorstore'] = vectorstore
-        st.session_state['all_texts'] = all_texts # Store all texts for summarization
-    else:
-        st.error("❌ Failed to create vector database")
+    if new_files and len(corpus):
+        st.success(f"✅ Vector database ready! {len(corpus)} text chunks from {len(corpus.sources)} PDF(s)")
 
 async def main():
     st.set_page_config(
@@ -83,9 +170,21 @@ async def main():
         with st.expander("ℹ️ Optional Settings"):
             st.info("The app is configured with:\n- Model: llama-3.3-8b-instruct\n- Referer: GitHub project\n- Title: PDF Q&A Tool")
 
+        if 'response_cache' in st.session_state:
+            with st.expander("📈 Response Cache"):
+                st.json(st.session_state['response_cache'].stats())
+
+        with st.expander("📊 Diagnostics"):
+            show_diagnostics()
+
     try:
-        llm = OpenRouterLLM(api_key=openrouter_api_key)
+        if 'response_cache' not in st.session_state:
+            st.session_state['response_cache'] = ResponseCache()
+        llm = OpenRouterLLM(api_key=openrouter_api_key, response_cache=st.session_state['response_cache'])
         st.session_state['llm'] = llm
+        if 'summarizer' not in st.session_state:
+            # Kept across reruns so cached section summaries are reused when switching tone
+            st.session_state['summarizer'] = DocumentSummarizer(llm)
     except Exception as e:
         st.error(f"Error initializing LLM: {str(e)}")
         return
@@ -101,44 +200,103 @@ async def main():
             accept_multiple_files=True
         )
         
-        if uploaded_files and 'vectorstore' not in st.session_state:
-            await process_pdfs(uploaded_files)
+        await process_pdfs(uploaded_files or [])
 
     with col2:
         st.header("💬 Q&A & Summary")
         
-        if 'vectorstore' in st.session_state:
+        corpus = st.session_state.get('corpus')
+        if corpus is not None and len(corpus):
+            engine_key = tuple(sorted(corpus.sources))
+            if st.session_state.get('qa_engine_key') != engine_key:
+                # Built once per set of documents; the chain is reused for every question
+                st.session_state['qa_engine'] = QAEngine(
+                    corpus,
+                    st.session_state['llm'],
+                    response_cache=st.session_state['response_cache'],
+                    namespace="|".join(engine_key),
+                    assembler=ContextAssembler.for_model(st.session_state['llm'].model),
+                )
+                st.session_state['qa_engine_key'] = engine_key
+
             st.subheader("❓ Ask Questions")
-            question = st.text_input(
-                "Enter your question about the document:",
-                placeholder="What is the main topic of this document?"
+            question = st.text_area(
+                "Enter your question about the document (or several, one per line):",
+                placeholder="What is the main topic of this document?",
+                height=80,
+            )
+            questions = [line.strip() for line in question.splitlines() if line.strip()]
+            combined = len(questions) > 1 and st.checkbox(
+                "Answer all questions in one prompt",
+                help="One LLM call for the whole batch instead of one per question",
             )
+
+            search_sources = None
+            if len(corpus.sources) > 1:
+                selected_sources = st.multiselect(
+                    "Search in:",
+                    options=corpus.sources,
+                    default=corpus.sources
+                )
+                if selected_sources and len(selected_sources) < len(corpus.sources):
+                    search_sources = selected_sources
             
             if st.button("🔍 Get Answer", type="primary"):
-                if question:
+                if len(questions) > 1:
+                    with st.spinner(f"🤔 Answering {len(questions)} questions..."):
+                        try:
+                            # One embedding batch and one index search for all of them
+                            results = await st.session_state['qa_engine'].abatch_answer(
+                                questions, k=3, sources=search_sources, combined=combined
+                            )
+                            for question, result in zip(questions, results):
+                                st.markdown(f"**Q:** {question}")
+                                st.markdown(f"**A:** {result.answer}")
+                                if result.sources:
+                                    st.caption("Sources: " + ", ".join(sorted({doc.metadata['source'] for doc in result.sources})))
+                            st.success(f"✅ Answered {len(questions)} questions")
+                            st.caption(
+                                f"⏱️ Retrieval {results[0].retrieval_time * 1000:.0f} ms · "
+                                f"Generation {max(result.generation_time for result in results):.1f} s · "
+                                f"{sum(result.cached for result in results)} cached"
+                            )
+
+                        except Exception as e:
+                            st.error(f"Error getting answers: {str(e)}")
+                elif question:
+                    question = questions[0]
+                    st.markdown(f"**Q:** {question}")
+                    answer_placeholder = st.empty()
+                    last_render = 0.0
+
+                    async def render_partial(answer_so_far: str):
+                        nonlocal last_render
+                        # Each redraw resends the whole answer to the browser, so cap it at ~20 per second
+                        now = time.perf_counter()
+                        if now - last_render >= 0.05:
+                            answer_placeholder.markdown(f"**A:** {answer_so_far}▌")
+                            last_render = now
+
                     with st.spinner("🤔 Thinking..."):
                         try:
-                            qa_chain = RetrievalQA.from_chain_type(
-                                llm=st.session_state['llm'],
-                                chain_type="stuff",
-                                retriever=st.session_state['vectorstore'].as_retriever(
-                                    search_kwargs={"k": 3}
-                                ),
-                                return_source_documents=True
+                            result = await st.session_state['qa_engine'].aanswer(
+                                question, k=3, sources=search_sources, on_token=render_partial
                             )
-                            result = qa_chain(question)
-                            answer = result['result']
-                            source_docs = result['source_documents']
-                            
-                            st.success("✅ Answer:")
-                            st.markdown(f"**Q:** {question}")
-                            st.markdown(f"**A:** {answer}")
+                            answer_placeholder.markdown(f"**A:** {result.answer}")
+                            st.success("✅ Answered")
                             
-                            if source_docs:
+                            if result.sources:
                                 st.markdown("**Sources:**")
-                                for doc in source_docs:
+                                for doc in result.sources:
                                     st.markdown(f"- *{doc.metadata['source']}*")
 
+                            st.caption(
+                                "⚡ Cached answer" if result.cached else
+                                f"⏱️ Retrieval {result.retrieval_time * 1000:.0f} ms · "
+                                f"First token {result.time_to_first_token or 0:.2f} s · Generation {result.generation_time:.1f} s "
+                                f"· Context {result.context_tokens} tokens"
+                            )
+
                         except Exception as e:
                             st.error(f"Error getting answer: {str(e)}")
                 else:
@@ -171,9 +329,7 @@ async def main():
                 with st.spinner("✍️ Generating summary..."):
                     try:
                         text_to_summarize = st.session_state['all_texts'][doc_to_summarize]
-                        tone_prompt = get_tone_prompt(tone)
-                        full_prompt = f"{tone_prompt}\n\n{text_to_summarize}"
-                        summary = st.session_state['llm'](full_prompt)
+                        summary = await st.session_state['summarizer'].asummarize(text_to_summarize, tone)
                         st.success(f"✅ Summary for {doc_to_summarize}:")
                         st.markdown(summary)
                     except Exception as e:
@@ -191,5 +347,12 @@ async def main():
         unsafe_allow_html=True
     )
 
+async def run():
+    try:
+        await main()
+    finally:
+        # Each Streamlit rerun gets a fresh event loop; release its pooled connections
+        await close_async_clients()
+
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    asyncio.run(run())
\ No newline at end of file
@@ -0,0 +1,781 @@
+"""Offline benchmarks for the PDF processing pipeline.
+
+Usage:
+    python benchmark.py extract --pages 200 500 --workers 4
+    python benchmark.py sessions --users 5000 --threads 32
+    python benchmark.py ann --sizes 20000 200000 --nprobe 8 32 --ef-search 32 128
+    python benchmark.py lexical --chunks 10000 50000
+    python benchmark.py chunk --pages 1000 --chunk-tokens 256
+    python benchmark.py dedup --pages 30 --versions 3 --edit-rate 0.01
+    python benchmark.py embed --threads 1 2 4 --batch-tokens 2048 8192 --backends torch onnx
+    python benchmark.py llm --requests 300 --rate-limit 20 --fail-rate 0.1
+    python benchmark.py ocr --pages 40 --scanned-ratio 0.5
+    python benchmark.py pipeline --pages 50 200 --output results.json --compare baseline.json
+    python benchmark.py memory --documents 5 --chunks 2000 --sessions 20
+"""
+import os
+import sys
+import json
+import time
+import shelve
+import shutil
+import tempfile
+import threading
+import random
+import asyncio
+import logging
+import argparse
+import itertools
+import platform
+import resource
+import statistics
+import subprocess
+import tracemalloc
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Tuple
+
+import fitz  # PyMuPDF
+import numpy as np
+
+from core import (
+    PDFProcessor, PageOCR, SessionStore, MemorySessionStore, SQLiteSessionStore, TieredSessionStore,
+    INDEX_TYPES, VECTOR_DTYPES, IndexConfig, build_faiss_index, tune_index, optimize_vectorstore, LexicalIndex,
+    get_token_encoding, IndexStore, DocumentCorpus, EmbeddingEngine, EMBEDDING_BACKENDS, ChunkDeduplicator, QAEngine, ContextAssembler,
+    OpenRouterLLM, LLMScheduler, PRIORITY_INTERACTIVE, PRIORITY_BACKGROUND, is_llm_error, close_async_clients,
+)
+from mock_openrouter import start_mock_server
+
+WORDS = (
+    "system document analysis report section figure table result method data model value "
+    "process control output input request response section clause part number summary "
+    "review policy contract revision appendix schedule manual operation safety procedure"
+).split()
+
+
+def make_synthetic_pdf(pages: int, words_per_page: int = 450, seed: int = 0) -> bytes:
+    """Build a text PDF with ``pages`` pages of pseudo-random prose."""
+    rng = random.Random(seed)
+    doc = fitz.open()
+    for number in range(pages):
+        page = doc.new_page()
+        words = [rng.choice(WORDS) for _ in range(words_per_page)]
+        sentences = [" ".join(words[i:i + 15]).capitalize() + "." for i in range(0, len(words), 15)]
+        body = f"Page {number + 1}\n\n" + " ".join(sentences)
+        page.insert_textbox(fitz.Rect(50, 50, page.rect.width - 50, page.rect.height - 50), body, fontsize=9)
+    data = doc.tobytes()
+    doc.close()
+    return data
+
+
+def make_scanned_pdf(pages: int, scanned_ratio: float, dpi: int = 150, seed: int = 0) -> bytes:
+    """``make_synthetic_pdf`` with a share of the pages replaced by images of themselves (no text layer)."""
+    source = fitz.open(stream=make_synthetic_pdf(pages, seed=seed), filetype="pdf")
+    rng = random.Random(seed)
+    doc = fitz.open()
+    for number, page in enumerate(source):
+        if rng.random() < scanned_ratio:
+            scan = doc.new_page(width=page.rect.width, height=page.rect.height)
+            scan.insert_image(scan.rect, pixmap=page.get_pixmap(dpi=dpi, colorspace=fitz.csGRAY))
+        else:
+            doc.insert_pdf(source, from_page=number, to_page=number)
+    data = doc.tobytes()
+    doc.close()
+    source.close()
+    return data
+
+
+def _timed(fn, repeat: int) -> List[float]:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def bench_extract(args, processor: PDFProcessor) -> None:
+    """Serial vs page-parallel extraction, plus time to first page for the streaming API."""
+    for pages in args.pages:
+        pdf_bytes = make_synthetic_pdf(pages)
+        # Warm the worker pool so process start-up is not charged to the first run
+        processor.extract_text_from_pdf(pdf_bytes, parallel=True)
+
+        serial = _timed(lambda: processor.extract_text_from_pdf(pdf_bytes), args.repeat)
+        parallel = _timed(lambda: processor.extract_text_from_pdf(pdf_bytes, parallel=True), args.repeat)
+
+        start = time.perf_counter()
+        first_page = None
+        for _ in processor.iter_pages(pdf_bytes, parallel=True):
+            if first_page is None:
+                first_page = time.perf_counter() - start
+
+        serial_s, parallel_s = statistics.median(serial), statistics.median(parallel)
+        print(
+            f"{pages:>5} pages ({len(pdf_bytes) / 1e6:.1f} MB): serial {serial_s * 1000:8.1f} ms | "
+            f"parallel {parallel_s * 1000:8.1f} ms | speedup {serial_s / parallel_s:4.2f}x | "
+            f"first page {first_page * 1000:6.1f} ms"
+        )
+
+
+class ShelveSessionStore(SessionStore):
+    """The bot's previous storage: one shelve file opened and closed on every call."""
+
+    def __init__(self, path: str):
+        super().__init__()
+        self.path = path
+        self._lock = threading.Lock()  # shelve has no safe concurrent access
+
+    def get(self, user_id):
+        with self._lock, shelve.open(self.path) as db:
+            return db.get(str(user_id), dict(self.NEW_SESSION))
+
+    def save(self, user_id, session):
+        with self._lock, shelve.open(self.path) as db:
+            db[str(user_id)] = session
+
+
+def bench_sessions(args, processor: PDFProcessor) -> None:
+    """Many users hitting /status (read) and questions (read + write) from concurrent threads."""
+    tmp_dir = tempfile.mkdtemp()
+    stores = {
+        "shelve": lambda: ShelveSessionStore(os.path.join(tmp_dir, "sessions.db")),
+        "memory": lambda: MemorySessionStore(),
+        "sqlite": lambda: SQLiteSessionStore(os.path.join(tmp_dir, "sessions.sqlite3")),
+        "sqlite+memory": lambda: TieredSessionStore(SQLiteSessionStore(os.path.join(tmp_dir, "tiered.sqlite3"))),
+    }
+    rng = random.Random(0)
+    # (user, is_question) for every simulated request
+    requests = [(rng.randrange(args.users), rng.random() < args.question_ratio) for _ in range(args.requests)]
+
+    for name, make_store in stores.items():
+        if args.stores and name not in args.stores:
+            continue
+        store = make_store()
+        for user_id in range(args.users):
+            store.save(user_id, {"status": "ready", "pdf_name": f"user{user_id}.pdf", "char_count": 120_000,
+                                 "chunk_count": 150, "doc_hash": f"{user_id:064x}"})
+
+        def handle(request):
+            user_id, is_question = request
+            start = time.perf_counter()
+            session = store.get(user_id)
+            if is_question:
+                session["char_count"] = session.get("char_count", 0) + 1
+                store.save(user_id, session)
+            return time.perf_counter() - start
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.threads) as executor:
+            latencies = sorted(executor.map(handle, requests))
+        elapsed = time.perf_counter() - start
+        store.close()
+
+        p50 = latencies[len(latencies) // 2]
+        p99 = latencies[int(len(latencies) * 0.99)]
+        print(
+            f"{name:>14}: {len(requests) / elapsed:9.0f} req/s | p50 {p50 * 1e6:8.0f} us | p99 {p99 * 1e6:8.0f} us "
+            f"({args.users} users, {args.threads} threads)"
+        )
+
+
+def make_synthetic_vectors(n: int, dim: int = 384, clusters: int = 200, seed: int = 0) -> np.ndarray:
+    """Unit vectors drawn around random topic centres, roughly like sentence embeddings of a corpus."""
+    rng = np.random.default_rng(seed)
+    centres = rng.standard_normal((clusters, dim)).astype(np.float32)
+    vectors = centres[rng.integers(clusters, size=n)] + 1.0 * rng.standard_normal((n, dim)).astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors
+
+
+def bench_ann(args, processor: PDFProcessor) -> None:
+    """Recall@k, single-query latency and memory of each index type against exact search."""
+    import faiss
+    for n in args.sizes:
+        vectors = make_synthetic_vectors(n + args.queries, seed=n)
+        corpus, queries = vectors[:n], vectors[n:]
+        flat = build_faiss_index(corpus, IndexConfig(), "flat")
+        _, truth = flat.search(queries, args.k)
+
+        print(f"{n} vectors ({corpus.nbytes / 1e6:.0f} MB raw), recall@{args.k} over {args.queries} queries:")
+        for index_type, dtype in itertools.product(args.types or INDEX_TYPES, args.dtypes):
+            if index_type == "ivf_pq" and dtype != "float32":
+                continue  # PQ codes are already compressed
+            start = time.perf_counter()
+            index = build_faiss_index(corpus, IndexConfig(vector_dtype=dtype), index_type)
+            build_s = time.perf_counter() - start
+            memory_mb = faiss.serialize_index(index).nbytes / 1e6
+            knobs = {"hnsw": ("ef_search", args.ef_search), "ivf_flat": ("nprobe", args.nprobe),
+                     "ivf_pq": ("nprobe", args.nprobe)}.get(index_type, ("", [None]))
+            for value in knobs[1]:
+                if value is not None:
+                    tune_index(index, IndexConfig(**{knobs[0]: value}))
+                latencies = []
+                found = np.empty_like(truth)
+                for i, query in enumerate(queries):
+                    start = time.perf_counter()
+                    _, ids = index.search(query[None, :], args.k)
+                    latencies.append(time.perf_counter() - start)
+                    found[i] = ids[0]
+                recall = np.mean([len(set(f) & set(t)) / args.k for f, t in zip(found, truth)])
+                setting = f"{knobs[0]}={value}" if value is not None else "exact"
+                print(
+                    f"  {index_type:>8} {dtype:>7} {setting:>13}: recall {recall:5.3f} | p50 {statistics.median(latencies) * 1e3:6.2f} ms | "
+                    f"memory {memory_mb:7.1f} MB | build {build_s:6.2f} s"
+                )
+
+
+def bench_lexical(args, processor: PDFProcessor) -> None:
+    """BM25 index build time, on-disk size and query latency on chunk-sized synthetic text."""
+    rng = random.Random(0)
+    for n in args.chunks:
+        # ~170 words per chunk, each with a few identifiers like part numbers and clause ids
+        part_numbers = [f"{rng.choice('ABCDEFGH')}{rng.choice('KLMNPRST')}-{rng.randrange(10000):04d}" for _ in range(n // 4)]
+        texts = [
+            " ".join(rng.choice(WORDS) for _ in range(170))
+            + f" part {rng.choice(part_numbers)} clause {rng.randrange(1, 20)}.{rng.randrange(1, 10)}.{rng.randrange(1, 10)}"
+            for _ in range(n)
+        ]
+        ids = [str(i) for i in range(n)]
+
+        index = LexicalIndex()
+        start = time.perf_counter()
+        index.add(ids, texts)
+        build_s = time.perf_counter() - start
+        tmp_dir = tempfile.mkdtemp()
+        index.save(tmp_dir)
+        size_mb = os.path.getsize(os.path.join(tmp_dir, LexicalIndex.FILENAME)) / 1e6
+
+        queries = [f"{rng.choice(WORDS)} {rng.choice(WORDS)} part {rng.choice(part_numbers)}" for _ in range(args.queries)]
+        latencies = sorted(_timed(
+            lambda: index.search(queries[rng.randrange(len(queries))], args.k, min_ratio=args.min_ratio), args.queries
+        ))
+        print(
+            f"{n:>7} chunks: build {build_s:6.2f} s | on disk {size_mb:6.1f} MB | "
+            f"query p50 {latencies[len(latencies) // 2] * 1e3:6.3f} ms | p99 {latencies[int(len(latencies) * 0.99)] * 1e3:6.3f} ms"
+        )
+
+
+def bench_chunk(args, processor: PDFProcessor) -> None:
+    """Character splitter vs token/layout chunker: split time and chunk length in tokens."""
+    encoding = get_token_encoding()
+    token_processor = PDFProcessor(cache_dir=None, chunking="tokens", chunk_tokens=args.chunk_tokens)
+    pdf_bytes = make_synthetic_pdf(args.pages)
+    variants = {
+        "characters": (processor, list(processor.iter_pages(pdf_bytes))),
+        "tokens": (token_processor, list(token_processor.iter_pages(pdf_bytes))),
+    }
+    for name, (splitter, pages) in variants.items():
+        chunks = []
+        timings = _timed(lambda: chunks.__setitem__(slice(None), splitter.split_pages_with_metadata(pages, {})), args.repeat)
+        lengths = np.array([len(tokens) for tokens in encoding.encode_ordinary_batch([c.page_content for c in chunks])])
+        print(
+            f"{name:>10}: {args.pages} pages in {statistics.median(timings) * 1000:7.1f} ms | {len(chunks):6} chunks | "
+            f"tokens mean {lengths.mean():6.1f} std {lengths.std():6.1f} p95 {np.percentile(lengths, 95):6.0f} "
+            f"max {lengths.max():5} | total {lengths.sum()}"
+        )
+
+
+def bench_embed(args, processor: PDFProcessor) -> None:
+    """Chunks/second of the plain HuggingFaceEmbeddings encoder vs EmbeddingEngine configurations.
+
+    Chunks come from a synthetic PDF split the way uploads are, with the
+    short page tails that make fixed-size batches pad. Every configuration
+    is checked against the baseline vectors.
+    """
+    import torch
+    from langchain_huggingface import HuggingFaceEmbeddings
+
+    pages = list(processor.iter_pages(make_synthetic_pdf(args.pages)))
+    texts = [doc.page_content for doc in processor.split_pages_with_metadata(pages, {})][:args.chunks]
+    default_threads = torch.get_num_threads()
+    print(f"{len(texts)} chunks, mean {np.mean([len(t) for t in texts]):.0f} chars, {os.cpu_count()} CPUs "
+          f"(torch default {default_threads} threads):")
+
+    def run(name: str, embed: Callable[[List[str]], List[List[float]]], reference: Any = None) -> np.ndarray:
+        embed(texts[:8])  # warm up
+        timings = _timed(lambda: embed(texts), args.repeat)
+        vectors = np.asarray(embed(texts), dtype=np.float32)
+        error = f" | max diff {np.abs(vectors - reference).max():.1e}" if reference is not None else ""
+        print(f"  {name:>34}: {len(texts) / statistics.median(timings):8.1f} chunks/s{error}")
+        return vectors
+
+    baseline = HuggingFaceEmbeddings(model_name=args.model, model_kwargs={"device": "cpu"})
+    reference = run("HuggingFaceEmbeddings (batch 32)", baseline.embed_documents)
+    for backend in args.backends:
+        for threads in args.threads or [default_threads]:
+            engine = EmbeddingEngine(args.model, backend=backend, threads=threads)
+            if engine.backend != backend:
+                break
+            for batch_tokens in args.batch_tokens:
+                engine.batch_tokens = batch_tokens
+                run(f"{backend} {threads} threads {batch_tokens} tokens/batch", engine.embed_documents, reference)
+    torch.set_num_threads(default_threads)
+
+
+def make_report_pdf(pages: int, edit_rate: float = 0.0, version: int = 0) -> bytes:
+    """A report with a running header and footer on every page; ``version`` changes ``edit_rate`` of its words."""
+    rng = random.Random(0)
+    edits = random.Random(version)
+    doc = fitz.open()
+    for number in range(pages):
+        page = doc.new_page()
+        words = [rng.choice(WORDS) for _ in range(400)]
+        for _ in range(int(len(words) * edit_rate)):
+            words[edits.randrange(len(words))] = edits.choice(WORDS)
+        sentences = [" ".join(words[i:i + 15]).capitalize() + "." for i in range(0, len(words), 15)]
+        body = (f"Example Industries - Annual Safety Report - Confidential\n\n{' '.join(sentences)}\n\n"
+                f"Page {number + 1} of {pages} | Document ref. 2024-{version + 1:04d}")
+        page.insert_textbox(fitz.Rect(50, 50, page.rect.width - 50, page.rect.height - 50), body, fontsize=9)
+    data = doc.tobytes()
+    doc.close()
+    return data
+
+
+def bench_dedup(args, processor: PDFProcessor) -> None:
+    """Boilerplate and near-duplicate removal on a report uploaded again in slightly edited versions.
+
+    Follows the production path: each version is ingested against the saved
+    MinHash signatures of the versions before it, saved to an ``IndexStore``,
+    and the corpus is assembled from the loaded indexes as the frontends do.
+    Reports the share of characters and chunks removed, the embedding calls
+    and index size it saves, and how many of the top-3 results per question
+    are distinct passages.
+    """
+    from langchain_community.embeddings import DeterministicFakeEmbedding
+
+    versions = [make_report_pdf(args.pages, args.edit_rate if version else 0.0, version) for version in range(args.versions)]
+    rng = random.Random(1)
+    questions = [" ".join(rng.choice(WORDS) for _ in range(6)) for _ in range(args.questions)]
+    for mode in ("off", "on"):
+        variant = PDFProcessor(cache_dir=None, dedup=mode, dedup_threshold=args.threshold)
+        if args.fake_embeddings:
+            variant.embeddings = DeterministicFakeEmbedding(size=384)
+        root = tempfile.mkdtemp()
+        try:
+            index_store = IndexStore(variant.embeddings, root=root)
+            saved: List[Tuple[str, str]] = []
+            chunks = skipped = boilerplate = chars = 0
+            start = time.perf_counter()
+            for number, pdf_bytes in enumerate(versions):
+                basis = [index_hash for _, index_hash in saved] if variant.dedup else []
+                known = [index_store.load_signatures(index_hash) for index_hash in basis]
+                known = [rows for rows in known if rows is not None and len(rows)]
+                name = f"report_v{number + 1}.pdf"
+                result = variant.ingest_stream(
+                    pdf_bytes, {"source": name}, keep_text=True,
+                    known_signatures=np.concatenate(known) if known else None,
+                )
+                chunks += result.chunk_count
+                skipped += result.duplicate_chunks
+                boilerplate += result.boilerplate_chars
+                chars += result.char_count
+                if result.vectorstore is None:
+                    continue
+                doc_hash = IndexStore.document_hash(pdf_bytes)
+                index_hash = IndexStore.deduplicated_hash(doc_hash, basis) if basis else doc_hash
+                index_store.save(
+                    index_hash, result.vectorstore, result.text, {"char_count": result.char_count, "chunk_count": result.chunk_count},
+                    lexical_index=result.lexical_index, signatures=result.signatures,
+                )
+                saved.append((name, index_hash))
+            elapsed = time.perf_counter() - start
+
+            corpus = DocumentCorpus(variant.embeddings)
+            for name, index_hash in saved:
+                corpus.add_vectorstore(name, index_store.load(index_hash), index_store.load_lexical(index_hash))
+            distinct = []
+            for question in questions:
+                seen = ChunkDeduplicator(args.threshold)
+                top = [doc.page_content for doc in corpus.search(question, 3)]
+                distinct.append(sum(not seen.is_duplicate(text) for text in top) / max(1, len(top)))
+            dimension = len(variant.embeddings.embed_query("dimension"))
+        finally:
+            shutil.rmtree(root, ignore_errors=True)
+        print(
+            f"dedup {mode:>3}: {chunks:5} chunks embedded, {skipped:5} skipped "
+            f"({skipped / max(1, chunks + skipped):5.1%}) | boilerplate {boilerplate / max(1, chars):5.1%} of chars | "
+            f"index {len(corpus) * dimension * 4 / 1e6:6.2f} MB | "
+            f"distinct top-3 {np.mean(distinct):5.1%} | {elapsed:6.2f} s"
+        )
+
+
+def bench_llm(args, processor: PDFProcessor) -> None:
+    """Synthetic Q&A + summary load against a rate-limited, flaky mock OpenRouter.
+
+    Compares calls without retries or a client-side limit to the scheduler
+    configured from the command line.
+    """
+    logging.getLogger("core").setLevel(logging.CRITICAL)  # one line per retry or failure otherwise
+    server = start_mock_server(delay=args.delay, rate_limit=args.rate_limit, fail_rate=args.fail_rate)
+    rng = random.Random(0)
+    # A small pool of prompts so concurrent users often ask the same thing
+    load = [
+        (f"question {rng.randrange(args.distinct)}", PRIORITY_INTERACTIVE) if rng.random() < args.interactive_ratio
+        else (f"summarize section {rng.randrange(args.distinct * 4)}", PRIORITY_BACKGROUND)
+        for _ in range(args.requests)
+    ]
+    variants = {
+        "no retry": LLMScheduler(max_concurrency=args.concurrency, max_retries=0),
+        "scheduler": LLMScheduler(max_concurrency=args.concurrency, rate_per_minute=args.rate_limit * 60,
+                                  burst=args.burst, max_retries=args.retries),
+    }
+
+    async def run(scheduler: LLMScheduler):
+        llm = OpenRouterLLM(api_key="mock", base_url=server.url, scheduler=scheduler, max_concurrency=args.concurrency)
+
+        async def call(prompt, priority):
+            start = time.perf_counter()
+            answer = await llm.ainvoke(prompt, priority=priority)
+            return priority, time.perf_counter() - start, is_llm_error(answer)
+
+        try:
+            return await asyncio.gather(*(call(prompt, priority) for prompt, priority in load))
+        finally:
+            await close_async_clients()
+
+    for name, scheduler in variants.items():
+        before = (server.request_count, server.rate_limited, server.failures)
+        start = time.perf_counter()
+        results = asyncio.run(run(scheduler))
+        elapsed = time.perf_counter() - start
+        upstream, limited, failed = (now - then for now, then in zip(
+            (server.request_count, server.rate_limited, server.failures), before))
+        stats = scheduler.stats()
+        print(
+            f"{name:>10}: {len(load)} calls in {elapsed:6.2f} s | errors {sum(r[2] for r in results):4} | "
+            f"upstream {upstream:4} answered, {limited:4} x 429, {failed:4} x 503 | "
+            f"coalesced {stats['coalesced']:4} | retries {stats['retries']:4}"
+        )
+        for label, priority in (("interactive", PRIORITY_INTERACTIVE), ("background", PRIORITY_BACKGROUND)):
+            latencies = sorted(r[1] for r in results if r[0] == priority)
+            if latencies:
+                print(
+                    f"{'':>12}{label:>11} p50 {latencies[len(latencies) // 2] * 1e3:8.1f} ms | "
+                    f"p99 {latencies[int(len(latencies) * 0.99)] * 1e3:8.1f} ms"
+                )
+    server.shutdown()
+
+
+def bench_ocr(args, processor: PDFProcessor) -> None:
+    """Extraction of a partly scanned PDF: text layer only, OCR from cold, and OCR again from the page cache."""
+    if not PageOCR.available():
+        print("OCR needs the pytesseract package and the Tesseract binary")
+        return
+    pdf_bytes = make_scanned_pdf(args.pages, args.scanned_ratio)
+    ocr_processor = PDFProcessor(cache_dir=tempfile.mkdtemp(), ocr="on")
+    # Warm the worker pool so process start-up is not charged to the first run
+    ocr_processor.extract_text_from_pdf(make_scanned_pdf(2, 1.0, seed=1), parallel=True)
+    runs = [
+        ("text layer", PDFProcessor(cache_dir=None, ocr="off")),
+        ("ocr cold", ocr_processor),
+        ("ocr cached", ocr_processor),
+    ]
+    for name, extractor in runs:
+        start = time.perf_counter()
+        pages = list(extractor.iter_pages(pdf_bytes, parallel=True))
+        elapsed = time.perf_counter() - start
+        empty = sum(1 for _, text in pages if not text.strip())
+        print(
+            f"{name:>10}: {args.pages} pages in {elapsed:7.2f} s | {empty:4} pages without text | "
+            f"{sum(len(text) for _, text in pages):8} chars"
+        )
+
+
+def _profile(fn: Callable[[], Any], repeat: int) -> Tuple[Any, Dict[str, float]]:
+    """Median wall time over ``repeat`` plain runs, then one run under tracemalloc for the peak allocation."""
+    timings = _timed(fn, repeat)
+    tracemalloc.start()
+    try:
+        result = fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, {"seconds": statistics.median(timings), "peak_mb": peak / 1e6}
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def bench_pipeline(args, processor: PDFProcessor) -> None:
+    """Time and memory of every ingestion and Q&A stage on synthetic PDFs, written as JSON.
+
+    Stages: extract_text_from_pdf, split_text_with_metadata, embedding, FAISS
+    build, hybrid retrieval and answer generation against the local mock
+    OpenRouter server, so the whole run is offline and CPU only.
+    """
+    from langchain_community.vectorstores import FAISS
+
+    if args.fake_embeddings:
+        from langchain_community.embeddings import DeterministicFakeEmbedding
+        processor.embeddings = DeterministicFakeEmbedding(size=384)
+    server = start_mock_server(delay=args.llm_delay)
+    llm = OpenRouterLLM(api_key="mock", base_url=server.url)
+    rng = random.Random(0)
+    questions = [f"What does the {rng.choice(WORDS)} {rng.choice(WORDS)} section say?" for _ in range(args.questions)]
+
+    report = {
+        "commit": _git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "settings": {"repeat": args.repeat, "questions": args.questions, "fake_embeddings": args.fake_embeddings,
+                     "llm_delay": args.llm_delay},
+        "runs": [],
+    }
+    for pages in args.pages:
+        pdf_bytes = make_synthetic_pdf(pages)
+        stages: Dict[str, Dict[str, float]] = {}
+
+        text, stages["extract"] = _profile(lambda: processor.extract_text_from_pdf(pdf_bytes), args.repeat)
+        docs, stages["split"] = _profile(lambda: processor.split_text_with_metadata(text, {"source": "bench.pdf"}), args.repeat)
+        texts = [doc.page_content for doc in docs]
+        vectors, stages["embed"] = _profile(lambda: processor.embeddings.embed_documents(texts), args.repeat)
+
+        def build():
+            store = FAISS.from_embeddings(list(zip(texts, vectors)), processor.embeddings,
+                                          metadatas=[doc.metadata for doc in docs])
+            return optimize_vectorstore(store, processor.index_config)
+
+        store, stages["faiss_build"] = _profile(build, args.repeat)
+        corpus = DocumentCorpus(processor.embeddings, store)
+        engine = QAEngine(corpus, llm, assembler=ContextAssembler.for_model(llm.model))
+        _, stages["retrieve"] = _profile(lambda: [corpus.hybrid_search(q, 3) for q in questions], args.repeat)
+        _, stages["answer"] = _profile(lambda: [engine.answer(q).answer for q in questions], args.repeat)
+
+        counts = {"extract": pages, "split": len(docs), "embed": len(texts), "faiss_build": len(texts),
+                  "retrieve": len(questions), "answer": len(questions)}
+        for name, stage in stages.items():
+            stage["items"] = counts[name]
+            stage["ms_per_item"] = stage["seconds"] * 1000 / max(1, counts[name])
+        report["runs"].append({"pages": pages, "chars": len(text), "chunks": len(docs), "stages": stages})
+
+        print(f"{pages} pages ({len(text)} chars, {len(docs)} chunks):")
+        for name, stage in stages.items():
+            print(
+                f"  {name:>12}: {stage['seconds'] * 1000:9.1f} ms | {stage['ms_per_item']:8.3f} ms/item | "
+                f"peak {stage['peak_mb']:7.1f} MB"
+            )
+    report["max_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    server.shutdown()
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Wrote {args.output}")
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print(f"Change against {args.compare} (commit {baseline.get('commit', '?')}):")
+        old_runs = {run["pages"]: run["stages"] for run in baseline.get("runs", [])}
+        for run in report["runs"]:
+            for name, stage in run["stages"].items():
+                old = old_runs.get(run["pages"], {}).get(name)
+                if old and old["seconds"]:
+                    change = stage["seconds"] / old["seconds"] - 1
+                    flag = "  <-- slower" if change > args.threshold else ""
+                    print(f"  {run['pages']:>5} pages {name:>12}: {change * 100:+7.1f}% time, "
+                          f"{stage['peak_mb'] - old['peak_mb']:+7.1f} MB peak{flag}")
+
+
+def _memory_mb() -> Dict[str, float]:
+    """Resident memory of this process, split into private and shared (page cache) pages where Linux reports it."""
+    try:
+        with open("/proc/self/smaps_rollup") as f:
+            fields = {line.split(":")[0]: int(line.split()[1]) for line in f if line.strip().endswith("kB")}
+        private = fields["Private_Clean"] + fields["Private_Dirty"]
+        return {"rss": fields["Rss"] / 1024, "private": private / 1024, "shared": (fields["Rss"] - private) / 1024}
+    except (OSError, KeyError, IndexError, ValueError):
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        return {"rss": rss, "private": rss, "shared": 0.0}
+
+
+def _session_memory(root: str, hashes: List[str], sessions: int, queries: np.ndarray) -> Dict[str, float]:
+    """Open ``sessions`` corpora over the same documents the way the Telegram bot does.
+
+    Returns the memory the first session took (``first_*``, including opening
+    the documents) and what each further session added.
+    """
+    from langchain_community.embeddings import DeterministicFakeEmbedding
+    embeddings = DeterministicFakeEmbedding(size=queries.shape[1])
+    index_store = IndexStore(embeddings, root=root)
+    corpora = []
+    snapshots = [_memory_mb()]
+    for _ in range(sessions):
+        corpus = DocumentCorpus(embeddings)
+        for doc_hash in hashes:
+            corpus.add_vectorstore(doc_hash, index_store.load(doc_hash), index_store.load_lexical(doc_hash))
+        corpus.search_by_vectors(queries.tolist(), 3)
+        corpora.append(corpus)
+        snapshots.append(_memory_mb())
+    first, last = snapshots[1], snapshots[-1]
+    report = {f"first_{name}": first[name] - snapshots[0][name] for name in first}
+    report.update({name: (last[name] - first[name]) / max(1, sessions - 1) for name in last})
+    return report
+
+
+def bench_memory(args, processor: PDFProcessor) -> None:
+    """Resident memory per Telegram session for pickled float32 indexes vs memory-mapped float32/float16/int8.
+
+    Each storage format is measured in a fresh process. Pickled indexes are
+    copied into every session's corpus; mapped ones are shared, so their
+    vectors and chunks show up once, as shared page cache.
+    """
+    from langchain_community.vectorstores import FAISS
+    from langchain_community.embeddings import DeterministicFakeEmbedding
+
+    embeddings = DeterministicFakeEmbedding(size=384)
+    rng = random.Random(0)
+    queries = make_synthetic_vectors(10, seed=1)
+    formats = ["pickle"] + [f"mapped {dtype}" for dtype in VECTOR_DTYPES]
+    context = multiprocessing.get_context("spawn")
+    print(f"{args.documents} documents x {args.chunks} chunks, {args.sessions} sessions:")
+    for name in formats:
+        root = tempfile.mkdtemp()
+        config = IndexConfig(vector_dtype=name.split()[-1] if name != "pickle" else "float32")
+        hashes = []
+        for number in range(args.documents):
+            vectors = make_synthetic_vectors(args.chunks, seed=number)
+            texts = [" ".join(rng.choice(WORDS) for _ in range(150)) for _ in range(args.chunks)]
+            store = FAISS.from_embeddings(list(zip(texts, vectors.tolist())), embeddings,
+                                          metadatas=[{"source": f"doc{number}.pdf", "page": i // 3} for i in range(args.chunks)])
+            store = optimize_vectorstore(store, config)
+            lexical = LexicalIndex()
+            lexical.add([store.index_to_docstore_id[i] for i in range(args.chunks)], texts)
+            doc_hash = f"{number:064x}"
+            if name == "pickle":
+                # The layout IndexStore wrote before chunks were memory-mapped
+                path = os.path.join(root, doc_hash)
+                store.save_local(path)
+                lexical.save(path)
+                with open(os.path.join(path, "info.json"), "w") as f:
+                    json.dump({"chunk_count": args.chunks}, f)
+            else:
+                IndexStore(embeddings, root=root, max_open=0).save(doc_hash, store, "", {"chunk_count": args.chunks},
+                                                                   lexical_index=lexical)
+            hashes.append(doc_hash)
+        disk_mb = sum(os.path.getsize(os.path.join(d, f)) for d, _, files in os.walk(root) for f in files) / 1e6
+
+        with context.Pool(1) as pool:
+            per_session = pool.apply(_session_memory, (root, hashes, args.sessions, queries))
+        print(
+            f"  {name:>15}: first session {per_session['first_rss']:7.2f} MB RSS "
+            f"({per_session['first_shared']:6.2f} MB shared) | each further session {per_session['rss']:7.2f} MB RSS "
+            f"({per_session['private']:6.2f} MB private) | {disk_mb:6.1f} MB on disk"
+        )
+        shutil.rmtree(root, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    extract = subparsers.add_parser("extract", help="serial vs parallel PDF text extraction")
+    extract.add_argument("--pages", type=int, nargs="+", default=[200, 500, 1000])
+    extract.add_argument("--repeat", type=int, default=3)
+    extract.add_argument("--workers", type=int, default=os.cpu_count())
+    extract.set_defaults(func=bench_extract)
+
+    sessions = subparsers.add_parser("sessions", help="session store throughput under concurrent users")
+    sessions.add_argument("--users", type=int, default=5000)
+    sessions.add_argument("--requests", type=int, default=50_000)
+    sessions.add_argument("--threads", type=int, default=32)
+    sessions.add_argument("--question-ratio", type=float, default=0.3)
+    sessions.add_argument("--stores", nargs="*", help="subset of: shelve memory sqlite sqlite+memory")
+    sessions.set_defaults(func=bench_sessions)
+
+    ann = subparsers.add_parser("ann", help="recall, latency and memory of the FAISS index types")
+    ann.add_argument("--sizes", type=int, nargs="+", default=[20_000, 200_000])
+    ann.add_argument("--queries", type=int, default=500)
+    ann.add_argument("--k", type=int, default=10)
+    ann.add_argument("--types", nargs="*", choices=INDEX_TYPES)
+    ann.add_argument("--nprobe", type=int, nargs="+", default=[8, 16, 64])
+    ann.add_argument("--ef-search", type=int, nargs="+", default=[32, 64, 128])
+    ann.add_argument("--dtypes", nargs="+", choices=VECTOR_DTYPES, default=["float32"],
+                     help="vector storage; float16 and int8 use a scalar quantizer")
+    ann.set_defaults(func=bench_ann)
+
+    lexical = subparsers.add_parser("lexical", help="BM25 lexical index size and query latency")
+    lexical.add_argument("--chunks", type=int, nargs="+", default=[10_000, 50_000])
+    lexical.add_argument("--queries", type=int, default=1000)
+    lexical.add_argument("--k", type=int, default=20)
+    lexical.add_argument("--min-ratio", type=float, default=0.25, help="as used by hybrid search; 0 scores every match")
+    lexical.set_defaults(func=bench_lexical)
+
+    chunk = subparsers.add_parser("chunk", help="character splitter vs token/layout chunker")
+    chunk.add_argument("--pages", type=int, default=1000)
+    chunk.add_argument("--chunk-tokens", type=int, default=256)
+    chunk.add_argument("--repeat", type=int, default=3)
+    chunk.set_defaults(func=bench_chunk)
+
+    embed = subparsers.add_parser("embed", help="embedding throughput per backend, thread count and batch size")
+    embed.add_argument("--model", default="sentence-transformers/all-MiniLM-L6-v2")
+    embed.add_argument("--pages", type=int, default=100)
+    embed.add_argument("--chunks", type=int, default=1000)
+    embed.add_argument("--backends", nargs="+", choices=EMBEDDING_BACKENDS, default=["torch"])
+    embed.add_argument("--threads", type=int, nargs="*", help="intra-op threads (default: torch's own choice)")
+    embed.add_argument("--batch-tokens", type=int, nargs="+", default=[2048, 8192, 32768])
+    embed.add_argument("--repeat", type=int, default=3)
+    embed.set_defaults(func=bench_embed)
+
+    dedup = subparsers.add_parser("dedup", help="boilerplate and near-duplicate chunk removal over re-uploaded versions")
+    dedup.add_argument("--pages", type=int, default=30)
+    dedup.add_argument("--versions", type=int, default=3, help="uploads of the same report")
+    dedup.add_argument("--edit-rate", type=float, default=0.01, help="fraction of words changed in each later version")
+    dedup.add_argument("--threshold", type=float, default=0.9, help="MinHash similarity treated as a duplicate")
+    dedup.add_argument("--questions", type=int, default=50)
+    dedup.add_argument("--fake-embeddings", action="store_true",
+                       help="hash-based embeddings instead of the model (when it is not downloaded)")
+    dedup.set_defaults(func=bench_dedup)
+
+    llm = subparsers.add_parser("llm", help="LLM call scheduling against a rate-limited, flaky mock server")
+    llm.add_argument("--requests", type=int, default=300)
+    llm.add_argument("--distinct", type=int, default=40, help="distinct questions in the load")
+    llm.add_argument("--interactive-ratio", type=float, default=0.5)
+    llm.add_argument("--concurrency", type=int, default=8)
+    llm.add_argument("--delay", type=float, default=0.05, help="mock server seconds per answer")
+    llm.add_argument("--rate-limit", type=float, default=20, help="mock server requests per second")
+    llm.add_argument("--fail-rate", type=float, default=0.1, help="mock server fraction of 503 answers")
+    llm.add_argument("--burst", type=int, default=5)
+    llm.add_argument("--retries", type=int, default=4)
+    llm.set_defaults(func=bench_llm)
+
+    ocr = subparsers.add_parser("ocr", help="OCR of image-only pages, cold and cached")
+    ocr.add_argument("--pages", type=int, default=40)
+    ocr.add_argument("--scanned-ratio", type=float, default=0.5)
+    ocr.add_argument("--workers", type=int, default=os.cpu_count())
+    ocr.set_defaults(func=bench_ocr)
+
+    pipeline = subparsers.add_parser("pipeline", help="time and memory of each ingestion and Q&A stage, as JSON")
+    pipeline.add_argument("--pages", type=int, nargs="+", default=[50, 200])
+    pipeline.add_argument("--repeat", type=int, default=3)
+    pipeline.add_argument("--questions", type=int, default=20)
+    pipeline.add_argument("--llm-delay", type=float, default=0.0, help="mock server seconds per answer")
+    pipeline.add_argument("--fake-embeddings", action="store_true",
+                          help="hash-based embeddings instead of the model (when it is not downloaded)")
+    pipeline.add_argument("--output", help="write the results to this JSON file")
+    pipeline.add_argument("--compare", help="earlier JSON results to compare against")
+    pipeline.add_argument("--threshold", type=float, default=0.1, help="flag stages this much slower than --compare")
+    pipeline.set_defaults(func=bench_pipeline)
+
+    memory = subparsers.add_parser("memory", help="resident memory per session for each vector storage format")
+    memory.add_argument("--documents", type=int, default=5)
+    memory.add_argument("--chunks", type=int, default=2000, help="chunks per document")
+    memory.add_argument("--sessions", type=int, default=20, help="sessions opening all the documents")
+    memory.set_defaults(func=bench_memory)
+
+    args = parser.parse_args()
+    if getattr(args, "workers", None):
+        os.environ.setdefault("EXTRACT_WORKERS", str(args.workers))
+    args.func(args, PDFProcessor(cache_dir=None))
+
+
+if __name__ == "__main__":
+    main()
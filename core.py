@@ -1,63 +1,1052 @@
 
+import io
 import os
+import re
+import sys
+import json
+import math
+import asyncio
+import weakref
+import time
+import shutil
+import tempfile
+import sqlite3
+import hashlib
+import uuid
+import zlib
+import bisect
+import heapq
+import queue
+import random
+import threading
+import multiprocessing
+import cProfile
+import pstats
+from abc import ABC, abstractmethod
+from array import array
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from collections import OrderedDict
+from contextlib import asynccontextmanager, contextmanager
+from dataclasses import dataclass, field, replace
+from email.utils import parsedate_to_datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
 import fitz  # PyMuPDF
+import numpy as np
+import httpx
 import requests
-from typing import List, Any, Optional
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_huggingface import HuggingFaceEmbeddings
-from langchain_community.vectorstores import FAISS
-from langchain.llms.base import LLM
-from langchain.schema import Generation, LLMResult, Document
-from langchain.callbacks.manager import CallbackManagerForLLMRun
+import requests.adapters
+from functools import lru_cache
+from typing import TYPE_CHECKING, List, Any, Optional, Dict, Iterable, Iterator, AsyncIterator, Tuple, Callable, Awaitable
+from langchain_core.language_models.llms import LLM
+from langchain_core.documents import Document
+from langchain_core.callbacks import CallbackManagerForLLMRun, AsyncCallbackManagerForLLMRun
+from langchain_core.outputs import GenerationChunk
+from langchain_core.embeddings import Embeddings
 from pydantic import Field
 import logging
 
+# The embedding model (torch), FAISS, the text splitters and the chain classes are
+# imported where they are first used so that both entry points start without paying for them
+if TYPE_CHECKING:
+    from langchain_community.vectorstores import FAISS
+
 logger = logging.getLogger(__name__)
 
+# Environment-backed parameters are read when the object is created, not when this module
+# is imported. None switches the embedding cache off, so its "not given" needs its own marker
+_CACHE_DIR_FROM_ENV: Any = object()
+
+
+def _cache_dir_from_env(cache_dir: Optional[str]) -> Optional[str]:
+    if cache_dir is _CACHE_DIR_FROM_ENV:
+        return os.getenv("EMBEDDING_CACHE_DIR", ".embedding_cache")
+    return cache_dir
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+TOKEN_BUCKETS = (64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384, 32768)
+
+# name -> (type, help, histogram buckets); metrics not listed here are exported untyped
+METRICS: Dict[str, Tuple[str, str, Tuple[float, ...]]] = {
+    "ingest_seconds": ("histogram", "Whole ingest_stream run per document", LATENCY_BUCKETS),
+    "extract_seconds": ("histogram", "Text extraction time per document", LATENCY_BUCKETS),
+    "extract_pages_total": ("counter", "Pages extracted", ()),
+    "ocr_seconds": ("histogram", "OCR time per page that was not cached", LATENCY_BUCKETS),
+    "ocr_pages_total": ("counter", "Pages without a text layer sent to OCR", ()),
+    "chunk_seconds": ("histogram", "Chunking time per document", LATENCY_BUCKETS),
+    "chunks_total": ("counter", "Chunks produced", ()),
+    "duplicate_chunks_total": ("counter", "Near-duplicate chunks skipped at ingest", ()),
+    "boilerplate_chars_total": ("counter", "Header and footer characters removed at ingest", ()),
+    "embed_seconds": ("histogram", "Embedding model time per batch", LATENCY_BUCKETS),
+    "embedded_texts_total": ("counter", "Texts run through the embedding model", ()),
+    "index_build_seconds": ("histogram", "FAISS index build time", LATENCY_BUCKETS),
+    "retrieval_seconds": ("histogram", "Retrieval time per question batch", LATENCY_BUCKETS),
+    "context_tokens": ("histogram", "Context tokens stuffed into a Q&A prompt", TOKEN_BUCKETS),
+    "llm_request_seconds": ("histogram", "LLM request time including queueing and retries", LATENCY_BUCKETS),
+    "llm_first_token_seconds": ("histogram", "Time to the first streamed LLM token", LATENCY_BUCKETS),
+    "llm_requests_total": ("counter", "LLM requests by outcome", ()),
+    "llm_tokens_total": ("counter", "Prompt and completion tokens reported by the LLM service", ()),
+    "llm_coalesced_total": ("counter", "LLM calls served by an identical request already in flight", ()),
+    "llm_retries_total": ("counter", "LLM requests retried after a 429 or 5xx", ()),
+    "llm_throttled_seconds_total": ("counter", "Time LLM requests waited for the rate limit", ()),
+    "cache_requests_total": ("counter", "Cache lookups by cache and result", ()),
+    "queue_depth": ("gauge", "Jobs or calls waiting in a queue", ()),
+}
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+
+class MetricsRegistry:
+    """Process-wide counters, gauges and histograms in the Prometheus text format.
+
+    Series are created on first use and keyed by name and labels. Gauges can
+    also be callbacks read at render time, such as queue depths. A worker
+    process can ``export`` what it recorded so the parent can ``merge`` it.
+    """
+
+    def __init__(self, prefix: str = "pdfqa"):
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._counters: Dict[Tuple[str, LabelKey], float] = {}
+        self._gauges: Dict[Tuple[str, LabelKey], float] = {}
+        self._callbacks: Dict[Tuple[str, LabelKey], Callable[[], float]] = {}
+        # (name, labels) -> [per-bucket counts..., +Inf count, sum]
+        self._histograms: Dict[Tuple[str, LabelKey], List[float]] = {}
+
+    @staticmethod
+    def _key(name: str, labels: Dict[str, Any]) -> Tuple[str, LabelKey]:
+        return name, tuple(sorted((label, str(value)) for label, value in labels.items()))
+
+    @staticmethod
+    def _buckets(name: str) -> Tuple[float, ...]:
+        return METRICS.get(name, ("histogram", "", LATENCY_BUCKETS))[2] or LATENCY_BUCKETS
+
+    def inc(self, name: str, value: float = 1.0, **labels: Any) -> None:
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0.0) + value
+
+    def set(self, name: str, value: float, **labels: Any) -> None:
+        with self._lock:
+            self._gauges[self._key(name, labels)] = value
+
+    def gauge_callback(self, name: str, fn: Callable[[], float], **labels: Any) -> None:
+        """Read ``fn()`` as the gauge's value whenever metrics are rendered."""
+        with self._lock:
+            self._callbacks[self._key(name, labels)] = fn
+
+    def observe(self, name: str, value: float, **labels: Any) -> None:
+        key = self._key(name, labels)
+        buckets = self._buckets(name)
+        with self._lock:
+            series = self._histograms.get(key)
+            if series is None:
+                series = self._histograms[key] = [0.0] * (len(buckets) + 2)
+            series[bisect.bisect_left(buckets, value)] += 1
+            series[-1] += value
+
+    def export(self, reset: bool = True) -> Dict[str, Any]:
+        """Counters and histograms recorded so far, as plain data for ``merge`` in another process."""
+        with self._lock:
+            data = {"counters": list(self._counters.items()), "histograms": list(self._histograms.items())}
+            if reset:
+                self._counters, self._histograms = {}, {}
+        return data
+
+    def merge(self, data: Dict[str, Any]) -> None:
+        with self._lock:
+            for key, value in data.get("counters", []):
+                key = (key[0], tuple(map(tuple, key[1])))
+                self._counters[key] = self._counters.get(key, 0.0) + value
+            for key, series in data.get("histograms", []):
+                key = (key[0], tuple(map(tuple, key[1])))
+                current = self._histograms.get(key)
+                self._histograms[key] = list(series) if current is None else [a + b for a, b in zip(current, series)]
+
+    def _gauge_values(self) -> Dict[Tuple[str, LabelKey], float]:
+        with self._lock:
+            values = dict(self._gauges)
+            callbacks = list(self._callbacks.items())
+        for key, fn in callbacks:
+            try:
+                values[key] = float(fn())
+            except Exception as e:
+                logger.debug(f"Gauge {key[0]} unavailable: {str(e)}")
+        return values
+
+    @staticmethod
+    def _format_labels(labels: LabelKey, extra: Optional[Tuple[str, str]] = None) -> str:
+        pairs = list(labels) + ([extra] if extra else [])
+        if not pairs:
+            return ""
+
+        def escape(value: str) -> str:
+            return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+        return "{" + ",".join(f'{label}="{escape(value)}"' for label, value in pairs) + "}"
+
+    def render(self) -> str:
+        """All series in the Prometheus text exposition format."""
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((key, list(series)) for key, series in self._histograms.items())
+        gauges = sorted(self._gauge_values().items())
+
+        lines: List[str] = []
+        described = set()
+
+        def describe(name: str, kind: str) -> None:
+            if name not in described:
+                described.add(name)
+                help_text = METRICS.get(name, ("", name, ()))[1]
+                lines.append(f"# HELP {self.prefix}_{name} {help_text}")
+                lines.append(f"# TYPE {self.prefix}_{name} {kind}")
+
+        for (name, labels), value in counters:
+            describe(name, "counter")
+            lines.append(f"{self.prefix}_{name}{self._format_labels(labels)} {value:g}")
+        for (name, labels), value in gauges:
+            describe(name, "gauge")
+            lines.append(f"{self.prefix}_{name}{self._format_labels(labels)} {value:g}")
+        for (name, labels), series in histograms:
+            describe(name, "histogram")
+            cumulative = 0.0
+            for bound, count in zip(self._buckets(name) + (float("inf"),), series[:-1]):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                lines.append(f"{self.prefix}_{name}_bucket{self._format_labels(labels, ('le', le))} {cumulative:g}")
+            lines.append(f"{self.prefix}_{name}_sum{self._format_labels(labels)} {series[-1]:g}")
+            lines.append(f"{self.prefix}_{name}_count{self._format_labels(labels)} {cumulative:g}")
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def _quantile(buckets: Tuple[float, ...], counts: List[float], q: float) -> float:
+        """Quantile estimated by linear interpolation inside the bucket it falls in, as Prometheus does."""
+        total = sum(counts)
+        if not total:
+            return 0.0
+        rank = q * total
+        seen = 0.0
+        lower = 0.0
+        for bound, count in zip(buckets, counts):
+            if seen + count >= rank and count:
+                return lower + (bound - lower) * (rank - seen) / count
+            seen += count
+            lower = bound
+        return buckets[-1]  # in the +Inf bucket
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Readable summary for dashboards: counter and gauge values, histogram count/mean/p50/p95."""
+        with self._lock:
+            counters = {self._series_name(key): value for key, value in sorted(self._counters.items())}
+            histograms = {key: list(series) for key, series in sorted(self._histograms.items())}
+        summary = {}
+        for (name, labels), series in histograms.items():
+            buckets = self._buckets(name)
+            count = sum(series[:-1])
+            summary[self._series_name((name, labels))] = {
+                "count": count,
+                "mean": series[-1] / count if count else 0.0,
+                "p50": self._quantile(buckets, series[:-1], 0.5),
+                "p95": self._quantile(buckets, series[:-1], 0.95),
+                "sum": series[-1],
+            }
+        gauges = {self._series_name(key): value for key, value in sorted(self._gauge_values().items())}
+        return {"counters": counters, "gauges": gauges, "histograms": summary}
+
+    def _series_name(self, key: Tuple[str, LabelKey]) -> str:
+        return key[0] + self._format_labels(key[1])
+
+    def reset(self) -> None:
+        with self._lock:
+            self._counters, self._gauges, self._histograms = {}, {}, {}
+
+
+metrics = MetricsRegistry()
+
+
+class SamplingProfiler:
+    """py-spy style sampler toggled at runtime: a daemon thread records every thread's Python stack.
+
+    Unlike cProfile it sees all threads and costs little per call, so it can
+    run in production for a while. ``collapsed`` is flamegraph.pl / speedscope
+    input; ``top`` lists the functions most often on CPU and on the stack.
+    """
+
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.samples = 0
+        self._stacks: Dict[str, int] = {}
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self) -> bool:
+        """Start sampling; False if it was already running."""
+        with self._lock:
+            if self.running:
+                return False
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+            self._thread.start()
+            return True
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def reset(self) -> None:
+        with self._lock:
+            self._stacks, self.samples = {}, 0
+
+    def _run(self) -> None:
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            frames = sys._current_frames()
+            with self._lock:
+                for thread_id, frame in frames.items():
+                    if thread_id == own:
+                        continue
+                    names = []
+                    while frame is not None:
+                        code = frame.f_code
+                        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                        frame = frame.f_back
+                    stack = ";".join(reversed(names))
+                    self._stacks[stack] = self._stacks.get(stack, 0) + 1
+                self.samples += 1
+
+    def collapsed(self) -> str:
+        """One ``frame;frame;frame count`` line per distinct stack."""
+        with self._lock:
+            return "".join(f"{stack} {count}\n" for stack, count in sorted(self._stacks.items(), key=lambda i: -i[1]))
+
+    def top(self, limit: int = 20) -> List[Tuple[str, int, int]]:
+        """``(function, samples on top of the stack, samples anywhere on the stack)``, busiest first."""
+        own: Dict[str, int] = {}
+        total: Dict[str, int] = {}
+        with self._lock:
+            for stack, count in self._stacks.items():
+                frames = stack.split(";")
+                own[frames[-1]] = own.get(frames[-1], 0) + count
+                for name in set(frames):
+                    total[name] = total.get(name, 0) + count
+        return sorted(((name, own.get(name, 0), count) for name, count in total.items()), key=lambda i: (-i[1], -i[2]))[:limit]
+
+
+class StageProfiler:
+    """cProfile hook around the instrumented pipeline stages, switched on and off at runtime.
+
+    While ``enabled``, the outermost ``timed`` block on each thread runs
+    under its own ``cProfile.Profile`` and the results are added up, so
+    ``report`` covers every stage that ran since profiling was enabled.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self._stats: Optional[pstats.Stats] = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def enable(self) -> None:
+        with self._lock:
+            self._stats = None
+            self.enabled = True
+
+    def disable(self) -> None:
+        self.enabled = False
+
+    @property
+    def collected(self) -> bool:
+        return self._stats is not None
+
+    @contextmanager
+    def profile(self):
+        # Only one profiler can be active per thread, so nested stages are covered by the outer one
+        if not self.enabled or getattr(self._local, "active", False):
+            yield
+            return
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Python 3.12+ allows one active profiler per process; this stage goes unprofiled
+            yield
+            return
+        self._local.active = True
+        try:
+            yield
+        finally:
+            profile.disable()
+            self._local.active = False
+            with self._lock:
+                if self._stats is None:
+                    self._stats = pstats.Stats(profile)
+                else:
+                    self._stats.add(profile)
+
+    def report(self, limit: int = 40, sort: str = "cumulative") -> str:
+        with self._lock:
+            if self._stats is None:
+                return "No profile collected; enable profiling and run some work first.\n"
+            out = io.StringIO()
+            self._stats.stream = out
+            self._stats.sort_stats(sort).print_stats(limit)
+            return out.getvalue()
+
+
+sampling_profiler = SamplingProfiler()
+stage_profiler = StageProfiler()
+
+
+@contextmanager
+def timed(name: str, **labels: Any):
+    """Record the block's duration in histogram ``name`` and profile it when stage profiling is on.
+
+    For synchronous code only: around an ``await`` the time and profile would
+    include whatever else the event loop ran.
+    """
+    start = time.perf_counter()
+    with stage_profiler.profile():
+        try:
+            yield
+        finally:
+            metrics.observe(name, time.perf_counter() - start, **labels)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    """``/metrics`` plus runtime profiling switches under ``/debug/``."""
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, body: str, content_type: str = "text/plain; charset=utf-8", status: int = 200) -> None:
+        data = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        if url.path == "/metrics":
+            self._send(metrics.render(), "text/plain; version=0.0.4; charset=utf-8")
+        elif url.path == "/debug/profile":
+            # Sample every thread for ?seconds=N (default 10) and return collapsed stacks, or ?format=top
+            try:
+                seconds = float(query.get("seconds", "10"))
+            except ValueError:
+                seconds = math.nan
+            if not math.isfinite(seconds) or seconds <= 0:
+                self._send("seconds must be a positive number\n", status=400)
+                return
+            seconds = min(seconds, 300.0)
+            if not sampling_profiler.start():
+                self._send("A sampling profile is already running\n", status=409)
+                return
+            try:
+                sampling_profiler.reset()
+                time.sleep(seconds)
+            finally:
+                # Never leave the sampler running if the client goes away or anything above fails
+                sampling_profiler.stop()
+            if query.get("format") == "top":
+                rows = [f"{own:8} {total:8}  {name}" for name, own, total in sampling_profiler.top(50)]
+                self._send(f"{sampling_profiler.samples} samples\n    self    total  function\n" + "\n".join(rows) + "\n")
+            else:
+                self._send(sampling_profiler.collapsed())
+        elif url.path == "/debug/cprofile":
+            # ?enable=1 starts collecting, ?enable=0 stops; without it returns the report so far
+            if "enable" in query:
+                stage_profiler.enable() if query["enable"] in ("1", "true", "on") else stage_profiler.disable()
+                self._send(f"stage profiling {'enabled' if stage_profiler.enabled else 'disabled'}\n")
+            else:
+                try:
+                    report = stage_profiler.report(int(query.get("limit", "40")), query.get("sort", "cumulative"))
+                except (ValueError, KeyError) as e:
+                    self._send(f"bad limit or sort: {e}\n", status=400)
+                    return
+                self._send(report)
+        else:
+            self._send("not found\n", status=404)
+
+
+def start_metrics_server(port: int, host: Optional[str] = None) -> ThreadingHTTPServer:
+    """Serve ``/metrics`` and the ``/debug/`` profiling switches on a background thread.
+
+    The endpoints are unauthenticated, so they listen on localhost unless
+    ``host`` (``METRICS_HOST``) says otherwise.
+    """
+    host = host or os.getenv("METRICS_HOST", "127.0.0.1")
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    logger.info(f"Metrics on http://{host}:{server.server_address[1]}/metrics")
+    return server
+
+
+_sync_session: Optional[requests.Session] = None
+_sync_session_lock = threading.Lock()
+_async_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, httpx.AsyncClient]" = weakref.WeakKeyDictionary()
+
+# Lower numbers are served first when LLM calls queue for a concurrency slot
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 10
+
+
+def _get_sync_session(pool_size: int) -> requests.Session:
+    """Process-wide keep-alive session for synchronous OpenRouter calls."""
+    global _sync_session
+    with _sync_session_lock:
+        if _sync_session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _sync_session = session
+        return _sync_session
+
+
+def _get_async_client(max_concurrency: int) -> httpx.AsyncClient:
+    """Pooled keep-alive client for the running event loop.
+
+    httpx clients are bound to the loop they were first used on, so one is
+    kept per loop (Streamlit starts a fresh loop on every rerun).
+    """
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        limits = httpx.Limits(max_connections=max_concurrency, max_keepalive_connections=max_concurrency)
+        client = httpx.AsyncClient(limits=limits)
+        _async_clients[loop] = client
+    return client
+
+
+async def close_async_clients() -> None:
+    """Close the pooled async client of the running event loop, if any."""
+    client = _async_clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.aclose()
+
+
+class TokenBucket:
+    """Thread-safe token bucket allowing ``rate`` requests per second in bursts of up to ``capacity``.
+
+    Each acquisition reserves a token immediately (the balance may go
+    negative), so waiters are admitted in arrival order. A ``rate`` of 0
+    disables the limit.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = max(1.0, capacity)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """Take a token and return how many seconds to wait before using it."""
+        if self.rate <= 0:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            return max(0.0, -self._tokens / self.rate)
+
+    def acquire(self) -> float:
+        wait = self.reserve()
+        if wait:
+            time.sleep(wait)
+        return wait
+
+    async def aacquire(self) -> float:
+        wait = self.reserve()
+        if wait:
+            await asyncio.sleep(wait)
+        return wait
+
+
+class PrioritySlots:
+    """Async concurrency limiter that hands free slots to the lowest ``priority`` waiter first."""
+
+    def __init__(self, slots: int):
+        self._free = slots
+        self._waiters: List[Tuple[int, int, asyncio.Future]] = []
+        self._sequence = 0
+
+    @property
+    def waiting(self) -> int:
+        return sum(1 for _, _, future in self._waiters if not future.done())
+
+    async def acquire(self, priority: int = PRIORITY_INTERACTIVE) -> None:
+        if self._free > 0 and not self.waiting:
+            self._free -= 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        self._sequence += 1
+        heapq.heappush(self._waiters, (priority, self._sequence, future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            # A slot handed over just as the waiter was cancelled goes to the next one
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+
+    def release(self) -> None:
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                future.set_result(None)
+                return
+        self._free += 1
+
+    @asynccontextmanager
+    async def slot(self, priority: int = PRIORITY_INTERACTIVE):
+        await self.acquire(priority)
+        try:
+            yield
+        finally:
+            self.release()
+
+
+class LLMScheduler:
+    """Admission control shared by every ``OpenRouterLLM`` call of the process.
+
+    - identical prompts already in flight are coalesced into one upstream request;
+    - a ``TokenBucket`` caps the request rate at ``rate_per_minute``;
+    - concurrency slots go to interactive Q&A (``PRIORITY_INTERACTIVE``) ahead
+      of summary sections (``PRIORITY_BACKGROUND``); calls from threads share
+      their own ``max_concurrency`` slots, first come first served;
+    - 429 and 5xx responses are retried up to ``max_retries`` times with full-jitter
+      exponential backoff, waiting at least as long as the ``Retry-After`` header asks.
+    """
+
+    RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+    def __init__(
+        self,
+        max_concurrency: int = 8,
+        rate_per_minute: float = 0.0,
+        burst: int = 5,
+        max_retries: int = 3,
+        backoff_base: float = 0.5,
+        backoff_max: float = 30.0,
+    ):
+        self.max_concurrency = max_concurrency
+        self.bucket = TokenBucket(rate_per_minute / 60.0, burst)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._slots: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, PrioritySlots]" = weakref.WeakKeyDictionary()
+        self._inflight: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[Any, asyncio.Future]]" = weakref.WeakKeyDictionary()
+        self._inflight_sync: Dict[Any, Future] = {}
+        self._sync_slots = threading.BoundedSemaphore(max_concurrency)
+        self._sync_waiting = 0
+        self._lock = threading.Lock()
+        self.requests = self.coalesced = self.retries = 0
+        self.throttled_seconds = 0.0
+        metrics.gauge_callback("queue_depth", lambda: self.waiting, queue="llm")
+
+    @property
+    def waiting(self) -> int:
+        """LLM calls waiting for a concurrency slot, over all event loops and threads."""
+        return self._sync_waiting + sum(slots.waiting for slots in list(self._slots.values()))
+
+    @classmethod
+    def from_env(cls, max_concurrency: int = 8) -> "LLMScheduler":
+        return cls(
+            max_concurrency=max_concurrency,
+            rate_per_minute=float(os.getenv("OPENROUTER_RATE_LIMIT", "0")),
+            burst=int(os.getenv("OPENROUTER_RATE_BURST", "5")),
+            max_retries=int(os.getenv("OPENROUTER_MAX_RETRIES", "3")),
+        )
+
+    def slots(self) -> PrioritySlots:
+        """Concurrency slots of the running event loop."""
+        loop = asyncio.get_running_loop()
+        slots = self._slots.get(loop)
+        if slots is None:
+            slots = self._slots[loop] = PrioritySlots(self.max_concurrency)
+        return slots
+
+    @contextmanager
+    def sync_slot(self):
+        """Concurrency slot for calls made from threads (``_call``/``_stream``)."""
+        with self._lock:
+            self._sync_waiting += 1
+        try:
+            self._sync_slots.acquire()
+        finally:
+            with self._lock:
+                self._sync_waiting -= 1
+        try:
+            yield
+        finally:
+            self._sync_slots.release()
+
+    async def coalesce(self, key: Any, factory: Callable[[], Awaitable[Any]]) -> Any:
+        """Await ``factory()``, sharing one running call among concurrent callers with the same key.
+
+        The call runs as its own task, so one caller being cancelled does not
+        cancel it for the others.
+        """
+        inflight = self._inflight.setdefault(asyncio.get_running_loop(), {})
+        task = inflight.get(key)
+        if task is not None:
+            self.coalesced += 1
+            metrics.inc("llm_coalesced_total")
+        else:
+            task = asyncio.ensure_future(factory())
+            inflight[key] = task
+            task.add_done_callback(lambda _: inflight.pop(key, None))
+        return await asyncio.shield(task)
+
+    def coalesce_sync(self, key: Any, fn: Callable[[], Any]) -> Any:
+        """Thread-based version of ``coalesce``: later callers wait for the first caller's result."""
+        with self._lock:
+            future = self._inflight_sync.get(key)
+            owner = future is None
+            if owner:
+                future = self._inflight_sync[key] = Future()
+            else:
+                self.coalesced += 1
+                metrics.inc("llm_coalesced_total")
+        if not owner:
+            return future.result()
+        try:
+            result = fn()
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._inflight_sync.pop(key, None)
+
+    def admitted(self, waited: float) -> None:
+        self.requests += 1
+        self.throttled_seconds += waited
+        if waited:
+            metrics.inc("llm_throttled_seconds_total", waited)
+
+    def should_retry(self, status: int, attempt: int) -> bool:
+        return status in self.RETRY_STATUSES and attempt < self.max_retries
+
+    def retry_delay(self, attempt: int, retry_after: Optional[str] = None) -> float:
+        """Full-jitter exponential backoff, but no shorter than ``Retry-After`` (seconds or HTTP date)."""
+        self.retries += 1
+        metrics.inc("llm_retries_total")
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+        if retry_after:
+            try:
+                wait = float(retry_after)
+            except ValueError:
+                try:
+                    wait = parsedate_to_datetime(retry_after).timestamp() - time.time()
+                except (TypeError, ValueError):
+                    wait = 0.0
+            delay = max(delay, min(wait, self.backoff_max))
+        return delay
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "requests": self.requests,
+            "coalesced": self.coalesced,
+            "retries": self.retries,
+            "throttled_seconds": self.throttled_seconds,
+        }
+
+
+_llm_scheduler: Optional[LLMScheduler] = None
+
+
+def get_llm_scheduler(max_concurrency: int = 8) -> LLMScheduler:
+    """Process-wide scheduler configured from the environment on first use."""
+    global _llm_scheduler
+    with _sync_session_lock:
+        if _llm_scheduler is None:
+            _llm_scheduler = LLMScheduler.from_env(max_concurrency)
+        return _llm_scheduler
+
+
+def is_llm_error(text: str) -> bool:
+    # OpenRouterLLM reports failures as "Error: ..." strings rather than raising
+    return text.startswith("Error:")
+
+
+class LLMStreamError(Exception):
+    """Raised by a streamed completion that fails after part of the answer was sent.
+
+    ``partial`` is the text received so far and ``error`` the "Error: ..."
+    message that a failure before the first token would have returned.
+    """
+
+    def __init__(self, error: str, partial: str):
+        super().__init__(error)
+        self.error = error
+        self.partial = partial
+
+
+class ResponseCache:
+    """Two-tier cache for LLM responses.
+
+    The exact tier maps (model, prompt hash) to a completion. The semantic tier
+    stores question embeddings per namespace (one document index) and returns
+    the stored answer for a new question whose cosine similarity to an earlier
+    one is at least ``semantic_threshold``. Both tiers expire entries after
+    ``ttl`` seconds and evict least recently used entries when full.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 2048,
+        ttl: float = 3600.0,
+        semantic_threshold: float = 0.95,
+        max_namespaces: int = 256,
+        max_per_namespace: int = 256,
+    ):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.semantic_threshold = semantic_threshold
+        self.max_namespaces = max_namespaces
+        self.max_per_namespace = max_per_namespace
+        self._exact: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+        # namespace -> (unit question vectors, values, expiry times)
+        self._semantic: "OrderedDict[str, Tuple[np.ndarray, List[Any], List[float]]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.exact_hits = self.exact_misses = 0
+        self.semantic_hits = self.semantic_misses = 0
+
+    @staticmethod
+    def exact_key(model: str, prompt: str) -> str:
+        return hashlib.sha256(f"{model}\0{prompt}".encode("utf-8")).hexdigest()
+
+    def get(self, model: str, prompt: str) -> Optional[Any]:
+        key = self.exact_key(model, prompt)
+        with self._lock:
+            entry = self._exact.get(key)
+            if entry is None or entry[0] < time.time():
+                if entry is not None:
+                    del self._exact[key]
+                self.exact_misses += 1
+                metrics.inc("cache_requests_total", cache="response", result="miss")
+                return None
+            self._exact.move_to_end(key)
+            self.exact_hits += 1
+            metrics.inc("cache_requests_total", cache="response", result="hit")
+            return entry[1]
+
+    def put(self, model: str, prompt: str, value: Any) -> None:
+        key = self.exact_key(model, prompt)
+        with self._lock:
+            self._exact[key] = (time.time() + self.ttl, value)
+            self._exact.move_to_end(key)
+            while len(self._exact) > self.max_entries:
+                self._exact.popitem(last=False)
+
+    @staticmethod
+    def _unit(vector: List[float]) -> np.ndarray:
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def get_similar(self, namespace: str, embedding: List[float]) -> Optional[Any]:
+        """Value stored for the most similar earlier question in ``namespace``, if close enough."""
+        query = self._unit(embedding)
+        with self._lock:
+            entry = self._semantic.get(namespace)
+            if entry is not None:
+                self._semantic.move_to_end(namespace)
+                vectors, values, expires = entry
+                similarities = vectors @ query
+                similarities[np.asarray(expires) < time.time()] = -1.0
+                best = int(np.argmax(similarities))
+                if similarities[best] >= self.semantic_threshold:
+                    self.semantic_hits += 1
+                    metrics.inc("cache_requests_total", cache="semantic", result="hit")
+                    return values[best]
+            self.semantic_misses += 1
+            metrics.inc("cache_requests_total", cache="semantic", result="miss")
+            return None
+
+    def put_similar(self, namespace: str, embedding: List[float], value: Any) -> None:
+        vector = self._unit(embedding)[None, :]
+        now = time.time()
+        with self._lock:
+            entry = self._semantic.get(namespace)
+            if entry is None:
+                vectors, values, expires = vector, [value], [now + self.ttl]
+            else:
+                vectors, values, expires = entry
+                keep = [i for i, expiry in enumerate(expires) if expiry >= now][-(self.max_per_namespace - 1):]
+                vectors = np.vstack([vectors[keep], vector])
+                values = [values[i] for i in keep] + [value]
+                expires = [expires[i] for i in keep] + [now + self.ttl]
+            self._semantic[namespace] = (vectors, values, expires)
+            self._semantic.move_to_end(namespace)
+            while len(self._semantic) > self.max_namespaces:
+                self._semantic.popitem(last=False)
+
+    def stats(self) -> Dict[str, Any]:
+        exact = self.exact_hits + self.exact_misses
+        semantic = self.semantic_hits + self.semantic_misses
+        return {
+            "exact_hits": self.exact_hits,
+            "exact_misses": self.exact_misses,
+            "exact_hit_rate": self.exact_hits / exact if exact else 0.0,
+            "semantic_hits": self.semantic_hits,
+            "semantic_misses": self.semantic_misses,
+            "semantic_hit_rate": self.semantic_hits / semantic if semantic else 0.0,
+            "exact_entries": len(self._exact),
+            "semantic_namespaces": len(self._semantic),
+        }
+
+
 class OpenRouterLLM(LLM):
     """Custom LLM wrapper for OpenRouter API"""
 
     api_key: str = Field(...)
     model: str = Field(default="meta-llama/llama-3.3-8b-instruct:free")
-    base_url: str = Field(default="https://openrouter.ai/api/v1/chat/completions")
+    base_url: str = Field(default_factory=lambda: os.getenv("OPENROUTER_BASE_URL", "https://openrouter.ai/api/v1/chat/completions"))
+    timeout: float = Field(default=60.0)
+    max_concurrency: int = Field(default_factory=lambda: int(os.getenv("OPENROUTER_MAX_CONCURRENCY", "8")))
+    response_cache: Optional[ResponseCache] = Field(default=None)
+    # Defaults to the process-wide scheduler, so every instance shares one rate limit
+    scheduler: Optional[LLMScheduler] = Field(default=None)
 
     @property
     def _llm_type(self) -> str:
         return "openrouter"
 
-    def _call(
-        self,
-        prompt: str,
-        stop: Optional[List[str]] = None,
-        run_manager: Optional[CallbackManagerForLLMRun] = None,
-        **kwargs: Any,
-    ) -> str:
-        """Call the OpenRouter API"""
-        headers = {
+    def _get_scheduler(self) -> LLMScheduler:
+        return self.scheduler or get_llm_scheduler(self.max_concurrency)
+
+    def _headers(self) -> Dict[str, str]:
+        return {
             "Content-Type": "application/json",
             "Authorization": f"Bearer {self.api_key}",
             "HTTP-Referer": "https://github.com/abdul183/PDF-SUMMARIZATION---QA", 
             "X-Title": "PDF Q&A Tool" 
         }
-        
+
+    def _payload(self, prompt: str, stop: Optional[List[str]] = None, stream: bool = False) -> Dict[str, Any]:
         payload = {
             "model": self.model,
             "messages": [
                 {"role": "user", "content": prompt}
             ]
         }
-        
-        try:
-            response = requests.post(
+        if stop:
+            payload["stop"] = stop
+        if stream:
+            payload["stream"] = True
+        return payload
+
+    def _cache_prompt(self, prompt: str, stop: Optional[List[str]]) -> str:
+        return f"{prompt}\0{stop}" if stop else prompt
+
+    def _cached(self, prompt: str, stop: Optional[List[str]]) -> Optional[str]:
+        if self.response_cache is None:
+            return None
+        return self.response_cache.get(self.model, self._cache_prompt(prompt, stop))
+
+    def _remember(self, prompt: str, stop: Optional[List[str]], content: str) -> str:
+        # Error strings are returned to the caller but never cached
+        if self.response_cache is not None and not is_llm_error(content):
+            self.response_cache.put(self.model, self._cache_prompt(prompt, stop), content)
+        return content
+
+    def _send(self, payload: Dict[str, Any], stream: bool = False) -> requests.Response:
+        """POST through the rate limit, retrying 429/5xx responses as the scheduler allows."""
+        session = _get_sync_session(self.max_concurrency)
+        scheduler = self._get_scheduler()
+        attempt = 0
+        while True:
+            scheduler.admitted(scheduler.bucket.acquire())
+            response = session.post(
                 self.base_url,
-                headers=headers,
+                headers=self._headers(),
                 json=payload,
-                timeout=60
+                timeout=self.timeout,
+                stream=stream,
             )
+            if not scheduler.should_retry(response.status_code, attempt):
+                return response
+            delay = scheduler.retry_delay(attempt, response.headers.get("Retry-After"))
+            logger.warning(f"OpenRouter returned {response.status_code}; retrying in {delay:.2f}s")
+            response.close()
+            time.sleep(delay)
+            attempt += 1
+
+    async def _asend(self, payload: Dict[str, Any], stream: bool = False) -> httpx.Response:
+        """Async version of ``_send``; the caller holds a concurrency slot."""
+        client = _get_async_client(self.max_concurrency)
+        scheduler = self._get_scheduler()
+        attempt = 0
+        while True:
+            scheduler.admitted(await scheduler.bucket.aacquire())
+            request = client.build_request("POST", self.base_url, headers=self._headers(), json=payload, timeout=self.timeout)
+            response = await client.send(request, stream=stream)
+            if not scheduler.should_retry(response.status_code, attempt):
+                return response
+            delay = scheduler.retry_delay(attempt, response.headers.get("Retry-After"))
+            logger.warning(f"OpenRouter returned {response.status_code}; retrying in {delay:.2f}s")
+            await response.aclose()
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    def _coalesce_key(self, prompt: str, stop: Optional[List[str]]) -> Tuple[str, str, str]:
+        return (self.base_url, self.model, self._cache_prompt(prompt, stop))
+
+    def _call(
+        self,
+        prompt: str,
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> str:
+        """Call the OpenRouter API"""
+        cached = self._cached(prompt, stop)
+        if cached is not None:
+            return cached
+        return self._get_scheduler().coalesce_sync(self._coalesce_key(prompt, stop), lambda: self._request(prompt, stop))
+
+    @staticmethod
+    def _record(mode: str, started: float, answer: str, usage: Optional[dict] = None) -> str:
+        """Record latency, outcome and token usage of one request; returns ``answer`` unchanged."""
+        metrics.observe("llm_request_seconds", time.perf_counter() - started, mode=mode)
+        metrics.inc("llm_requests_total", mode=mode, status="error" if is_llm_error(answer) else "ok")
+        for kind in ("prompt", "completion"):
+            if usage and usage.get(f"{kind}_tokens"):
+                metrics.inc("llm_tokens_total", usage[f"{kind}_tokens"], kind=kind)
+        return answer
+
+    def _request(self, prompt: str, stop: Optional[List[str]]) -> str:
+        started = time.perf_counter()
+        usage: Dict[str, Any] = {}
+        return self._record("call", started, self._fetch(prompt, stop, usage), usage)
+
+    def _fetch(self, prompt: str, stop: Optional[List[str]], usage: Dict[str, Any]) -> str:
+        try:
+            with self._get_scheduler().sync_slot():
+                response = self._send(self._payload(prompt, stop))
             response.raise_for_status()
             
             result = response.json()
-            return result["choices"][0]["message"]["content"]
+            usage.update(result.get("usage") or {})
+            return self._remember(prompt, stop, result["choices"][0]["message"]["content"])
             
         except requests.exceptions.JSONDecodeError:
             logger.error("Failed to decode JSON from API response.")
@@ -79,52 +1068,3467 @@ class OpenRouterLLM(LLM):
             logger.error(f"Invalid API response format: {str(e)}")
             return "Error: The AI service returned an invalid response format after successful request."
 
-class PDFProcessor:
-    """Handles PDF processing, text extraction, and vector store creation."""
+    async def _acall(
+        self,
+        prompt: str,
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> str:
+        """Call the OpenRouter API without blocking the event loop.
 
-    def __init__(self, embeddings_model_name="sentence-transformers/all-MiniLM-L6-v2"):
-        self.embeddings = HuggingFaceEmbeddings(model_name=embeddings_model_name, model_kwargs={'device': 'cpu'})
-        self.text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=1000,
-            chunk_overlap=100,
-            length_function=len,
+        Pass ``priority=PRIORITY_BACKGROUND`` (e.g. ``llm.ainvoke(prompt, priority=...)``)
+        for work that should yield to interactive questions.
+        """
+        cached = self._cached(prompt, stop)
+        if cached is not None:
+            return cached
+        priority = kwargs.get("priority", PRIORITY_INTERACTIVE)
+        return await self._get_scheduler().coalesce(
+            self._coalesce_key(prompt, stop), lambda: self._arequest(prompt, stop, priority)
         )
 
-    def extract_text_from_pdf(self, pdf_file_bytes: bytes) -> str:
-        """Extract text from PDF bytes"""
+    async def _arequest(self, prompt: str, stop: Optional[List[str]], priority: int) -> str:
+        started = time.perf_counter()
+        usage: Dict[str, Any] = {}
+        return self._record("call", started, await self._afetch(prompt, stop, priority, usage), usage)
+
+    async def _afetch(self, prompt: str, stop: Optional[List[str]], priority: int, usage: Dict[str, Any]) -> str:
         try:
-            doc = fitz.open(stream=pdf_file_bytes, filetype="pdf")
-            text = "".join(page.get_text() for page in doc)
-            doc.close()
-            return text
-        except Exception as e:
-            logger.error(f"PDF extraction error: {str(e)}")
-            return ""
+            async with self._get_scheduler().slots().slot(priority):
+                response = await self._asend(self._payload(prompt, stop))
+            response.raise_for_status()
 
-    def split_text(self, text: str) -> List[str]:
-        """Split text into chunks"""
-        return self.text_splitter.split_text(text)
+            result = response.json()
+            usage.update(result.get("usage") or {})
+            return self._remember(prompt, stop, result["choices"][0]["message"]["content"])
 
-    def split_text_with_metadata(self, text: str, metadata: dict) -> List[Document]:
-        """Split text into chunks and attach metadata."""
-        # Create documents and then split them
-        docs = self.text_splitter.create_documents([text], metadatas=[metadata])
-        return self.text_splitter.split_documents(docs)
+        except json.JSONDecodeError:
+            logger.error("Failed to decode JSON from API response.")
+            logger.error(f"Response status code: {response.status_code}")
+            logger.error(f"Response text: {response.text}")
+            return f"Error: The AI service returned an invalid (non-JSON) response. Status: {response.status_code}. Body: {response.text[:200]}"
+        except httpx.TimeoutException as e:
+            logger.error(f"API request timed out: {str(e)}")
+            return "Error: The request to the AI service timed out. Please try again."
+        except httpx.ConnectError as e:
+            logger.error(f"API connection error: {str(e)}")
+            return "Error: Could not connect to the AI service. Please check your internet connection."
+        except httpx.HTTPStatusError as e:
+            logger.error(f"API request failed: {str(e)}")
+            return f"Error: API request failed with status {e.response.status_code}: {e.response.text}"
+        except httpx.HTTPError as e:
+            logger.error(f"API request failed: {str(e)}")
+            return f"Error: An API request failed: {str(e)}"
+        except (KeyError, IndexError) as e:
+            logger.error(f"Invalid API response format: {str(e)}")
+            return "Error: The AI service returned an invalid response format after successful request."
 
-    def create_vector_store_with_metadata(self, documents: List[Document]) -> Optional[FAISS]:
-        """Create FAISS vector store from documents with metadata."""
-        try:
-            vectorstore = FAISS.from_documents(documents, self.embeddings)
-            return vectorstore
-        except Exception as e:
-            logger.error(f"Vector store creation error: {str(e)}")
+    @staticmethod
+    def _parse_sse_line(line: str) -> Optional[str]:
+        """Text delta carried by one server-sent event line ("" for keep-alives and non-content events).
+
+        Returns None at the end-of-stream marker; raises ValueError for an error event.
+        """
+        if not line.startswith("data:"):
+            return ""  # blank separators and ": OPENROUTER PROCESSING" comments
+        data = line[len("data:"):].strip()
+        if data == "[DONE]":
             return None
+        event = json.loads(data)
+        if "error" in event:
+            raise ValueError(event["error"].get("message", str(event["error"])))
+        choices = event.get("choices") or [{}]
+        return choices[0].get("delta", {}).get("content") or ""
 
-    def create_vector_store(self, chunks: List[str]) -> Optional[FAISS]:
-        """Create FAISS vector store from text chunks"""
+    def _stream(
+        self,
+        prompt: str,
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> Iterator[GenerationChunk]:
+        """Stream the completion over server-sent events.
+
+        A failure before any text arrives is yielded as a single "Error: ..."
+        chunk; one after that raises ``LLMStreamError``, so a cut-off answer
+        is never mistaken for a complete one.
+        """
+        cached = self._cached(prompt, stop)
+        if cached is not None:
+            yield GenerationChunk(text=cached)
+            return
+
+        started = time.perf_counter()
+        parts: List[str] = []
+        error = None
         try:
-            vectorstore = FAISS.from_texts(chunks, self.embeddings)
-            return vectorstore
-        except Exception as e:
-            logger.error(f"Vector store creation error: {str(e)}")
-            return None
+            with self._get_scheduler().sync_slot(), self._send(self._payload(prompt, stop, stream=True), stream=True) as response:
+                response.raise_for_status()
+                for line in response.iter_lines(decode_unicode=True):
+                    text = self._parse_sse_line(line or "")
+                    if text is None:
+                        break
+                    if text:
+                        if not parts:
+                            metrics.observe("llm_first_token_seconds", time.perf_counter() - started)
+                        parts.append(text)
+                        if run_manager:
+                            run_manager.on_llm_new_token(text)
+                        yield GenerationChunk(text=text)
+        except requests.exceptions.Timeout as e:
+            logger.error(f"API request timed out: {str(e)}")
+            error = "Error: The request to the AI service timed out. Please try again."
+        except requests.exceptions.ConnectionError as e:
+            logger.error(f"API connection error: {str(e)}")
+            error = "Error: Could not connect to the AI service. Please check your internet connection."
+        except requests.exceptions.RequestException as e:
+            logger.error(f"API request failed: {str(e)}")
+            if e.response is not None:
+                error = f"Error: API request failed with status {e.response.status_code}: {e.response.text}"
+            else:
+                error = f"Error: An API request failed: {str(e)}"
+        except (ValueError, KeyError, IndexError, AttributeError) as e:
+            logger.error(f"Invalid API stream event: {str(e)}")
+            error = f"Error: The AI service returned an invalid streamed response: {str(e)}"
+
+        self._record("stream", started, error or "".join(parts))
+        if error is not None and parts:
+            raise LLMStreamError(error, "".join(parts))
+        if error is not None:
+            yield GenerationChunk(text=error)
+        elif parts:
+            self._remember(prompt, stop, "".join(parts))
+
+    async def _astream(
+        self,
+        prompt: str,
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[GenerationChunk]:
+        """Async version of ``_stream``; the concurrency slot is held until the stream ends."""
+        cached = self._cached(prompt, stop)
+        if cached is not None:
+            yield GenerationChunk(text=cached)
+            return
+
+        priority = kwargs.get("priority", PRIORITY_INTERACTIVE)
+        started = time.perf_counter()
+        parts: List[str] = []
+        error = None
+        try:
+            async with self._get_scheduler().slots().slot(priority):
+                response = await self._asend(self._payload(prompt, stop, stream=True), stream=True)
+                try:
+                    if response.is_error:
+                        await response.aread()
+                    response.raise_for_status()
+                    async for line in response.aiter_lines():
+                        text = self._parse_sse_line(line)
+                        if text is None:
+                            break
+                        if text:
+                            if not parts:
+                                metrics.observe("llm_first_token_seconds", time.perf_counter() - started)
+                            parts.append(text)
+                            if run_manager:
+                                await run_manager.on_llm_new_token(text)
+                            yield GenerationChunk(text=text)
+                finally:
+                    await response.aclose()
+        except httpx.TimeoutException as e:
+            logger.error(f"API request timed out: {str(e)}")
+            error = "Error: The request to the AI service timed out. Please try again."
+        except httpx.ConnectError as e:
+            logger.error(f"API connection error: {str(e)}")
+            error = "Error: Could not connect to the AI service. Please check your internet connection."
+        except httpx.HTTPStatusError as e:
+            logger.error(f"API request failed: {str(e)}")
+            error = f"Error: API request failed with status {e.response.status_code}: {e.response.text}"
+        except httpx.HTTPError as e:
+            logger.error(f"API request failed: {str(e)}")
+            error = f"Error: An API request failed: {str(e)}"
+        except (ValueError, KeyError, IndexError, AttributeError) as e:
+            logger.error(f"Invalid API stream event: {str(e)}")
+            error = f"Error: The AI service returned an invalid streamed response: {str(e)}"
+
+        self._record("stream", started, error or "".join(parts))
+        if error is not None and parts:
+            raise LLMStreamError(error, "".join(parts))
+        if error is not None:
+            yield GenerationChunk(text=error)
+        elif parts:
+            self._remember(prompt, stop, "".join(parts))
+
+
+class EmbeddingCache:
+    """On-disk, memory-mapped LRU cache of embedding vectors keyed by hash of (model name, text).
+
+    Vectors live in a fixed-capacity float32 memmap; a small SQLite table maps
+    keys to slots and tracks last use so the oldest entries are evicted first.
+    Each entry also stores a CRC32 of its key and vector: another process may
+    evict and overwrite a slot between our lookup and our read, and such a
+    vector is then treated as a miss rather than returned for the wrong key.
+    """
+
+    _PARAM_BATCH = 500
+
+    def __init__(self, cache_dir: str = ".embedding_cache", max_entries: int = 200_000):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._vectors: Optional[np.memmap] = None
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(os.path.join(cache_dir, "index.sqlite"), timeout=30, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        columns = [row[1] for row in self._db.execute("PRAGMA table_info(entries)")]
+        if columns and "checksum" not in columns:
+            # Entries written before checksums were kept cannot be verified; start over
+            self._db.execute("DROP TABLE entries")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "key TEXT PRIMARY KEY, slot INTEGER UNIQUE NOT NULL, last_used REAL NOT NULL, "
+            "checksum INTEGER NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS entries_last_used ON entries(last_used)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self._db.commit()
+
+    @staticmethod
+    def make_key(model_name: str, text: str) -> str:
+        """Content address for a chunk embedded with a given model."""
+        return hashlib.sha256(f"{model_name}\0{text}".encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def _checksum(key: str, vector: np.ndarray) -> int:
+        return zlib.crc32(vector.tobytes(), zlib.crc32(key.encode("utf-8")))
+
+    def _get_meta(self, name: str) -> Optional[str]:
+        row = self._db.execute("SELECT value FROM meta WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else None
+
+    def _open_vectors(self, dim: Optional[int] = None) -> Optional[np.memmap]:
+        """Open (creating on first write) the memory-mapped vector file."""
+        if self._vectors is not None:
+            return self._vectors
+
+        stored_dim = self._get_meta("dim")
+        if stored_dim is None:
+            if dim is None:
+                return None
+            with self._db:
+                self._db.execute("INSERT OR IGNORE INTO meta VALUES ('dim', ?)", (str(dim),))
+                self._db.execute("INSERT OR IGNORE INTO meta VALUES ('capacity', ?)", (str(self.max_entries),))
+            stored_dim = self._get_meta("dim")
+
+        dim = int(stored_dim)
+        # The capacity is fixed when the file is created so the memmap shape stays stable across runs
+        capacity = int(self._get_meta("capacity") or self.max_entries)
+        self.max_entries = capacity
+
+        path = os.path.join(self.cache_dir, "vectors.f32")
+        size = capacity * dim * np.dtype(np.float32).itemsize
+        with open(path, "ab") as f:
+            if f.tell() < size:
+                f.truncate(size)
+        self._vectors = np.memmap(path, dtype=np.float32, mode="r+", shape=(capacity, dim))
+        return self._vectors
+
+    def _batches(self, keys: List[str]) -> Iterable[List[str]]:
+        for i in range(0, len(keys), self._PARAM_BATCH):
+            yield keys[i:i + self._PARAM_BATCH]
+
+    def get_many(self, keys: List[str]) -> Dict[str, List[float]]:
+        """Return cached vectors for the given keys, refreshing their LRU position."""
+        if not keys:
+            return {}
+
+        with self._lock:
+            vectors = self._open_vectors()
+            if vectors is None:
+                self.misses += len(keys)
+                metrics.inc("cache_requests_total", len(keys), cache="embedding", result="miss")
+                return {}
+
+            found: Dict[str, List[float]] = {}
+            for batch in self._batches(keys):
+                placeholders = ",".join("?" * len(batch))
+                rows = self._db.execute(
+                    f"SELECT key, slot, checksum FROM entries WHERE key IN ({placeholders})", batch
+                ).fetchall()
+                for key, slot, checksum in rows:
+                    vector = np.array(vectors[slot])
+                    # A mismatch means the slot was reused for another key after the lookup
+                    if self._checksum(key, vector) == checksum:
+                        found[key] = vector.tolist()
+
+            if found:
+                now = time.time()
+                with self._db:
+                    self._db.executemany(
+                        "UPDATE entries SET last_used = ? WHERE key = ?",
+                        [(now, key) for key in found],
+                    )
+
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+            metrics.inc("cache_requests_total", len(found), cache="embedding", result="hit")
+            metrics.inc("cache_requests_total", len(keys) - len(found), cache="embedding", result="miss")
+            return found
+
+    def put_many(self, items: Dict[str, List[float]]) -> None:
+        """Store vectors, evicting the least recently used entries when the cache is full."""
+        if not items:
+            return
+
+        with self._lock:
+            dim = len(next(iter(items.values())))
+            vectors = self._open_vectors(dim)
+            if vectors.shape[1] != dim:
+                logger.warning(f"Embedding cache dimension mismatch ({vectors.shape[1]} != {dim}); not caching")
+                return
+
+            now = time.time()
+            with self._db:
+                # BEGIN IMMEDIATE serialises slot allocation between processes sharing the cache
+                self._db.execute("BEGIN IMMEDIATE")
+                keys = list(items)
+                existing = set()
+                for batch in self._batches(keys):
+                    placeholders = ",".join("?" * len(batch))
+                    existing.update(
+                        row[0] for row in self._db.execute(
+                            f"SELECT key FROM entries WHERE key IN ({placeholders})", batch
+                        )
+                    )
+                new_keys = [key for key in keys if key not in existing][-self.max_entries:]
+                if not new_keys:
+                    return
+
+                count = self._db.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+                fresh = min(len(new_keys), self.max_entries - count)
+                # Slots stay dense (0..count-1) because evicted slots are reused immediately
+                slots = list(range(count, count + fresh))
+
+                evict = len(new_keys) - fresh
+                if evict:
+                    victims = self._db.execute(
+                        "SELECT key, slot FROM entries ORDER BY last_used LIMIT ?", (evict,)
+                    ).fetchall()
+                    self._db.executemany("DELETE FROM entries WHERE key = ?", [(key,) for key, _ in victims])
+                    slots.extend(slot for _, slot in victims)
+
+                rows = []
+                for key, slot in zip(new_keys, slots):
+                    vector = np.asarray(items[key], dtype=np.float32)
+                    vectors[slot] = vector
+                    rows.append((key, slot, now, self._checksum(key, vector)))
+                vectors.flush()
+                self._db.executemany(
+                    "INSERT INTO entries (key, slot, last_used, checksum) VALUES (?, ?, ?, ?)", rows
+                )
+
+    def __len__(self) -> int:
+        return self._db.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    def stats(self) -> Dict[str, Any]:
+        """Hit/miss counters for this process plus current cache occupancy."""
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": len(self),
+            "capacity": self.max_entries,
+        }
+
+
+EMBEDDING_BACKENDS = ("torch", "onnx")
+
+
+class EmbeddingEngine(Embeddings):
+    """CPU sentence-transformers encoder that batches chunks by token length.
+
+    Texts are tokenized once to measure them, sorted longest first and cut
+    into batches of at most ``batch_tokens`` padded tokens and
+    ``max_batch_size`` texts, so short chunks share large batches and little
+    work goes into padding. ``threads`` sets the intra-op thread count, and
+    ``backend="onnx"`` runs the same model on ONNX Runtime (needs
+    ``optimum[onnxruntime]``; falls back to torch without it). Vectors come
+    back in input order and match ``HuggingFaceEmbeddings`` for the model.
+    """
+
+    def __init__(
+        self,
+        model_name: str = "sentence-transformers/all-MiniLM-L6-v2",
+        backend: str = "torch",
+        threads: Optional[int] = None,
+        batch_tokens: int = 8192,
+        max_batch_size: int = 128,
+    ):
+        if backend not in EMBEDDING_BACKENDS:
+            raise ValueError(f"Unknown embedding backend: {backend}")
+        from sentence_transformers import SentenceTransformer
+        import importlib.util
+        self.model_name = model_name
+        self.threads = threads
+        self.batch_tokens = batch_tokens
+        self.max_batch_size = max_batch_size
+        if threads:
+            import torch
+            torch.set_num_threads(threads)
+
+        model_kwargs: Dict[str, Any] = {}
+        if backend == "onnx":
+            if importlib.util.find_spec("onnxruntime") is None or importlib.util.find_spec("optimum") is None:
+                logger.warning("EMBEDDING_BACKEND=onnx needs optimum[onnxruntime]; using torch")
+                backend = "torch"
+            else:
+                import onnxruntime
+                options = onnxruntime.SessionOptions()
+                if threads:
+                    options.intra_op_num_threads = threads
+                model_kwargs = {"provider": "CPUExecutionProvider", "session_options": options}
+        self.backend = backend
+        self.model = SentenceTransformer(model_name, device="cpu", backend=backend, model_kwargs=model_kwargs or None)
+
+    def token_lengths(self, texts: List[str]) -> List[int]:
+        """Tokens per text including special tokens, capped at the model's maximum sequence length."""
+        encoded = self.model.tokenizer(
+            texts, truncation=True, max_length=self.model.max_seq_length,
+            return_attention_mask=False, return_token_type_ids=False,
+        )
+        return [len(ids) for ids in encoded["input_ids"]]
+
+    def batches(self, lengths: List[int]) -> List[List[int]]:
+        """Positions of the texts in each batch, longest texts first."""
+        batches: List[List[int]] = []
+        current: List[int] = []
+        for position in sorted(range(len(lengths)), key=lambda i: -lengths[i]):
+            # Sorted longest first, so the batch's first text sets its padded length
+            if current and (len(current) == self.max_batch_size or (len(current) + 1) * lengths[current[0]] > self.batch_tokens):
+                batches.append(current)
+                current = []
+            current.append(position)
+        if current:
+            batches.append(current)
+        return batches
+
+    def encode(self, texts: List[str]) -> np.ndarray:
+        """float32 matrix of embeddings, one row per text in input order."""
+        if not texts:
+            return np.empty((0, 0), dtype=np.float32)
+        texts = [text.replace("\n", " ") for text in texts]  # as HuggingFaceEmbeddings does
+        vectors = None
+        for batch in self.batches(self.token_lengths(texts)):
+            encoded = self.model.encode(
+                [texts[i] for i in batch], batch_size=len(batch), convert_to_numpy=True, show_progress_bar=False
+            )
+            if vectors is None:
+                vectors = np.empty((len(texts), encoded.shape[1]), dtype=np.float32)
+            vectors[batch] = encoded
+        return vectors
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.encode(texts).tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.encode([text])[0].tolist()
+
+
+@lru_cache(maxsize=None)
+def get_embeddings(model_name: str = "sentence-transformers/all-MiniLM-L6-v2") -> Embeddings:
+    """Process-wide embedding model, loaded on first call and shared by every PDFProcessor.
+
+    Configured from ``EMBEDDING_BACKEND``, ``EMBEDDING_THREADS``,
+    ``EMBEDDING_BATCH_TOKENS`` and ``EMBEDDING_BATCH_SIZE``, read at load time
+    so ingestion workers can set their own thread count first.
+    """
+    start = time.perf_counter()
+    embeddings = EmbeddingEngine(
+        model_name,
+        backend=os.getenv("EMBEDDING_BACKEND", "torch"),
+        threads=int(os.getenv("EMBEDDING_THREADS", "0")) or None,
+        batch_tokens=int(os.getenv("EMBEDDING_BATCH_TOKENS", "8192")),
+        max_batch_size=int(os.getenv("EMBEDDING_BATCH_SIZE", "128")),
+    )
+    logger.info(
+        f"Loaded embedding model {model_name} ({embeddings.backend}, "
+        f"{embeddings.threads or 'default'} threads) in {time.perf_counter() - start:.2f}s"
+    )
+    return embeddings
+
+
+class LazyEmbeddings(Embeddings):
+    """Stand-in that resolves the shared model from ``get_embeddings`` on first use."""
+
+    def __init__(self, model_name: str):
+        self.model_name = model_name
+
+    @property
+    def model(self) -> Embeddings:
+        return get_embeddings(self.model_name)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        model = self.model
+        with timed("embed_seconds"):
+            vectors = model.embed_documents(texts)
+        metrics.inc("embedded_texts_total", len(texts))
+        return vectors
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.model.embed_query(text)
+
+
+def log_startup_time(stage: str, started: float) -> float:
+    """Log and return seconds since ``started`` (a ``time.perf_counter()`` taken at process start)."""
+    elapsed = time.perf_counter() - started
+    logger.info(f"Startup: {stage} after {elapsed:.2f}s")
+    return elapsed
+
+
+class CachedEmbeddings(Embeddings):
+    """Embeddings wrapper that only sends cache misses to the underlying model."""
+
+    def __init__(self, embeddings: Embeddings, cache: EmbeddingCache, model_name: str):
+        self.embeddings = embeddings
+        self.cache = cache
+        self.model_name = model_name
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys = [EmbeddingCache.make_key(self.model_name, text) for text in texts]
+        cached = self.cache.get_many(keys)
+
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in cached and key not in missing:
+                missing[key] = text
+
+        if missing:
+            vectors = self.embeddings.embed_documents(list(missing.values()))
+            computed = dict(zip(missing.keys(), vectors))
+            self.cache.put_many(computed)
+            cached.update(computed)
+
+        return [cached[key] for key in keys]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embeddings.embed_query(text)
+
+    def embed_queries(self, texts: List[str]) -> List[List[float]]:
+        """Embed a batch of questions in one model call, bypassing the cache like ``embed_query``.
+
+        Questions are user data and rarely repeat verbatim; caching them would
+        persist them and evict document vectors.
+        """
+        return self.embeddings.embed_documents(texts)
+
+
+# FAISS index families, smallest/most exact first
+INDEX_TYPES = ("flat", "hnsw", "ivf_flat", "ivf_pq")
+VECTOR_DTYPES = ("float32", "float16", "int8")
+
+
+@dataclass
+class IndexConfig:
+    """Which FAISS index to build for a set of vectors, and its recall/latency knobs.
+
+    ``index_type="auto"`` keeps exact flat search for small corpora and moves
+    to HNSW, IVF-Flat and finally IVF-PQ as the vector count passes the
+    thresholds. ``ef_search`` (HNSW) and ``nprobe`` (IVF) trade recall for
+    query latency and can be changed on a built index with ``tune_index``.
+    ``vector_dtype`` stores flat, HNSW and IVF-Flat vectors as float16 (half
+    the memory) or int8 (a quarter) with a FAISS scalar quantizer.
+    """
+
+    index_type: str = field(default_factory=lambda: os.getenv("VECTOR_INDEX", "auto"))
+    vector_dtype: str = field(default_factory=lambda: os.getenv("VECTOR_DTYPE", "float32"))
+    hnsw_threshold: int = 20_000
+    ivf_threshold: int = 200_000
+    pq_threshold: int = 1_000_000
+    hnsw_m: int = 32
+    ef_construction: int = 80
+    ef_search: int = field(default_factory=lambda: int(os.getenv("VECTOR_INDEX_EF_SEARCH", "64")))
+    nlist: Optional[int] = None  # inverted lists; defaults to 4 * sqrt(n)
+    nprobe: int = field(default_factory=lambda: int(os.getenv("VECTOR_INDEX_NPROBE", "16")))
+    pq_m: int = 48  # sub-quantizers; lowered to a divisor of the dimension
+    pq_bits: int = 8
+    train_size: int = 50_000  # IVF/PQ training sample size
+
+    def choose(self, n: int) -> str:
+        """Index type to use for ``n`` vectors."""
+        if self.index_type != "auto":
+            if self.index_type not in INDEX_TYPES:
+                raise ValueError(f"Unknown index type: {self.index_type}")
+            return self.index_type
+        if n >= self.pq_threshold:
+            return "ivf_pq"
+        if n >= self.ivf_threshold:
+            return "ivf_flat"
+        if n >= self.hnsw_threshold:
+            return "hnsw"
+        return "flat"
+
+    def scalar_quantizer(self) -> Optional[int]:
+        """FAISS ``ScalarQuantizer`` type for ``vector_dtype``; None for plain float32."""
+        import faiss
+        if self.vector_dtype not in VECTOR_DTYPES:
+            raise ValueError(f"Unknown vector dtype: {self.vector_dtype}")
+        return {
+            "float16": faiss.ScalarQuantizer.QT_fp16,
+            "int8": faiss.ScalarQuantizer.QT_8bit,
+        }.get(self.vector_dtype)
+
+
+def index_type_of(index: Any) -> str:
+    """Which of ``INDEX_TYPES`` a FAISS index is."""
+    import faiss
+    if isinstance(index, faiss.IndexHNSW):
+        return "hnsw"
+    if isinstance(index, faiss.IndexIVFPQ):
+        return "ivf_pq"
+    if isinstance(index, faiss.IndexIVF):
+        return "ivf_flat"
+    return "flat"
+
+
+def vector_dtype_of(index: Any) -> str:
+    """Which of ``VECTOR_DTYPES`` an index stores its vectors as ("float32" for PQ codes too)."""
+    import faiss
+    index = faiss.downcast_index(index)
+    if isinstance(index, faiss.IndexHNSW):
+        index = faiss.downcast_index(index.storage)
+    sq = getattr(index, "sq", None)
+    if sq is None:
+        return "float32"
+    return {faiss.ScalarQuantizer.QT_fp16: "float16", faiss.ScalarQuantizer.QT_8bit: "int8"}.get(sq.qtype, "float32")
+
+
+def tune_index(index: Any, config: IndexConfig) -> Any:
+    """Apply the query-time knobs of ``config`` to a built or loaded index."""
+    import faiss
+    if isinstance(index, faiss.IndexHNSW):
+        index.hnsw.efSearch = config.ef_search
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        ivf.nprobe = min(config.nprobe, ivf.nlist)
+    return index
+
+
+def build_faiss_index(vectors: np.ndarray, config: IndexConfig, index_type: Optional[str] = None) -> Any:
+    """Build, train (on a sample) and fill an L2 FAISS index; row ``i`` gets id ``i``."""
+    import faiss
+    start = time.perf_counter()
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    n, dim = vectors.shape
+    index_type = index_type or config.choose(n)
+    qtype = config.scalar_quantizer()
+    sq = None
+
+    if index_type == "hnsw":
+        if qtype is None:
+            index = faiss.IndexHNSWFlat(dim, config.hnsw_m)
+        else:
+            index = faiss.IndexHNSWSQ(dim, qtype, config.hnsw_m)
+            sq = faiss.downcast_index(index.storage).sq
+        index.hnsw.efConstruction = config.ef_construction
+    elif index_type in ("ivf_flat", "ivf_pq"):
+        # k-means wants ~39 training points per list; shrink nlist for small corpora
+        nlist = max(1, min(config.nlist or int(4 * np.sqrt(n)), n // 39))
+        quantizer = faiss.IndexFlatL2(dim)
+        # PQ codebooks need the same ~39 points per centroid; too few vectors stay IVF-Flat
+        if index_type == "ivf_pq" and n >= 39 * 2 ** config.pq_bits:
+            pq_m = max(m for m in range(1, min(config.pq_m, dim) + 1) if dim % m == 0)
+            index = faiss.IndexIVFPQ(quantizer, dim, nlist, pq_m, config.pq_bits)
+        elif qtype is None:
+            index = faiss.IndexIVFFlat(quantizer, dim, nlist)
+        else:
+            index = faiss.IndexIVFScalarQuantizer(quantizer, dim, nlist, qtype)
+            sq = index.sq
+    elif qtype is None:
+        index = faiss.IndexFlatL2(dim)
+    else:
+        index = faiss.IndexScalarQuantizer(dim, qtype, faiss.METRIC_L2)
+        sq = index.sq
+
+    if sq is not None and sq.qtype == faiss.ScalarQuantizer.QT_8bit:
+        # Widen the trained per-dimension range by 10% so vectors added later are not clipped
+        sq.rangestat = faiss.ScalarQuantizer.RS_minmax
+        sq.rangestat_arg = 0.1
+    if not index.is_trained:
+        sample = vectors
+        if n > config.train_size:
+            sample = vectors[np.random.default_rng(0).choice(n, config.train_size, replace=False)]
+        index.train(sample)
+    index.add(vectors)
+    metrics.observe("index_build_seconds", time.perf_counter() - start, index_type=index_type)
+    return tune_index(index, config)
+
+
+def index_vectors(index: Any) -> np.ndarray:
+    """All vectors of an index in id order (approximate for PQ, which only keeps codes)."""
+    import faiss
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None and ivf.direct_map.type == faiss.DirectMap.NoMap:
+        ivf.make_direct_map()
+    return index.reconstruct_n(0, index.ntotal)
+
+
+def optimize_vectorstore(vectorstore: Optional["FAISS"], config: IndexConfig) -> Optional["FAISS"]:
+    """Rebuild a store's index as the type ``config`` picks for its size, if that differs.
+
+    Stores are filled incrementally through a flat index so they are queryable
+    early; this swaps in the approximate index once the final size is known,
+    stored as ``config.vector_dtype``. Only moves to larger index families,
+    since vectors read back from a PQ index are approximate.
+    """
+    if vectorstore is None:
+        return None
+    current = index_type_of(vectorstore.index)
+    wanted = config.choose(vectorstore.index.ntotal)
+    if INDEX_TYPES.index(wanted) < INDEX_TYPES.index(current):
+        wanted = current
+    if wanted != current or (current != "ivf_pq" and vector_dtype_of(vectorstore.index) != config.vector_dtype):
+        start = time.perf_counter()
+        vectorstore.index = build_faiss_index(index_vectors(vectorstore.index), config, wanted)
+        logger.info(
+            f"Rebuilt {vectorstore.index.ntotal} vectors as {wanted} {config.vector_dtype} index "
+            f"in {time.perf_counter() - start:.2f}s"
+        )
+    return vectorstore
+
+
+# Words, plus identifiers such as part numbers (AB-1234), clause ids (4.2.1) and paths kept whole
+_TOKEN_RE = re.compile(r"\w+(?:[.\-/]\w+)*")
+_STOPWORDS = frozenset(
+    "a an and are as at be by for from has have in is it its of on or that the this to was were will with".split()
+)
+
+
+def tokenize(text: str) -> List[str]:
+    """Lowercased terms for the lexical index; compound identifiers also yield their parts."""
+    tokens = []
+    for match in _TOKEN_RE.finditer(text.lower()):
+        token = match.group()
+        if token in _STOPWORDS:
+            continue
+        tokens.append(token)
+        if not token.isalnum():
+            tokens.extend(part for part in re.split(r"[.\-/]", token) if part and part not in _STOPWORDS)
+    return tokens
+
+
+class LexicalIndex:
+    """BM25 inverted index over chunk texts, keyed by the vector store's docstore ids.
+
+    Postings are typed ``array`` pairs (uint32 chunk position, uint16 term
+    frequency), so a term costs 6 bytes per chunk it occurs in and queries
+    score postings as zero-copy numpy views.
+    """
+
+    FILENAME = "lexical.npz"
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.doc_ids: List[str] = []
+        self._positions: Dict[str, int] = {}
+        self._lengths = array("I")
+        self._postings: Dict[str, Tuple[array, array]] = {}
+        self._norm: Optional[np.ndarray] = None  # per-chunk BM25 length normalization, rebuilt after changes
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.doc_ids)
+
+    def _add_terms(self, doc_id: str, counts: Dict[str, int], length: int) -> None:
+        self._norm = None
+        position = len(self.doc_ids)
+        self.doc_ids.append(doc_id)
+        self._positions[doc_id] = position
+        self._lengths.append(length)
+        for term, tf in counts.items():
+            postings = self._postings.get(term)
+            if postings is None:
+                postings = self._postings[term] = (array("I"), array("H"))
+            postings[0].append(position)
+            postings[1].append(min(tf, 65535))
+
+    def add(self, doc_ids: Iterable[str], texts: Iterable[str]) -> None:
+        with self._lock:
+            for doc_id, text in zip(doc_ids, texts):
+                tokens = tokenize(text)
+                counts: Dict[str, int] = {}
+                for token in tokens:
+                    counts[token] = counts.get(token, 0) + 1
+                self._add_terms(doc_id, counts, len(tokens))
+
+    def extend(self, other: "LexicalIndex", rename: Optional[Dict[str, str]] = None) -> None:
+        """Append another index's chunks, optionally under new ids, without re-tokenizing."""
+        rename = rename or {}
+        offset = len(self.doc_ids)
+        with self._lock, other._lock:
+            self._norm = None
+            self.doc_ids.extend(rename.get(doc_id, doc_id) for doc_id in other.doc_ids)
+            for position, doc_id in enumerate(self.doc_ids[offset:], start=offset):
+                self._positions[doc_id] = position
+            self._lengths.extend(other._lengths)
+            for term, (positions, tfs) in other._postings.items():
+                postings = self._postings.get(term)
+                if postings is None:
+                    postings = self._postings[term] = (array("I"), array("H"))
+                postings[0].extend(array("I", (np.frombuffer(positions, dtype=np.uint32) + offset).tobytes()))
+                postings[1].extend(tfs)
+
+    def remove(self, doc_ids: Iterable[str]) -> None:
+        """Drop chunks and renumber the rest; linear in the number of postings."""
+        with self._lock:
+            removed = [self._positions[doc_id] for doc_id in doc_ids if doc_id in self._positions]
+            if not removed:
+                return
+            self._norm = None
+            keep = np.ones(len(self.doc_ids), dtype=bool)
+            keep[removed] = False
+            new_position = np.cumsum(keep, dtype=np.int64) - 1
+            self.doc_ids = [doc_id for doc_id, kept in zip(self.doc_ids, keep) if kept]
+            self._positions = {doc_id: position for position, doc_id in enumerate(self.doc_ids)}
+            self._lengths = array("I", np.frombuffer(self._lengths, dtype=np.uint32)[keep].tobytes())
+            for term in list(self._postings):
+                positions, tfs = self._postings[term]
+                positions = np.frombuffer(positions, dtype=np.uint32)
+                mask = keep[positions]
+                if not mask.any():
+                    del self._postings[term]
+                    continue
+                self._postings[term] = (
+                    array("I", new_position[positions[mask]].astype(np.uint32).tobytes()),
+                    array("H", np.frombuffer(tfs, dtype=np.uint16)[mask].tobytes()),
+                )
+
+    def search(
+        self,
+        query: str,
+        k: int = 10,
+        doc_ids: Optional[Iterable[str]] = None,
+        min_ratio: float = 0.0,
+    ) -> List[Tuple[str, float]]:
+        """Top-``k`` ``(doc_id, bm25_score)`` scoring at least ``min_ratio`` of the best, optionally only among ``doc_ids``.
+
+        Terms are scored rarest first. Once no chunk that has not matched yet
+        could still reach the top ``k`` (or ``min_ratio`` of the best score),
+        the long postings of common terms are only probed for the chunks
+        already matched instead of being scanned in full.
+        """
+        terms = set(tokenize(query))
+        with self._lock:
+            n = len(self.doc_ids)
+            if not n or not terms:
+                return []
+            if self._norm is None:
+                lengths = np.frombuffer(self._lengths, dtype=np.uint32)
+                self._norm = (self.k1 * (1 - self.b + self.b * lengths / max(lengths.mean(), 1.0))).astype(np.float32)
+            norm = self._norm
+
+            matched = []
+            for term in terms:
+                postings = self._postings.get(term)
+                if postings is not None:
+                    df = len(postings[0])
+                    matched.append((float(np.log1p((n - df + 0.5) / (df + 0.5))), postings))
+            matched.sort(key=lambda item: item[0], reverse=True)
+            # Upper bound on what the not-yet-scored terms can add to any chunk
+            remaining = sum(idf for idf, _ in matched) * (self.k1 + 1)
+
+            scores = np.zeros(n, dtype=np.float32)
+            hits = np.empty(0, dtype=np.uint32)  # chunks with a non-zero score so far
+            candidates: Optional[np.ndarray] = None
+            for idf, (positions, tfs) in matched:
+                if candidates is None and doc_ids is None:
+                    if len(hits):
+                        top = scores[hits]
+                        threshold = max(min_ratio * float(top.max()), float(np.partition(top, -k)[-k]) if len(hits) >= k else 0.0)
+                        if threshold > remaining:
+                            candidates = hits
+                remaining -= idf * (self.k1 + 1)
+                positions = np.frombuffer(positions, dtype=np.uint32)
+                tfs = np.frombuffer(tfs, dtype=np.uint16)
+                if candidates is not None:
+                    # Postings are sorted by position, so matched chunks are found by binary search
+                    found = np.searchsorted(positions, candidates)
+                    present = found < len(positions)
+                    present[present] = positions[found[present]] == candidates[present]
+                    positions, tfs = candidates[present], tfs[found[present]]
+                else:
+                    hits = np.concatenate([hits, positions[scores[positions] == 0]])
+                tfs = tfs.astype(np.float32)
+                # Each chunk appears once per term, so fancy-index accumulation is safe
+                scores[positions] += idf * tfs * (self.k1 + 1) / (tfs + norm[positions])
+
+            if doc_ids is not None:
+                allowed = [self._positions[doc_id] for doc_id in doc_ids if doc_id in self._positions]
+                mask = np.zeros(n, dtype=bool)
+                mask[allowed] = True
+                scores[~mask] = 0
+            if candidates is None or doc_ids is not None:
+                candidates = np.flatnonzero(scores)
+            if not len(candidates):
+                return []
+            candidates = candidates[scores[candidates] >= min_ratio * scores[candidates].max()]
+            if len(candidates) > k:
+                candidates = candidates[np.argpartition(-scores[candidates], k)[:k]]
+            candidates = candidates[np.argsort(-scores[candidates])]
+            return [(self.doc_ids[i], float(scores[i])) for i in candidates]
+
+    def save(self, directory: str) -> None:
+        with self._lock:
+            terms = list(self._postings)
+            sizes = np.array([len(self._postings[term][0]) for term in terms], dtype=np.int64)
+            np.savez_compressed(
+                os.path.join(directory, self.FILENAME),
+                params=np.array([self.k1, self.b]),
+                doc_ids=np.frombuffer("\n".join(self.doc_ids).encode("utf-8"), dtype=np.uint8),
+                lengths=np.frombuffer(self._lengths, dtype=np.uint32),
+                terms=np.frombuffer("\n".join(terms).encode("utf-8"), dtype=np.uint8),
+                offsets=np.concatenate([[0], np.cumsum(sizes)]),
+                positions=np.concatenate([np.frombuffer(self._postings[t][0], dtype=np.uint32) for t in terms] or [np.empty(0, np.uint32)]),
+                tfs=np.concatenate([np.frombuffer(self._postings[t][1], dtype=np.uint16) for t in terms] or [np.empty(0, np.uint16)]),
+            )
+
+    @classmethod
+    def load(cls, directory: str) -> Optional["LexicalIndex"]:
+        """Read an index written by ``save``; None if the directory has none."""
+        try:
+            data = np.load(os.path.join(directory, cls.FILENAME))
+        except OSError:
+            return None
+        k1, b = data["params"]
+        index = cls(k1=float(k1), b=float(b))
+        doc_ids = data["doc_ids"].tobytes().decode("utf-8")
+        index.doc_ids = doc_ids.split("\n") if doc_ids else []
+        index._positions = {doc_id: position for position, doc_id in enumerate(index.doc_ids)}
+        index._lengths = array("I", data["lengths"].tobytes())
+        terms = data["terms"].tobytes().decode("utf-8")
+        offsets, positions, tfs = data["offsets"], data["positions"], data["tfs"]
+        for i, term in enumerate(terms.split("\n") if terms else []):
+            start, stop = offsets[i], offsets[i + 1]
+            index._postings[term] = (array("I", positions[start:stop].tobytes()), array("H", tfs[start:stop].tobytes()))
+        return index
+
+
+def reciprocal_rank_fusion(rankings: Iterable[List[str]], k: int = 60) -> List[Tuple[str, float]]:
+    """Fuse ranked id lists by summing ``1 / (k + rank)``; best first."""
+    scores: Dict[str, float] = {}
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking, start=1):
+            scores[doc_id] = scores.get(doc_id, 0.0) + 1.0 / (k + rank)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
+
+
+@lru_cache(maxsize=None)
+def get_token_encoding(name: str = "cl100k_base") -> Any:
+    """Shared tiktoken encoding; tiktoken is imported on first use."""
+    import tiktoken
+    return tiktoken.get_encoding(name)
+
+
+@lru_cache(maxsize=None)
+def _token_byte_lengths(name: str) -> np.ndarray:
+    """UTF-8 byte length of every token id, for locating token boundaries without decoding."""
+    encoding = get_token_encoding(name)
+    lengths = np.zeros(encoding.n_vocab, dtype=np.int64)
+    for token in range(encoding.n_vocab):
+        try:
+            lengths[token] = len(encoding.decode_single_token_bytes(token))
+        except KeyError:
+            pass
+    return lengths
+
+
+_PARAGRAPH_BREAK = re.compile(r"\n[ \t]*\n\s*")
+
+
+def paragraph_spans(text: str) -> List[Tuple[int, int]]:
+    """``(start, end)`` of each blank-line separated paragraph, surrounding whitespace trimmed."""
+    spans = []
+    start = 0
+    for end, next_start in [(m.start(), m.end()) for m in _PARAGRAPH_BREAK.finditer(text)] + [(len(text), len(text))]:
+        segment = text[start:end]
+        stripped = segment.strip()
+        if stripped:
+            offset = start + len(segment) - len(segment.lstrip())
+            spans.append((offset, offset + len(stripped)))
+        start = next_start
+    return spans
+
+
+class TokenChunker:
+    """Packs whole paragraphs into chunks of up to ``chunk_tokens`` tokens.
+
+    With layout extraction each PyMuPDF text block is a paragraph, so chunks
+    end at block boundaries. Paragraphs longer than a chunk are cut into token
+    windows overlapping by ``overlap_tokens``; between packed chunks, trailing
+    paragraphs that fit in ``overlap_tokens`` are repeated. Paragraphs of
+    ``batch_pages`` pages are tokenized in one ``encode_ordinary_batch`` call,
+    which tiktoken spreads over native threads.
+    """
+
+    def __init__(
+        self,
+        chunk_tokens: int = 256,
+        overlap_tokens: int = 32,
+        encoding_name: str = "cl100k_base",
+        batch_pages: int = 16,
+    ):
+        if overlap_tokens >= chunk_tokens:
+            raise ValueError("overlap_tokens must be smaller than chunk_tokens")
+        self.chunk_tokens = chunk_tokens
+        self.overlap_tokens = overlap_tokens
+        self.encoding_name = encoding_name
+        self.batch_pages = batch_pages
+
+    @property
+    def encoding(self) -> Any:
+        return get_token_encoding(self.encoding_name)
+
+    def _windows(
+        self,
+        text: str,
+        start: int,
+        end: int,
+        tokens: List[int],
+        lead_start: Optional[int] = None,
+        lead_tokens: int = 0,
+    ) -> Iterator[Tuple[int, int, int]]:
+        """Overlapping token windows over one long paragraph; the first also takes the
+        ``lead_tokens`` of short paragraphs from ``lead_start`` that preceded it."""
+        paragraph = text[start:end]
+        raw = np.frombuffer(paragraph.encode("utf-8"), dtype=np.uint8)
+        # Character offset of every token boundary: cumulative token byte lengths mapped
+        # to characters by counting UTF-8 lead bytes
+        byte_offsets = np.concatenate([[0], np.cumsum(_token_byte_lengths(self.encoding_name)[tokens])])
+        if byte_offsets[-1] != len(raw):
+            byte_offsets = np.linspace(0, len(raw), len(tokens) + 1).astype(np.int64)
+        char_of_byte = np.concatenate([np.cumsum((raw & 0xC0) != 0x80) - 1, [len(paragraph)]])
+        offsets = char_of_byte[np.minimum(byte_offsets, len(raw))]
+        i = 0
+        budget = self.chunk_tokens - lead_tokens
+        while True:
+            j = min(i + budget, len(tokens))
+            window_start = lead_start if lead_start is not None and i == 0 else start + int(offsets[i])
+            window_end = start + int(offsets[j])
+            yield window_start, window_end, j - i + (lead_tokens if i == 0 else 0)
+            if j == len(tokens):
+                break
+            i = j - self.overlap_tokens
+            budget = self.chunk_tokens
+
+    def _pack(self, text: str, spans: List[Tuple[int, int]], counts: List[List[int]]) -> Iterator[Tuple[int, int, int]]:
+        """``(start, end, tokens)`` of the chunks of one page."""
+        current: List[Tuple[int, int, int]] = []
+        current_tokens = 0
+        for (start, end), tokens in zip(spans, counts):
+            count = len(tokens)
+            if count > self.chunk_tokens:
+                # Short paragraphs before a long one (e.g. a heading) open its first window
+                lead_tokens = current_tokens + 1 if current else 0
+                if self.chunk_tokens - lead_tokens <= self.overlap_tokens:
+                    yield current[0][0], current[-1][1], current_tokens
+                    current, lead_tokens = [], 0
+                yield from self._windows(text, start, end, tokens, current[0][0] if current else None, lead_tokens)
+                current, current_tokens = [], 0
+                continue
+            # +1 for the paragraph break kept between paragraphs ("\n\n" is one token)
+            if current and current_tokens + count + 1 > self.chunk_tokens:
+                yield current[0][0], current[-1][1], current_tokens
+                carried = []
+                carried_tokens = 0
+                for paragraph in reversed(current[1:]):
+                    if carried_tokens + paragraph[2] > self.overlap_tokens:
+                        break
+                    carried.insert(0, paragraph)
+                    carried_tokens += paragraph[2] + 1
+                if carried_tokens + count + 1 > self.chunk_tokens:
+                    carried, carried_tokens = [], 0
+                current, current_tokens = carried, carried_tokens
+            current_tokens += count + (1 if current else 0)
+            current.append((start, end, count))
+        if current:
+            yield current[0][0], current[-1][1], current_tokens
+
+    def split_spans(self, texts: List[str]) -> List[List[Tuple[int, int, int]]]:
+        """Chunk spans ``(start, end, tokens)`` for each text, tokenizing all paragraphs at once."""
+        spans = [paragraph_spans(text) for text in texts]
+        paragraphs = [text[start:end] for text, text_spans in zip(texts, spans) for start, end in text_spans]
+        encoded = iter(self.encoding.encode_ordinary_batch(paragraphs) if paragraphs else [])
+        result = []
+        for text, text_spans in zip(texts, spans):
+            counts = [next(encoded) for _ in text_spans]
+            result.append(list(self._pack(text, text_spans, counts)))
+        return result
+
+    def split_text(self, text: str) -> List[str]:
+        return [text[start:end] for start, end, _ in self.split_spans([text])[0]]
+
+    def split_pages(self, pages: Iterable[Tuple[int, str]], metadata: dict) -> Iterator[Document]:
+        """Chunk ``(page_number, text)`` pages, tagging chunks with the page, token count and
+        ``start_index``/``end_index`` offsets into the concatenated page texts."""
+        offset = 0
+        batch: List[Tuple[int, str]] = []
+
+        def flush() -> Iterator[Document]:
+            nonlocal offset
+            texts = [text for _, text in batch]
+            for (number, text), chunks in zip(batch, self.split_spans(texts)):
+                for start, end, tokens in chunks:
+                    yield Document(
+                        page_content=text[start:end],
+                        metadata={**metadata, "page": number, "start_index": offset + start,
+                                  "end_index": offset + end, "tokens": tokens},
+                    )
+                offset += len(text)
+            batch.clear()
+
+        for page in pages:
+            batch.append(page)
+            if len(batch) >= self.batch_pages:
+                yield from flush()
+        if batch:
+            yield from flush()
+
+
+_DIGITS = re.compile(r"\d+")
+_WORD = re.compile(r"\w+")
+
+
+class BoilerplateFilter:
+    """Drops page headers and footers: lines at the top or bottom of a page that recur on many pages.
+
+    Lines are compared lower-cased with digits masked, so "Page 3 of 40" and
+    "Page 4 of 40" match. The first ``window`` pages are held back to learn
+    which edge lines repeat on at least ``min_share`` of pages; later pages
+    are filtered as they stream, and edge lines that become that common
+    later on are dropped from then on.
+    """
+
+    def __init__(self, window: int = 8, edge_lines: int = 2, min_share: float = 0.5, min_pages: int = 3):
+        self.window = window
+        self.edge_lines = edge_lines
+        self.min_share = min_share
+        self.min_pages = min_pages
+        self.pages = 0
+        self.removed_lines = 0
+        self.removed_chars = 0
+        self.total_chars = 0
+        self._counts: Dict[str, int] = {}
+        self._boilerplate: set = set()
+
+    @staticmethod
+    def _key(line: str) -> str:
+        return _DIGITS.sub("#", " ".join(line.lower().split()))
+
+    def _edges(self, lines: List[str]) -> List[int]:
+        """Indexes of the first and last ``edge_lines`` non-blank lines."""
+        filled = [i for i, line in enumerate(lines) if line.strip()]
+        return sorted(set(filled[:self.edge_lines] + filled[-self.edge_lines:]))
+
+    def _learn(self, text: str) -> None:
+        self.pages += 1
+        lines = text.split("\n")
+        for key in {self._key(lines[i]) for i in self._edges(lines)}:
+            count = self._counts[key] = self._counts.get(key, 0) + 1
+            if count >= max(self.min_pages, self.min_share * self.pages):
+                self._boilerplate.add(key)
+
+    def _strip(self, text: str) -> str:
+        self.total_chars += len(text)
+        lines = text.split("\n")
+        drop = {i for i in self._edges(lines) if self._key(lines[i]) in self._boilerplate}
+        if not drop:
+            return text
+        self.removed_lines += len(drop)
+        kept = "\n".join(line for i, line in enumerate(lines) if i not in drop)
+        self.removed_chars += len(text) - len(kept)
+        return kept
+
+    def filter(self, pages: Iterable[Tuple[int, str]]) -> Iterator[Tuple[int, str]]:
+        """``(page_number, text)`` pairs with the boilerplate lines removed, in order."""
+        held: List[Tuple[int, str]] = []
+        for number, text in pages:
+            self._learn(text)
+            if len(held) < self.window:
+                held.append((number, text))
+                if len(held) < self.window:
+                    continue
+                for held_number, held_text in held:
+                    yield held_number, self._strip(held_text)
+                continue
+            yield number, self._strip(text)
+        if len(held) < self.window:
+            for held_number, held_text in held:
+                yield held_number, self._strip(held_text)
+
+
+class ChunkDeduplicator:
+    """Near-duplicate chunk detector: MinHash signatures of word 3-grams, bucketed with LSH.
+
+    ``is_duplicate`` estimates the Jaccard similarity to earlier chunks from
+    the fraction of matching signature values and reports one at or above
+    ``threshold``; other chunks are remembered. Signatures are split into
+    ``bands`` so only chunks sharing a band are compared; with 64 hashes in
+    16 bands a pair at 0.85 similarity shares one with probability > 0.9999.
+    """
+
+    _PRIME = (1 << 61) - 1
+
+    def __init__(self, threshold: float = 0.9, num_perm: int = 64, bands: int = 16, seed: int = 1):
+        if num_perm % bands:
+            raise ValueError("num_perm must be a multiple of bands")
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = num_perm // bands
+        rng = np.random.default_rng(seed)
+        self._a = rng.integers(1, 1 << 32, size=num_perm, dtype=np.uint64)
+        self._b = rng.integers(0, 1 << 32, size=num_perm, dtype=np.uint64)
+        self._buckets: List[Dict[bytes, List[int]]] = [{} for _ in range(bands)]
+        self._signatures: List[np.ndarray] = []
+        self.checked = 0
+        self.duplicates = 0
+
+    def signature(self, text: str) -> Optional[np.ndarray]:
+        """MinHash of the text's word 3-grams (or its words when shorter); None without words."""
+        words = _WORD.findall(text.lower())
+        if not words:
+            return None
+        shingles = {" ".join(words[i:i + 3]) for i in range(max(1, len(words) - 2))}
+        hashes = np.fromiter((zlib.crc32(shingle.encode("utf-8")) for shingle in shingles), dtype=np.uint64, count=len(shingles))
+        # (a * h + b) stays below 2**64 for 32-bit a, b and h
+        return ((hashes[:, None] * self._a + self._b) % np.uint64(self._PRIME)).min(axis=0)
+
+    def __len__(self) -> int:
+        return len(self._signatures)
+
+    @property
+    def num_perm(self) -> int:
+        return len(self._a)
+
+    def _band_keys(self, signature: np.ndarray) -> List[bytes]:
+        return [signature[band * self.rows:(band + 1) * self.rows].tobytes() for band in range(self.bands)]
+
+    def _remember(self, signature: np.ndarray, keys: List[bytes]) -> None:
+        position = len(self._signatures)
+        self._signatures.append(signature)
+        for band, key in enumerate(keys):
+            self._buckets[band].setdefault(key, []).append(position)
+
+    def is_duplicate(self, text: str) -> bool:
+        signature = self.signature(text)
+        if signature is None:
+            return False
+        self.checked += 1
+        keys = self._band_keys(signature)
+        candidates = {i for band, key in enumerate(keys) for i in self._buckets[band].get(key, ())}
+        for i in candidates:
+            if np.count_nonzero(self._signatures[i] == signature) >= self.threshold * len(signature):
+                self.duplicates += 1
+                return True
+        self._remember(signature, keys)
+        return False
+
+    def add(self, signatures: np.ndarray) -> None:
+        """Remember precomputed signatures (one row per chunk), such as those saved with an index."""
+        if len(signatures) and signatures.shape[1] != self.num_perm:
+            logger.warning(f"Ignoring {signatures.shape[1]}-hash signatures in a {self.num_perm}-hash deduplicator")
+            return
+        for signature in np.asarray(signatures, dtype=np.uint64):
+            self._remember(signature, self._band_keys(signature))
+
+    def signatures(self, start: int = 0) -> np.ndarray:
+        """Remembered signatures from position ``start`` on, one row per chunk."""
+        if len(self._signatures) <= start:
+            return np.empty((0, self.num_perm), dtype=np.uint64)
+        return np.vstack(self._signatures[start:])
+
+
+def _page_text(page: "fitz.Page", layout: bool = False) -> str:
+    """Plain page text, or with ``layout`` one blank-line separated paragraph per PyMuPDF text block."""
+    if not layout:
+        return page.get_text()
+    blocks = (block[4].strip() for block in page.get_text("blocks") if block[6] == 0)
+    return "\n\n".join(block for block in blocks if block) + "\n"
+
+
+def _extract_page_range(pdf_path: str, start: int, stop: int, layout: bool = False) -> List[Tuple[int, str]]:
+    """Extract pages ``[start, stop)`` of a PDF file; runs in an extraction worker."""
+    doc = fitz.open(pdf_path)
+    try:
+        return [(number + 1, _page_text(doc[number], layout)) for number in range(start, stop)]
+    finally:
+        doc.close()
+
+
+_extraction_pool: Optional[ProcessPoolExecutor] = None
+_extraction_pool_lock = threading.Lock()
+
+
+def _get_extraction_pool(max_workers: Optional[int] = None) -> ProcessPoolExecutor:
+    """Process pool shared by all parallel extractions; created on first use."""
+    global _extraction_pool
+    with _extraction_pool_lock:
+        if _extraction_pool is None:
+            _extraction_pool = ProcessPoolExecutor(
+                max_workers=max_workers or int(os.getenv("EXTRACT_WORKERS", "0")) or None,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return _extraction_pool
+
+
+def _ocr_page_image(samples: bytes, width: int, height: int, language: str) -> Tuple[str, float]:
+    """OCR one grayscale page image; runs in an extraction worker. Returns the text and seconds taken."""
+    import pytesseract
+    from PIL import Image
+    start = time.perf_counter()
+    text = pytesseract.image_to_string(Image.frombytes("L", (width, height), samples), lang=language)
+    return text, time.perf_counter() - start
+
+
+class PageOCR:
+    """Offline OCR for pages that have no text layer, such as scanned PDFs.
+
+    Pages are rendered to grayscale pixmaps with PyMuPDF and recognized by
+    Tesseract (through the optional ``pytesseract`` package) on the shared
+    extraction process pool. Results are cached in SQLite by a hash of the
+    page image, DPI and language, so uploading the same scan again does not
+    run OCR.
+    """
+
+    def __init__(
+        self,
+        cache_dir: Optional[str] = None,
+        dpi: Optional[int] = None,
+        language: Optional[str] = None,
+        max_workers: Optional[int] = None,
+    ):
+        self.dpi = dpi if dpi is not None else int(os.getenv("OCR_DPI", "200"))
+        self.language = language if language is not None else os.getenv("OCR_LANGUAGE", "eng")
+        self.max_workers = max_workers
+        self._lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+            self._db = sqlite3.connect(os.path.join(cache_dir, "ocr.sqlite"), timeout=30, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS pages (key TEXT PRIMARY KEY, text TEXT NOT NULL)")
+            self._db.commit()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    @lru_cache(maxsize=None)
+    def available() -> bool:
+        """Whether pytesseract and the Tesseract binary are installed."""
+        try:
+            import pytesseract
+            pytesseract.get_tesseract_version()
+            return True
+        except Exception as e:
+            logger.info(f"OCR unavailable, image-only pages will be empty: {str(e)}")
+            return False
+
+    def _cached(self, key: str) -> Optional[str]:
+        if self._db is None:
+            return None
+        with self._lock:
+            row = self._db.execute("SELECT text FROM pages WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def _store(self, key: str, text: str) -> None:
+        if self._db is None:
+            return
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO pages (key, text) VALUES (?, ?)", (key, text))
+            self._db.commit()
+
+    def submit(self, page: "fitz.Page") -> "Future[Tuple[str, float, bool]]":
+        """Start recognizing a page; the future resolves to ``(text, seconds, cached)``."""
+        start = time.perf_counter()
+        pixmap = page.get_pixmap(dpi=self.dpi, colorspace=fitz.csGRAY, alpha=False)
+        samples = pixmap.samples
+        key = hashlib.sha256(f"{self.dpi}\0{self.language}\0".encode("utf-8") + samples).hexdigest()
+        text = self._cached(key)
+        if text is not None:
+            self.hits += 1
+            done: "Future[Tuple[str, float, bool]]" = Future()
+            done.set_result((text, time.perf_counter() - start, True))
+            return done
+
+        self.misses += 1
+        result: "Future[Tuple[str, float, bool]]" = Future()
+        job = _get_extraction_pool(self.max_workers).submit(
+            _ocr_page_image, samples, pixmap.width, pixmap.height, self.language
+        )
+
+        def finished(job: Future) -> None:
+            try:
+                text, seconds = job.result()
+            except BaseException as e:
+                result.set_exception(e)
+                return
+            self._store(key, text)
+            result.set_result((text, seconds, False))
+
+        job.add_done_callback(finished)
+        return result
+
+    def close(self) -> None:
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+
+@dataclass
+class IngestionResult:
+    """Outcome of a streaming ingestion run."""
+
+    vectorstore: Optional["FAISS"]
+    lexical_index: Optional[LexicalIndex] = None
+    page_count: int = 0
+    char_count: int = 0
+    chunk_count: int = 0
+    duplicate_chunks: int = 0  # near-duplicates skipped; not in chunk_count
+    boilerplate_chars: int = 0  # header/footer characters removed before splitting
+    signatures: Optional[np.ndarray] = None  # MinHash of the embedded chunks, with dedup on
+    text: str = ""
+    time_to_first_queryable: Optional[float] = None
+    total_time: float = 0.0
+
+
+_STAGE_DONE = object()
+
+
+def _timed_iter(items: Iterable[Any], spent: Dict[str, float], key: str) -> Iterator[Any]:
+    """Yield from ``items``, adding the time taken to produce each one to ``spent[key]``."""
+    iterator = iter(items)
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        finally:
+            spent[key] += time.perf_counter() - start
+        yield item
+
+
+def _collect_texts(pages: Iterable[Tuple[int, str]], texts: List[str]) -> Iterator[Tuple[int, str]]:
+    """Pass pages through, appending each page's text to ``texts``."""
+    for number, text in pages:
+        texts.append(text)
+        yield number, text
+
+
+def _put_until_stopped(q: "queue.Queue", item: Any, stop: threading.Event) -> bool:
+    """Blocking put that gives up once the pipeline is stopped; returns False if it gave up."""
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+class PDFProcessor:
+    """Handles PDF processing, text extraction, and vector store creation."""
+
+    def __init__(
+        self,
+        embeddings_model_name="sentence-transformers/all-MiniLM-L6-v2",
+        cache_dir: Optional[str] = _CACHE_DIR_FROM_ENV,
+        cache_max_entries: Optional[int] = None,
+        index_config: Optional[IndexConfig] = None,
+        chunking: Optional[str] = None,
+        chunk_tokens: Optional[int] = None,
+        ocr: Optional[str] = None,
+        vector_dtype: Optional[str] = None,
+        dedup: Optional[str] = None,
+        dedup_threshold: Optional[float] = None,
+    ):
+        # Settings left out come from the environment (see the README)
+        cache_dir = _cache_dir_from_env(cache_dir)
+        if cache_max_entries is None:
+            cache_max_entries = int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", "200000"))
+        chunking = chunking or os.getenv("CHUNKING", "characters")
+        if chunk_tokens is None:
+            chunk_tokens = int(os.getenv("CHUNK_TOKENS", "256"))
+        ocr = ocr or os.getenv("OCR", "auto")
+        dedup = dedup or os.getenv("DEDUP", "off")
+        if dedup_threshold is None:
+            dedup_threshold = float(os.getenv("DEDUP_THRESHOLD", "0.9"))
+        self.embeddings_model_name = embeddings_model_name
+        self.index_config = index_config or IndexConfig()
+        # "float16" / "int8" store vectors scalar-quantized at half / a quarter of the float32 size
+        if vector_dtype is not None:
+            if vector_dtype not in VECTOR_DTYPES:
+                raise ValueError(f"Unknown vector dtype: {vector_dtype}")
+            self.index_config = replace(self.index_config, vector_dtype=vector_dtype)
+        embeddings = LazyEmbeddings(embeddings_model_name)
+        if cache_dir:
+            self.embedding_cache = EmbeddingCache(cache_dir, max_entries=cache_max_entries)
+            self.embeddings = CachedEmbeddings(embeddings, self.embedding_cache, embeddings_model_name)
+        else:
+            self.embedding_cache = None
+            self.embeddings = embeddings
+        from langchain_text_splitters import RecursiveCharacterTextSplitter
+        self.text_splitter = RecursiveCharacterTextSplitter(
+            chunk_size=1000,
+            chunk_overlap=100,
+            length_function=len,
+        )
+        # "tokens": paragraph-aligned chunks measured in tiktoken tokens, from layout extraction
+        if chunking not in ("characters", "tokens"):
+            raise ValueError(f"Unknown chunking mode: {chunking}")
+        self.chunker = TokenChunker(chunk_tokens, overlap_tokens=chunk_tokens // 8) if chunking == "tokens" else None
+        # "auto": OCR text-less pages when Tesseract is installed; "on" insists on it; "off" never OCRs
+        if ocr not in ("auto", "on", "off"):
+            raise ValueError(f"Unknown OCR mode: {ocr}")
+        if ocr == "on" and not PageOCR.available():
+            raise RuntimeError("OCR=on needs the pytesseract package and the Tesseract binary")
+        self.ocr_mode = ocr
+        # "on": drop repeated headers/footers and near-duplicate chunks before embedding
+        if dedup not in ("on", "off"):
+            raise ValueError(f"Unknown dedup mode: {dedup}")
+        self.dedup = dedup == "on"
+        self.dedup_threshold = dedup_threshold
+        self._ocr_cache_dir = cache_dir
+        self._ocr: Optional[PageOCR] = None
+
+    def preload(self, started: Optional[float] = None) -> threading.Thread:
+        """Load the embedding model on a background thread so the first upload does not wait for it."""
+        def load():
+            get_embeddings(self.embeddings_model_name)
+            if started is not None:
+                log_startup_time("embedding model loaded", started)
+
+        thread = threading.Thread(target=load, daemon=True)
+        thread.start()
+        return thread
+
+    def extract_text_from_pdf(self, pdf_file_bytes: bytes, parallel: bool = False) -> str:
+        """Extract text from PDF bytes"""
+        try:
+            with timed("extract_seconds"):
+                pages = [text for _, text in self.iter_pages(pdf_file_bytes, parallel=parallel)]
+            metrics.inc("extract_pages_total", len(pages))
+            return "".join(pages)
+        except Exception as e:
+            logger.error(f"PDF extraction error: {str(e)}")
+            return ""
+
+    def iter_pages(
+        self,
+        pdf_file_bytes: bytes,
+        parallel: bool = False,
+        max_workers: Optional[int] = None,
+        pages_per_task: int = 16,
+        layout: Optional[bool] = None,
+    ) -> Iterator[Tuple[int, str]]:
+        """Yield ``(page_number, text)`` in page order (1-based) as pages are extracted.
+
+        With ``parallel=True`` page ranges are extracted by a process pool, each
+        worker opening the document independently; small documents are still
+        read serially since the hand-off would cost more than it saves.
+        ``layout`` (default: on in token chunking mode) separates text blocks
+        with blank lines so chunks can follow them. Pages without a text layer
+        are OCR'd when OCR is enabled (see ``PageOCR``).
+        """
+        if layout is None:
+            layout = self.chunker is not None
+        pages = self._iter_text_layer(pdf_file_bytes, parallel, max_workers, pages_per_task, layout)
+        ocr = self._get_ocr()
+        if ocr is None:
+            return pages
+        return self._ocr_missing(pdf_file_bytes, pages, ocr)
+
+    def _get_ocr(self) -> Optional[PageOCR]:
+        """The OCR stage, created on first use since looking for Tesseract starts a subprocess."""
+        if self._ocr is None and self.ocr_mode != "off" and PageOCR.available():
+            self._ocr = PageOCR(self._ocr_cache_dir)
+        return self._ocr
+
+    def _ocr_missing(
+        self, pdf_file_bytes: bytes, pages: Iterator[Tuple[int, str]], ocr: PageOCR
+    ) -> Iterator[Tuple[int, str]]:
+        """Pass ``pages`` through in order, replacing text-less ones with OCR results.
+
+        OCR jobs start as soon as such a page is seen, so they overlap with
+        the extraction of later pages; pages wait in order behind them.
+        """
+        doc = fitz.open(stream=pdf_file_bytes, filetype="pdf")
+        pending: "deque[Tuple[int, Any]]" = deque()
+        timings: List[float] = []
+
+        def resolved(number: int, item: Any) -> Tuple[int, str]:
+            if isinstance(item, str):
+                return number, item
+            text, seconds, cached = item.result()
+            timings.append(seconds)
+            metrics.inc("ocr_pages_total", cached=str(cached).lower())
+            if not cached:
+                metrics.observe("ocr_seconds", seconds)
+            logger.info(f"OCR page {number}: {len(text)} chars in {seconds:.2f}s{' (cached)' if cached else ''}")
+            return number, text
+
+        try:
+            for number, text in pages:
+                pending.append((number, text if text.strip() else ocr.submit(doc[number - 1])))
+                while pending and (isinstance(pending[0][1], str) or pending[0][1].done()):
+                    yield resolved(*pending.popleft())
+            while pending:
+                yield resolved(*pending.popleft())
+        finally:
+            doc.close()
+        if timings:
+            logger.info(
+                f"OCR: {len(timings)} text-less pages, {sum(timings):.2f}s total, "
+                f"{max(timings):.2f}s slowest (cache {ocr.hits} hits, {ocr.misses} misses)"
+            )
+
+    def _iter_text_layer(
+        self, pdf_file_bytes: bytes, parallel: bool, max_workers: Optional[int], pages_per_task: int, layout: bool
+    ) -> Iterator[Tuple[int, str]]:
+        doc = fitz.open(stream=pdf_file_bytes, filetype="pdf")
+        try:
+            page_count = doc.page_count
+            if not parallel or page_count < 2 * pages_per_task:
+                for number, page in enumerate(doc, start=1):
+                    yield number, _page_text(page, layout)
+                return
+        finally:
+            doc.close()
+
+        # Workers open the file by path so the PDF is written once instead of pickled per task
+        fd, pdf_path = tempfile.mkstemp(suffix=".pdf")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(pdf_file_bytes)
+            ranges = [(start, min(start + pages_per_task, page_count)) for start in range(0, page_count, pages_per_task)]
+            executor = _get_extraction_pool(max_workers)
+            # map() yields results in submission order while later ranges are still running
+            for pages in executor.map(_extract_page_range, [pdf_path] * len(ranges), *zip(*ranges), [layout] * len(ranges)):
+                yield from pages
+        finally:
+            os.remove(pdf_path)
+
+    def split_text(self, text: str) -> List[str]:
+        """Split text into chunks"""
+        if self.chunker is not None:
+            return self.chunker.split_text(text)
+        return self.text_splitter.split_text(text)
+
+    def split_text_with_metadata(self, text: str, metadata: dict) -> List[Document]:
+        """Split text into chunks and attach metadata."""
+        with timed("chunk_seconds"):
+            if self.chunker is not None:
+                chunks = [
+                    Document(page_content=text[start:end],
+                             metadata={**metadata, "start_index": start, "end_index": end, "tokens": tokens})
+                    for start, end, tokens in self.chunker.split_spans([text])[0]
+                ]
+            else:
+                # Create documents and then split them
+                docs = self.text_splitter.create_documents([text], metadatas=[metadata])
+                chunks = self.text_splitter.split_documents(docs)
+        metrics.inc("chunks_total", len(chunks))
+        return chunks
+
+    def split_pages_with_metadata(self, pages: Iterable[Tuple[int, str]], metadata: dict) -> Iterator[Document]:
+        """Split pages one at a time, tagging each chunk with its page number.
+
+        Accepts the ``iter_pages`` generator, so chunks are produced while later
+        pages are still being extracted. In token mode chunks also carry
+        ``start_index``/``end_index`` into the document text and their ``tokens``.
+        """
+        if self.chunker is not None:
+            yield from self.chunker.split_pages(pages, metadata)
+            return
+        for number, text in pages:
+            if not text.strip():
+                continue
+            yield from self.text_splitter.create_documents([text], metadatas=[{**metadata, "page": number}])
+
+    @contextmanager
+    def _log_cache_usage(self):
+        """Log embedding cache hits/misses for the enclosed block."""
+        if self.embedding_cache is None:
+            yield
+            return
+        hits, misses = self.embedding_cache.hits, self.embedding_cache.misses
+        yield
+        logger.info(
+            f"Embedding cache: {self.embedding_cache.hits - hits} hits, "
+            f"{self.embedding_cache.misses - misses} misses"
+        )
+
+    def ingest_stream(
+        self,
+        pdf_file_bytes: bytes,
+        metadata: dict,
+        vectorstore: Optional["FAISS"] = None,
+        batch_size: int = 64,
+        queue_size: int = 4,
+        parallel: bool = False,
+        keep_text: bool = False,
+        known_signatures: Optional[np.ndarray] = None,
+    ) -> IngestionResult:
+        """Extract, split and embed a PDF as a pipeline instead of three materialized phases.
+
+        Pages flow from an extractor thread to a splitter thread to the embedder
+        through bounded queues, and chunk vectors are added to the index in
+        micro-batches of ``batch_size``, so memory stays flat in document size
+        and the index becomes queryable after the first batch. New vectors are
+        appended to ``vectorstore`` when one is given (a copy of it when it is
+        a read-only store from ``IndexStore.load``). Once complete, the index
+        is rebuilt as the type ``index_config`` picks for its size. A BM25
+        ``LexicalIndex`` over the same chunk ids is built alongside.
+
+        With dedup on, repeated page headers and footers are removed before
+        splitting (``text`` is the filtered text, so chunk offsets point into
+        it), and chunks nearly identical to an earlier chunk or to one of
+        ``known_signatures`` are skipped instead of embedded. Pass the
+        signatures of what is already indexed, from ``DocumentCorpus.signatures``
+        or ``IndexStore.load_signatures``; those of the embedded chunks come
+        back in ``result.signatures``.
+        """
+        start = time.perf_counter()
+        if vectorstore is not None:
+            vectorstore = writable_vectorstore(vectorstore)
+        result = IngestionResult(vectorstore=vectorstore, lexical_index=LexicalIndex())
+        pages_q: "queue.Queue" = queue.Queue(maxsize=queue_size)
+        batches_q: "queue.Queue" = queue.Queue(maxsize=queue_size)
+        stop = threading.Event()
+        errors: List[BaseException] = []
+        texts: List[str] = []
+        # Busy time per stage; the splitter's waits for pages are taken off its own
+        spent = {"extract": 0.0, "split": 0.0, "split_wait": 0.0}
+        boilerplate = BoilerplateFilter() if self.dedup else None
+        deduplicator = ChunkDeduplicator(self.dedup_threshold) if self.dedup else None
+        if deduplicator is not None and known_signatures is not None:
+            deduplicator.add(known_signatures)
+        known = len(deduplicator) if deduplicator is not None else 0
+
+        def extract():
+            try:
+                for number, text in _timed_iter(self.iter_pages(pdf_file_bytes, parallel=parallel), spent, "extract"):
+                    result.page_count += 1
+                    result.char_count += len(text)
+                    if not _put_until_stopped(pages_q, (number, text), stop):
+                        return
+            except BaseException as e:
+                errors.append(e)
+            finally:
+                _put_until_stopped(pages_q, _STAGE_DONE, stop)
+
+        def split():
+            def pages():
+                while not stop.is_set():
+                    waited = time.perf_counter()
+                    try:
+                        item = pages_q.get(timeout=0.1)
+                    except queue.Empty:
+                        continue
+                    finally:
+                        spent["split_wait"] += time.perf_counter() - waited
+                    if item is _STAGE_DONE:
+                        return
+                    yield item
+
+            try:
+                batch: List[Document] = []
+                page_iter = pages() if boilerplate is None else boilerplate.filter(pages())
+                if keep_text:
+                    # The kept text is what was split, so chunk offsets point into it
+                    page_iter = _collect_texts(page_iter, texts)
+                for doc in _timed_iter(self.split_pages_with_metadata(page_iter, metadata), spent, "split"):
+                    if deduplicator is not None and deduplicator.is_duplicate(doc.page_content):
+                        continue
+                    batch.append(doc)
+                    if len(batch) >= batch_size:
+                        if not _put_until_stopped(batches_q, batch, stop):
+                            return
+                        batch = []
+                if batch:
+                    _put_until_stopped(batches_q, batch, stop)
+            except BaseException as e:
+                errors.append(e)
+            finally:
+                _put_until_stopped(batches_q, _STAGE_DONE, stop)
+
+        workers = [threading.Thread(target=extract, daemon=True), threading.Thread(target=split, daemon=True)]
+        for worker in workers:
+            worker.start()
+
+        try:
+            with self._log_cache_usage():
+                while True:
+                    batch = batches_q.get()
+                    if batch is _STAGE_DONE:
+                        break
+                    chunk_texts = [doc.page_content for doc in batch]
+                    vectors = self.embeddings.embed_documents(chunk_texts)
+                    metadatas = [doc.metadata for doc in batch]
+                    ids = [str(uuid.uuid4()) for _ in batch]
+                    if result.vectorstore is None:
+                        from langchain_community.vectorstores import FAISS
+                        result.vectorstore = FAISS.from_embeddings(
+                            list(zip(chunk_texts, vectors)), self.embeddings, metadatas=metadatas, ids=ids
+                        )
+                    else:
+                        result.vectorstore.add_embeddings(list(zip(chunk_texts, vectors)), metadatas=metadatas, ids=ids)
+                    result.lexical_index.add(ids, chunk_texts)
+                    result.chunk_count += len(batch)
+                    if result.time_to_first_queryable is None:
+                        result.time_to_first_queryable = time.perf_counter() - start
+        finally:
+            stop.set()
+            for worker in workers:
+                worker.join()
+
+        if errors:
+            raise errors[0]
+
+        result.vectorstore = optimize_vectorstore(result.vectorstore, self.index_config)
+        result.text = "".join(texts)
+        result.total_time = time.perf_counter() - start
+        metrics.observe("ingest_seconds", result.total_time)
+        metrics.observe("extract_seconds", spent["extract"])
+        metrics.observe("chunk_seconds", max(0.0, spent["split"] - spent["split_wait"]))
+        metrics.inc("extract_pages_total", result.page_count)
+        metrics.inc("chunks_total", result.chunk_count)
+        if deduplicator is not None:
+            result.duplicate_chunks = deduplicator.duplicates
+            result.signatures = deduplicator.signatures(known)
+            result.boilerplate_chars = boilerplate.removed_chars
+            metrics.inc("duplicate_chunks_total", result.duplicate_chunks)
+            metrics.inc("boilerplate_chars_total", result.boilerplate_chars)
+            logger.info(
+                f"Dedup: removed {boilerplate.removed_lines} header/footer lines "
+                f"({result.boilerplate_chars / max(1, boilerplate.total_chars):.1%} of characters), "
+                f"skipped {result.duplicate_chunks} of {deduplicator.checked} chunks "
+                f"({result.duplicate_chunks / max(1, deduplicator.checked):.1%})"
+            )
+        logger.info(
+            f"Ingested {result.page_count} pages into {result.chunk_count} chunks in {result.total_time:.2f}s "
+            f"(first queryable after {result.time_to_first_queryable or 0:.2f}s)"
+        )
+        return result
+
+    def create_vector_store_with_metadata(self, documents: List[Document]) -> Optional["FAISS"]:
+        """Create FAISS vector store from documents with metadata."""
+        from langchain_community.vectorstores import FAISS
+        try:
+            with self._log_cache_usage():
+                vectorstore = FAISS.from_documents(documents, self.embeddings)
+            return optimize_vectorstore(vectorstore, self.index_config)
+        except Exception as e:
+            logger.error(f"Vector store creation error: {str(e)}")
+            return None
+
+    def create_vector_store(self, chunks: List[str]) -> Optional["FAISS"]:
+        """Create FAISS vector store from text chunks"""
+        from langchain_community.vectorstores import FAISS
+        try:
+            with self._log_cache_usage():
+                vectorstore = FAISS.from_texts(chunks, self.embeddings)
+            return optimize_vectorstore(vectorstore, self.index_config)
+        except Exception as e:
+            logger.error(f"Vector store creation error: {str(e)}")
+            return None
+
+
+class ChunkIds:
+    """``index_to_docstore_id`` of a mapped store: position ``i`` has id ``f"{prefix}{i}"``, computed, not stored.
+
+    Indexes like the list of a document's ids in ``DocumentCorpus`` and
+    offers the ``values``/``get`` of the dict LangChain normally keeps there.
+    """
+
+    def __init__(self, prefix: str, count: int):
+        self.prefix = prefix
+        self.count = count
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __getitem__(self, position: int) -> str:
+        if not 0 <= position < self.count:
+            raise KeyError(position)
+        return f"{self.prefix}{position}"
+
+    def __iter__(self) -> Iterator[str]:
+        return (f"{self.prefix}{position}" for position in range(self.count))
+
+    def values(self) -> Iterator[str]:
+        return iter(self)
+
+    def get(self, position: int, default: Optional[str] = None) -> Optional[str]:
+        return f"{self.prefix}{position}" if 0 <= position < self.count else default
+
+    def position(self, doc_id: str) -> Optional[int]:
+        if not doc_id.startswith(self.prefix):
+            return None
+        try:
+            position = int(doc_id[len(self.prefix):])
+        except ValueError:
+            return None
+        return position if 0 <= position < self.count else None
+
+
+class ReadOnlyIndexError(RuntimeError):
+    """Raised on an attempt to change a memory-mapped store opened by ``IndexStore.load``;
+    change a ``writable_vectorstore`` copy instead."""
+
+
+class MappedDocstore:
+    """Read-only docstore whose chunk records are memory-mapped from disk.
+
+    Each chunk is a JSON record (text and metadata) in ``chunks.bin``,
+    located through an offsets array, and is only decoded when a search
+    returns it. Processes and sessions reading the same document share the
+    page cache instead of each holding an unpickled copy of every chunk.
+    """
+
+    RECORDS = "chunks.bin"
+    OFFSETS = "chunks.offsets.npy"
+
+    def __init__(self, path: str, ids: ChunkIds):
+        self.ids = ids
+        self._offsets = np.load(os.path.join(path, self.OFFSETS), mmap_mode="r")
+        size = int(self._offsets[-1])
+        # np.memmap refuses empty files
+        self._records = np.memmap(os.path.join(path, self.RECORDS), dtype=np.uint8, mode="r") if size else b""
+
+    @classmethod
+    def exists(cls, path: str) -> bool:
+        return os.path.exists(os.path.join(path, cls.OFFSETS))
+
+    @classmethod
+    def write(cls, path: str, documents: List[Document]) -> None:
+        """Write chunk records in index order."""
+        offsets = np.zeros(len(documents) + 1, dtype=np.int64)
+        with open(os.path.join(path, cls.RECORDS), "wb") as f:
+            for i, doc in enumerate(documents):
+                record = json.dumps({"text": doc.page_content, "metadata": doc.metadata}, default=str).encode("utf-8")
+                f.write(record)
+                offsets[i + 1] = offsets[i] + len(record)
+        np.save(os.path.join(path, cls.OFFSETS), offsets)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def document(self, position: int) -> Document:
+        record = json.loads(bytes(self._records[int(self._offsets[position]):int(self._offsets[position + 1])]))
+        return Document(id=self.ids[position], page_content=record["text"], metadata=record["metadata"])
+
+    def search(self, search: str) -> Any:
+        """The chunk with id ``search``; a "not found" string otherwise, like LangChain's docstores."""
+        position = self.ids.position(search)
+        if position is None:
+            return f"ID {search} not found."
+        return self.document(position)
+
+    def delete(self, ids: List) -> None:
+        raise ReadOnlyIndexError(
+            "Memory-mapped chunks cannot be deleted; change a copy made with writable_vectorstore() instead"
+        )
+
+
+def writable_vectorstore(vectorstore: "FAISS") -> "FAISS":
+    """``vectorstore`` itself, or an in-memory copy of a read-only store opened by ``IndexStore.load``.
+
+    Writing to a memory-mapped FAISS index fails a C++ assertion that aborts
+    the whole process, so stores that will be appended to are copied first.
+    """
+    if not isinstance(vectorstore.docstore, MappedDocstore):
+        return vectorstore
+    import faiss
+    from langchain_community.docstore.in_memory import InMemoryDocstore
+    from langchain_community.vectorstores import FAISS
+    docstore = vectorstore.docstore
+    documents = [docstore.document(position) for position in range(len(docstore))]
+    return FAISS(
+        vectorstore.embedding_function,
+        # clone_index would keep viewing the mapped vectors; a serialization round trip owns them
+        faiss.deserialize_index(faiss.serialize_index(vectorstore.index)),
+        InMemoryDocstore({doc.id: doc for doc in documents}),
+        {position: doc.id for position, doc in enumerate(documents)},
+        relevance_score_fn=vectorstore.override_relevance_score_fn,
+        normalize_L2=vectorstore._normalize_L2,
+        distance_strategy=vectorstore.distance_strategy,
+    )
+
+
+class IndexStore:
+    """Document-hash addressed directory of FAISS indexes saved in FAISS's native format.
+
+    Each document gets ``<root>/<hash>/`` holding the FAISS index, the chunk
+    records of a ``MappedDocstore``, the BM25 ``LexicalIndex``, the chunks'
+    MinHash signatures for dedup, the extracted text and a small ``info.json``. Loading memory-maps the vectors and chunks
+    read-only, so sessions and processes using the same document share its
+    pages. Opened indexes are kept in an in-process LRU so callers only need to
+    hold on to the document hash.
+    """
+
+    def __init__(
+        self,
+        embeddings: Embeddings,
+        root: Optional[str] = None,
+        max_open: int = 16,
+        index_config: Optional[IndexConfig] = None,
+    ):
+        root = root or os.getenv("INDEX_DIR", "indexes")
+        os.makedirs(root, exist_ok=True)
+        self.root = root
+        self.embeddings = embeddings
+        self.index_config = index_config or IndexConfig()
+        self.max_open = max_open
+        self._open: "OrderedDict[str, FAISS]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    SIGNATURES = "minhash.npy"
+
+    @staticmethod
+    def document_hash(pdf_file_bytes: bytes) -> str:
+        """Content address of an uploaded PDF."""
+        return hashlib.sha256(pdf_file_bytes).hexdigest()
+
+    @staticmethod
+    def deduplicated_hash(doc_hash: str, basis: Iterable[str]) -> str:
+        """Address of a document's index with the chunks near-identical to the ``basis`` indexes left out."""
+        return hashlib.sha256(f"{doc_hash}|{','.join(sorted(basis))}".encode("utf-8")).hexdigest()
+
+    def path(self, doc_hash: str) -> str:
+        return os.path.join(self.root, doc_hash)
+
+    def exists(self, doc_hash: str) -> bool:
+        return os.path.exists(os.path.join(self.path(doc_hash), "info.json"))
+
+    def save(
+        self,
+        doc_hash: str,
+        vectorstore: "FAISS",
+        text: str,
+        info: Dict[str, Any],
+        lexical_index: Optional[LexicalIndex] = None,
+        signatures: Optional[np.ndarray] = None,
+    ) -> None:
+        """Persist an index atomically so concurrent readers never see a partial directory.
+
+        Chunks are renumbered to the ``ChunkIds`` of the saved index, so the
+        next ``load`` returns the memory-mapped copy rather than ``vectorstore``.
+        """
+        import faiss
+        count = vectorstore.index.ntotal
+        store_ids = [vectorstore.index_to_docstore_id[i] for i in range(count)]
+        ids = self._chunk_ids(doc_hash, count)
+        tmp_dir = tempfile.mkdtemp(prefix=f".{doc_hash}.", dir=self.root)
+        try:
+            faiss.write_index(vectorstore.index, os.path.join(tmp_dir, "index.faiss"))
+            MappedDocstore.write(tmp_dir, [vectorstore.docstore.search(doc_id) for doc_id in store_ids])
+            if lexical_index is not None:
+                renamed = LexicalIndex(lexical_index.k1, lexical_index.b)
+                renamed.extend(lexical_index, rename=dict(zip(store_ids, ids)))
+                renamed.save(tmp_dir)
+            if signatures is not None:
+                np.save(os.path.join(tmp_dir, self.SIGNATURES), signatures)
+            with open(os.path.join(tmp_dir, "full_text.txt"), "w", encoding="utf-8") as f:
+                f.write(text)
+            # info.json is written last; its presence marks the index as complete
+            with open(os.path.join(tmp_dir, "info.json"), "w", encoding="utf-8") as f:
+                json.dump({**info, "normalize_L2": vectorstore._normalize_L2}, f)
+            target = self.path(doc_hash)
+            if os.path.exists(target):
+                shutil.rmtree(target)
+            os.replace(tmp_dir, target)
+        finally:
+            if os.path.exists(tmp_dir):
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+
+        with self._lock:
+            self._open.pop(doc_hash, None)
+
+    @staticmethod
+    def _chunk_ids(doc_hash: str, count: int) -> ChunkIds:
+        # The hash prefix keeps ids unique when several documents share a DocumentCorpus
+        return ChunkIds(f"{doc_hash[:16]}:", count)
+
+    def load_info(self, doc_hash: str) -> Optional[Dict[str, Any]]:
+        try:
+            with open(os.path.join(self.path(doc_hash), "info.json"), encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def load_text(self, doc_hash: str) -> str:
+        try:
+            with open(os.path.join(self.path(doc_hash), "full_text.txt"), encoding="utf-8") as f:
+                return f.read()
+        except OSError as e:
+            logger.error(f"Could not read text for index {doc_hash}: {str(e)}")
+            return ""
+
+    def load_signatures(self, doc_hash: str, deduplicator: Optional["ChunkDeduplicator"] = None) -> Optional[np.ndarray]:
+        """MinHash signatures of the document's chunks; None if the index is missing.
+
+        Indexes saved without them (dedup was off) have them computed from the
+        chunks once and written next to the index.
+        """
+        path = os.path.join(self.path(doc_hash), self.SIGNATURES)
+        try:
+            return np.load(path, mmap_mode="r")
+        except (OSError, ValueError):
+            pass
+        vectorstore = self.load(doc_hash)
+        if vectorstore is None:
+            return None
+        deduplicator = deduplicator or ChunkDeduplicator()
+        rows = [deduplicator.signature(vectorstore.docstore.search(doc_id).page_content)
+                for doc_id in vectorstore.index_to_docstore_id.values()]
+        signatures = np.array([row for row in rows if row is not None], dtype=np.uint64).reshape(-1, deduplicator.num_perm)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                np.save(f, signatures)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"Could not save signatures for index {doc_hash}: {str(e)}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return signatures
+
+    def load_lexical(self, doc_hash: str) -> Optional[LexicalIndex]:
+        """The document's BM25 index; None for indexes saved without one."""
+        return LexicalIndex.load(self.path(doc_hash))
+
+    def load(self, doc_hash: str) -> Optional["FAISS"]:
+        """Return the index for a document, opening it from disk on an LRU miss."""
+        with self._lock:
+            vectorstore = self._open.get(doc_hash)
+            if vectorstore is not None:
+                self._open.move_to_end(doc_hash)
+                return vectorstore
+
+        if not self.exists(doc_hash):
+            return None
+
+        from langchain_community.vectorstores import FAISS
+        path = self.path(doc_hash)
+        try:
+            if MappedDocstore.exists(path):
+                import faiss
+                # Vectors stay in the page cache; searching reads them in place
+                index = faiss.read_index(os.path.join(path, "index.faiss"), faiss.IO_FLAG_MMAP_IFC | faiss.IO_FLAG_READ_ONLY)
+                ids = self._chunk_ids(doc_hash, index.ntotal)
+                vectorstore = FAISS(
+                    self.embeddings, index, MappedDocstore(path, ids), ids,
+                    normalize_L2=(self.load_info(doc_hash) or {}).get("normalize_L2", False),
+                )
+            else:
+                # Saved before chunks were memory-mapped; the directory is only ever
+                # written by save(), so unpickling its docstore is safe
+                vectorstore = FAISS.load_local(path, self.embeddings, allow_dangerous_deserialization=True)
+            tune_index(vectorstore.index, self.index_config)
+        except Exception as e:
+            logger.error(f"Index load error for {doc_hash}: {str(e)}")
+            return None
+
+        with self._lock:
+            self._remember(doc_hash, vectorstore)
+        return vectorstore
+
+    def _remember(self, doc_hash: str, vectorstore: "FAISS") -> None:
+        self._open[doc_hash] = vectorstore
+        self._open.move_to_end(doc_hash)
+        while len(self._open) > self.max_open:
+            self._open.popitem(last=False)
+
+
+# Per-process state of ingestion workers; populated by _init_ingest_worker
+_worker_processor: Optional["PDFProcessor"] = None
+
+
+def _init_ingest_worker(embeddings_model_name: str, cache_dir: Optional[str], max_workers: int = 1) -> None:
+    """Load the embedding model once per worker process so jobs start warm."""
+    global _worker_processor
+    # Split the cores between workers instead of every worker starting one thread per core
+    os.environ.setdefault("EMBEDDING_THREADS", str(max(1, (os.cpu_count() or 1) // max_workers)))
+    _worker_processor = PDFProcessor(embeddings_model_name, cache_dir=cache_dir)
+    _worker_processor.embeddings.embed_query("warm up")
+
+
+def ingest_pdf_job(
+    pdf_file_bytes: bytes, doc_hash: str, index_root: str, source: str, basis: Iterable[str] = ()
+) -> Dict[str, Any]:
+    """Extract, split, embed and persist one PDF; runs inside an ingestion worker.
+
+    With dedup on, chunks near-identical to those of the ``basis`` indexes
+    (the other documents the new one will be searched with) are skipped.
+    Returns the index info (``char_count``, ``chunk_count``,
+    ``duplicate_chunks``) or ``{"error": ...}`` where the error is
+    ``"no_text"`` or ``"vector_store"``, plus the worker's ``metrics`` export.
+    """
+    processor = _worker_processor or PDFProcessor()
+    store = IndexStore(processor.embeddings, root=index_root, max_open=0)
+    known = None
+    if processor.dedup and basis:
+        signatures = [store.load_signatures(basis_hash) for basis_hash in basis]
+        signatures = [rows for rows in signatures if rows is not None and len(rows)]
+        known = np.concatenate(signatures) if signatures else None
+    result = processor.ingest_stream(pdf_file_bytes, {"source": source}, keep_text=True, known_signatures=known)
+    if not result.text.strip():
+        return {"error": "no_text", "metrics": metrics.export()}
+    if result.vectorstore is None:
+        # Every chunk was a near-duplicate of the basis documents: nothing new to index
+        error = "duplicate" if result.duplicate_chunks else "vector_store"
+        return {"error": error, "duplicate_chunks": result.duplicate_chunks, "metrics": metrics.export()}
+
+    info = {"char_count": result.char_count, "chunk_count": result.chunk_count, "duplicate_chunks": result.duplicate_chunks}
+    store.save(
+        doc_hash, result.vectorstore, result.text, info,
+        lexical_index=result.lexical_index, signatures=result.signatures,
+    )
+    # The worker's metrics travel back with the result; IngestionScheduler merges them
+    return {**info, "metrics": metrics.export()}
+
+
+class QueueFullError(Exception):
+    """Raised when the ingestion queue (global or per-user) has no room for another job."""
+
+
+class _IngestionJob:
+    def __init__(self, user_id: Any, task: Optional[asyncio.Task]):
+        self.user_id = user_id
+        self.task = task
+        self.turn: Optional[asyncio.Future] = None
+        self.holds_slot = False
+        self.future: Optional[Future] = None
+
+
+class IngestionScheduler:
+    """Runs CPU-bound ingestion jobs in a process pool behind bounded, cancellable queues.
+
+    At most ``max_workers`` jobs run at once; up to ``max_queue`` more wait in
+    FIFO order and each user may have ``max_per_user`` jobs pending. Worker
+    processes load the embedding model once at start-up.
+    """
+
+    def __init__(
+        self,
+        max_workers: int = 2,
+        max_queue: int = 16,
+        max_per_user: int = 1,
+        embeddings_model_name: str = "sentence-transformers/all-MiniLM-L6-v2",
+        cache_dir: Optional[str] = _CACHE_DIR_FROM_ENV,
+        position_update_interval: float = 2.0,
+    ):
+        cache_dir = _cache_dir_from_env(cache_dir)
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.max_per_user = max_per_user
+        self.position_update_interval = position_update_interval
+        # spawn rather than fork: forking a process that already runs torch threads can deadlock
+        self._executor = ProcessPoolExecutor(
+            max_workers=max_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_ingest_worker,
+            initargs=(embeddings_model_name, cache_dir, max_workers),
+        )
+        self._running = 0
+        self._waiting: "deque[_IngestionJob]" = deque()
+        self._user_jobs: Dict[Any, List[_IngestionJob]] = {}
+        metrics.gauge_callback("queue_depth", lambda: self.queue_depth, queue="ingestion")
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._waiting)
+
+    def queue_position(self, user_id: Any) -> Optional[int]:
+        """1-based position of the user's first waiting job, or None if nothing is waiting."""
+        for position, job in enumerate(self._waiting, start=1):
+            if job.user_id == user_id:
+                return position
+        return None
+
+    async def run(
+        self,
+        user_id: Any,
+        fn: Callable[..., Any],
+        *args: Any,
+        on_queued: Optional[Callable[[int], Awaitable[None]]] = None,
+        on_started: Optional[Callable[[], Awaitable[None]]] = None,
+    ) -> Any:
+        """Run ``fn(*args)`` in the pool once a slot is free.
+
+        ``on_queued`` is awaited with the job's queue position whenever it
+        changes; ``on_started`` once the job is handed to a worker. Raises
+        QueueFullError when there is no room and CancelledError if the job is
+        cancelled with ``cancel``.
+        """
+        if len(self._user_jobs.get(user_id, [])) >= self.max_per_user:
+            raise QueueFullError("user already has the maximum number of pending jobs")
+        if self._running >= self.max_workers and len(self._waiting) >= self.max_queue:
+            raise QueueFullError("ingestion queue is full")
+
+        loop = asyncio.get_running_loop()
+        job = _IngestionJob(user_id, asyncio.current_task())
+        self._user_jobs.setdefault(user_id, []).append(job)
+        try:
+            if self._running < self.max_workers:
+                self._running += 1
+                job.holds_slot = True
+            else:
+                job.turn = loop.create_future()
+                self._waiting.append(job)
+                last_position = None
+                while not job.turn.done():
+                    position = self._waiting.index(job) + 1
+                    if on_queued and position != last_position:
+                        await on_queued(position)
+                        last_position = position
+                    await asyncio.wait({job.turn}, timeout=self.position_update_interval)
+
+            if on_started:
+                await on_started()
+            job.future = self._executor.submit(fn, *args)
+            result = await asyncio.wrap_future(job.future)
+            # Jobs such as ingest_pdf_job hand back what they recorded in the worker process
+            if isinstance(result, dict) and "metrics" in result:
+                metrics.merge(result.pop("metrics"))
+            return result
+        finally:
+            if job in self._waiting:
+                self._waiting.remove(job)
+            if job.holds_slot:
+                if job.future is None:
+                    self._release()
+                else:
+                    # A cancelled caller stops waiting, but a job already inside a worker keeps
+                    # running; its slot is only free once the worker is
+                    job.future.add_done_callback(lambda _: self._release_threadsafe(loop))
+            jobs = self._user_jobs.get(user_id, [])
+            if job in jobs:
+                jobs.remove(job)
+            if not jobs:
+                self._user_jobs.pop(user_id, None)
+
+    def _release(self) -> None:
+        self._running -= 1
+        while self._waiting and self._running < self.max_workers:
+            job = self._waiting.popleft()
+            self._running += 1
+            job.holds_slot = True
+            job.turn.set_result(True)
+
+    def _release_threadsafe(self, loop: asyncio.AbstractEventLoop) -> None:
+        # Executor callbacks run on the executor's management thread
+        try:
+            loop.call_soon_threadsafe(self._release)
+        except RuntimeError:
+            pass  # the loop is closed; nothing is left to schedule
+
+    def cancel(self, user_id: Any) -> bool:
+        """Cancel every pending job of a user. A job already inside a worker finishes in the
+        background (its index is still saved) and keeps its worker slot until then, but its
+        caller stops waiting for it."""
+        jobs = self._user_jobs.get(user_id, [])
+        for job in jobs:
+            if job.task is not None:
+                job.task.cancel()
+        return bool(jobs)
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+TONE_PROMPTS = {
+    "formal": "Please summarize this document in a formal, professional tone:",
+    "casual": "Give me a relaxed, friendly summary of this document:",
+    "bullet": "Summarize this document using clear, concise bullet points:"
+}
+
+
+class DocumentSummarizer:
+    """Map-reduce summarizer covering the whole document.
+
+    The text is cut into large sections that are summarized concurrently (at
+    most ``max_workers`` LLM calls in flight); the partial summaries are then
+    combined hierarchically until one summary remains. Section summaries are
+    cached per (section hash, tone), so re-summarizing a document, or asking
+    for another tone after the reduce step, reuses the work already done.
+    """
+
+    def __init__(
+        self,
+        llm: LLM,
+        max_workers: int = 4,
+        section_size: int = 6000,
+        section_overlap: int = 200,
+        reduce_size: int = 8000,
+        cache_size: int = 2048,
+    ):
+        self.llm = llm
+        self.max_workers = max_workers
+        self.reduce_size = reduce_size
+        self.cache_size = cache_size
+        from langchain_text_splitters import RecursiveCharacterTextSplitter
+        self.splitter = RecursiveCharacterTextSplitter(
+            chunk_size=section_size,
+            chunk_overlap=section_overlap,
+            length_function=len,
+        )
+        self._partials: "OrderedDict[Tuple[str, str], str]" = OrderedDict()
+
+    @staticmethod
+    def _tone_prompt(tone: str) -> str:
+        return TONE_PROMPTS.get(tone, TONE_PROMPTS["formal"])
+
+    async def _ask(self, prompt: str, semaphore: asyncio.Semaphore) -> str:
+        # Summaries are long-running background work: let Q&A calls jump the queue
+        async with semaphore:
+            return await self.llm.ainvoke(prompt, priority=PRIORITY_BACKGROUND)
+
+    async def _summarize_section(self, section: str, index: int, total: int, tone: str, semaphore: asyncio.Semaphore) -> str:
+        key = (hashlib.sha256(section.encode("utf-8")).hexdigest(), tone)
+        cached = self._partials.get(key)
+        if cached is not None:
+            self._partials.move_to_end(key)
+            return cached
+
+        prompt = (
+            f"{self._tone_prompt(tone)}\n\n"
+            f"This is part {index} of {total} of a longer document. Summarize only this part, "
+            f"keeping key facts, figures and names.\n\n{section}"
+        )
+        summary = await self._ask(prompt, semaphore)
+        if not is_llm_error(summary):
+            self._partials[key] = summary
+            while len(self._partials) > self.cache_size:
+                self._partials.popitem(last=False)
+        return summary
+
+    def _group(self, summaries: List[str]) -> List[List[str]]:
+        """Pack consecutive summaries into groups that fit one reduce prompt."""
+        groups: List[List[str]] = [[]]
+        size = 0
+        for summary in summaries:
+            if groups[-1] and size + len(summary) > self.reduce_size:
+                groups.append([])
+                size = 0
+            groups[-1].append(summary)
+            size += len(summary)
+        return groups
+
+    def _combine_prompt(self, summaries: List[str], tone: str, final: bool) -> str:
+        instruction = "Combine them into a single summary of the whole document." if final else (
+            "Combine them into one summary of this stretch of the document, keeping key facts, figures and names."
+        )
+        joined = "\n\n".join(summaries)
+        return (
+            f"{self._tone_prompt(tone)}\n\n"
+            f"The text below consists of summaries of consecutive parts of one document. {instruction}\n\n{joined}"
+        )
+
+    async def asummarize(self, text: str, tone: str = "formal") -> str:
+        """Summarize the full text in the given tone ("formal", "casual" or "bullet")."""
+        sections = self.splitter.split_text(text)
+        if not sections:
+            return ""
+
+        semaphore = asyncio.Semaphore(self.max_workers)
+        if len(sections) == 1:
+            return await self._ask(f"{self._tone_prompt(tone)}\n\n{sections[0]}", semaphore)
+
+        summaries = await asyncio.gather(*(
+            self._summarize_section(section, index, len(sections), tone, semaphore)
+            for index, section in enumerate(sections, start=1)
+        ))
+
+        while True:
+            errors = [summary for summary in summaries if is_llm_error(summary)]
+            if errors:
+                return errors[0]
+
+            groups = self._group(summaries)
+            # Stop when everything fits, or when no two summaries fit together (another round would not shrink it)
+            if len(groups) == 1 or len(groups) == len(summaries):
+                return await self._ask(self._combine_prompt(summaries, tone, final=True), semaphore)
+
+            logger.info(f"Reducing {len(summaries)} partial summaries in {len(groups)} groups")
+            summaries = await asyncio.gather(*(
+                self._ask(self._combine_prompt(group, tone, final=False), semaphore) for group in groups
+            ))
+
+
+class DocumentCorpus:
+    """FAISS index over many documents that can grow and shrink one document at a time.
+
+    Every chunk's docstore id is tracked per ``source`` so a document's
+    vectors can be deleted, and adding a document built elsewhere (e.g. an
+    ``IndexStore`` index or an ``ingest_stream`` result) copies its vectors
+    rather than re-embedding the text. The index is rebuilt as a larger
+    ``IndexConfig`` type as the corpus grows. A BM25 ``LexicalIndex`` over the
+    same ids backs ``hybrid_search``.
+
+    Read-only memory-mapped stores (``IndexStore.load``) are not copied: they
+    are searched in place next to the corpus's own index and the results
+    merged by distance, so sessions over the same document share its vectors
+    and chunk texts.
+    """
+
+    def __init__(
+        self,
+        embeddings: Embeddings,
+        vectorstore: Optional["FAISS"] = None,
+        index_config: Optional[IndexConfig] = None,
+    ):
+        self.embeddings = embeddings
+        # The corpus's own index is appended to, so a read-only loaded store is copied
+        self.vectorstore = writable_vectorstore(vectorstore) if vectorstore is not None else None
+        self.index_config = index_config or IndexConfig()
+        self.lexical = LexicalIndex()
+        self._ids: Dict[str, Any] = {}  # source -> list of ids, or a shared store's ChunkIds
+        self._shared: Dict[str, "FAISS"] = {}  # source -> memory-mapped store searched in place
+        self._signatures: Dict[str, np.ndarray] = {}  # source -> MinHash of its chunks, for ingest dedup
+        if self.vectorstore is not None:
+            for doc_id in self.vectorstore.index_to_docstore_id.values():
+                doc = self.vectorstore.docstore.search(doc_id)
+                self._ids.setdefault(doc.metadata.get("source", ""), []).append(doc_id)
+                self.lexical.add([doc_id], [doc.page_content])
+
+    @property
+    def sources(self) -> List[str]:
+        return list(self._ids)
+
+    def __contains__(self, source: str) -> bool:
+        return source in self._ids
+
+    def __len__(self) -> int:
+        return sum(len(ids) for ids in self._ids.values())
+
+    def _add_embeddings(self, source: str, texts: List[str], vectors: Any, metadatas: List[dict]) -> List[str]:
+        ids = [str(uuid.uuid4()) for _ in texts]
+        metadatas = [{**metadata, "source": source} for metadata in metadatas]
+        pairs = list(zip(texts, (list(map(float, vector)) for vector in vectors)))
+        if self.vectorstore is None:
+            from langchain_community.vectorstores import FAISS
+            self.vectorstore = FAISS.from_embeddings(pairs, self.embeddings, metadatas=metadatas, ids=ids)
+        else:
+            self.vectorstore.add_embeddings(pairs, metadatas=metadatas, ids=ids)
+        self._ids.setdefault(source, []).extend(ids)
+        optimize_vectorstore(self.vectorstore, self.index_config)
+        return ids
+
+    def add_vectorstore(
+        self,
+        source: str,
+        vectorstore: "FAISS",
+        lexical_index: Optional[LexicalIndex] = None,
+        signatures: Optional[np.ndarray] = None,
+    ) -> int:
+        """Add every chunk of another store under ``source`` (replacing an earlier version); returns the chunk count.
+
+        ``lexical_index`` is the store's own BM25 index (from ``ingest_stream`` or
+        ``IndexStore.load_lexical``); its postings are reused instead of re-tokenizing.
+        A ``MappedDocstore`` store is referenced rather than copied. ``signatures``
+        (``IngestionResult.signatures``) are kept for ``signatures()``.
+        """
+        if source in self:
+            self.remove(source)
+        if signatures is not None:
+            self._signatures[source] = signatures
+        count = vectorstore.index.ntotal
+        if not count:
+            return 0
+        if isinstance(vectorstore.docstore, MappedDocstore):
+            ids = vectorstore.docstore.ids
+            self._shared[source] = vectorstore
+            self._ids[source] = ids
+            if lexical_index is not None and len(lexical_index) == count and lexical_index.doc_ids[0] == ids[0]:
+                self.lexical.extend(lexical_index)
+            else:
+                self.lexical.add(list(ids), [vectorstore.docstore.document(i).page_content for i in range(count)])
+            return count
+        vectors = index_vectors(vectorstore.index)
+        store_ids = [vectorstore.index_to_docstore_id[i] for i in range(count)]
+        docs = [vectorstore.docstore.search(doc_id) for doc_id in store_ids]
+        texts = [doc.page_content for doc in docs]
+        ids = self._add_embeddings(source, texts, vectors, [doc.metadata for doc in docs])
+        if lexical_index is not None and sorted(lexical_index.doc_ids) == sorted(store_ids):
+            self.lexical.extend(lexical_index, rename=dict(zip(store_ids, ids)))
+        else:
+            self.lexical.add(ids, texts)
+        return count
+
+    def signatures(self) -> Optional[np.ndarray]:
+        """MinHash signatures of the chunks indexed so far, for ``ingest_stream(known_signatures=...)``.
+
+        Covers documents added with ``signatures``; None when there are none.
+        """
+        kept = [rows for source, rows in self._signatures.items() if source in self._ids and len(rows)]
+        return np.concatenate(kept) if kept else None
+
+    def add_documents(self, source: str, documents: List[Document]) -> int:
+        """Embed and add chunks under ``source`` (replacing an earlier version); returns the chunk count."""
+        if source in self:
+            self.remove(source)
+        if not documents:
+            return 0
+        texts = [doc.page_content for doc in documents]
+        ids = self._add_embeddings(source, texts, self.embeddings.embed_documents(texts), [doc.metadata for doc in documents])
+        self.lexical.add(ids, texts)
+        return len(documents)
+
+    def remove(self, source: str) -> bool:
+        """Delete a document's vectors; returns False if it was not in the corpus."""
+        ids = self._ids.pop(source, None)
+        self._signatures.pop(source, None)
+        if ids is None:
+            return False
+        if not self._ids:
+            # FAISS cannot represent an empty store without a dimension; start over on the next add
+            self.vectorstore = None
+            self._shared = {}
+            self.lexical = LexicalIndex()
+            return True
+        self.lexical.remove(ids)
+        if self._shared.pop(source, None) is not None:
+            return True
+        if all(other in self._shared for other in self._ids):
+            self.vectorstore = None
+            return True
+        if index_type_of(self.vectorstore.index) == "flat":
+            self.vectorstore.delete(ids)
+        else:
+            self._rebuild_without(set(ids))
+        return True
+
+    def _rebuild_without(self, removed: set) -> None:
+        """Drop vectors from an approximate index by rebuilding it from the rest.
+
+        HNSW cannot remove vectors, and IVF keeps ids sparse after removal while
+        the LangChain store assumes contiguous positions.
+        """
+        store = self.vectorstore
+        keep = [i for i in range(store.index.ntotal) if store.index_to_docstore_id[i] not in removed]
+        vectors = index_vectors(store.index)[keep]
+        store.docstore.delete(list(removed))
+        store.index = build_faiss_index(vectors, self.index_config)
+        store.index_to_docstore_id = {new: store.index_to_docstore_id[old] for new, old in enumerate(keep)}
+
+    def search_by_vector(self, vector: List[float], k: int = 3, sources: Optional[Iterable[str]] = None) -> List[Document]:
+        """Top-``k`` chunks for a query vector, optionally restricted to some ``source`` values."""
+        return self.search_by_vectors([vector], k, sources)[0]
+
+    def search_by_vectors(
+        self, vectors: List[List[float]], k: int = 3, sources: Optional[Iterable[str]] = None
+    ) -> List[List[Document]]:
+        """``search_by_vector`` for several query vectors with one FAISS search over the whole batch.
+
+        The corpus's own index and each shared store are searched once; their
+        hits are merged by distance.
+        """
+        if not vectors or (self.vectorstore is None and not self._shared):
+            return [[] for _ in vectors]
+        wanted = set(sources) if sources else None
+        queries = np.asarray(vectors, dtype=np.float32)
+        hits: List[List[Tuple[float, Document]]] = [[] for _ in vectors]
+        if self.vectorstore is not None:
+            own = [source for source in self._ids if source not in self._shared]
+            selected = sum(len(self._ids[source]) for source in own if wanted is None or source in wanted)
+            if selected:
+                for row, found in zip(hits, self._search_store(self.vectorstore, queries, k, wanted, selected)):
+                    row.extend(found)
+        for source, store in self._shared.items():
+            if wanted is None or source in wanted:
+                for row, found in zip(hits, self._search_store(store, queries, k)):
+                    row.extend(found)
+        return [[doc for _, doc in sorted(row, key=lambda hit: hit[0])[:k]] for row in hits]
+
+    @staticmethod
+    def _search_store(
+        store: "FAISS", queries: np.ndarray, k: int, wanted: Optional[set] = None, selected: int = 0
+    ) -> List[List[Tuple[float, Document]]]:
+        """Top-``k`` ``(distance, chunk)`` pairs per query in one store, keeping ``wanted`` sources only."""
+        total = store.index.ntotal
+        fetch_k = k
+        if wanted is not None:
+            # The filter is applied after the search, so over-fetch in proportion to how much is filtered out
+            fetch_k = max(k * 4, -(-k * total // selected) * 4)
+        if store._normalize_L2:
+            import faiss
+            queries = queries.copy()
+            faiss.normalize_L2(queries)
+        distances, positions = store.index.search(queries, min(total, fetch_k))
+        results = []
+        for row_distances, row in zip(distances, positions):
+            docs = []
+            for distance, position in zip(row_distances, row):
+                if position == -1:
+                    continue
+                doc = store.docstore.search(store.index_to_docstore_id[position])
+                if wanted is None or doc.metadata.get("source") in wanted:
+                    docs.append((float(distance), doc))
+                    if len(docs) == k:
+                        break
+            results.append(docs)
+        return results
+
+    def search(self, query: str, k: int = 3, sources: Optional[Iterable[str]] = None) -> List[Document]:
+        return self.search_by_vector(self.embeddings.embed_query(query), k, sources)
+
+    def hybrid_search_by_vector(
+        self,
+        query: str,
+        vector: List[float],
+        k: int = 3,
+        sources: Optional[Iterable[str]] = None,
+        fetch_k: int = 20,
+        lexical_floor: float = 0.25,
+    ) -> List[Document]:
+        """Top-``k`` chunks by reciprocal rank fusion of dense and BM25 rankings.
+
+        Dense similarity finds paraphrases while BM25 catches exact terms such
+        as part numbers, clause ids and names that embeddings blur together.
+        BM25 hits scoring under ``lexical_floor`` of the best one only matched
+        common words and are left out so they do not outvote a rare-term match.
+        """
+        return self.hybrid_search_by_vectors([query], [vector], k, sources, fetch_k, lexical_floor)[0]
+
+    def hybrid_search_by_vectors(
+        self,
+        queries: List[str],
+        vectors: List[List[float]],
+        k: int = 3,
+        sources: Optional[Iterable[str]] = None,
+        fetch_k: int = 20,
+        lexical_floor: float = 0.25,
+    ) -> List[List[Document]]:
+        """``hybrid_search_by_vector`` for a batch; the dense half is one ``search_by_vectors`` call."""
+        if self.vectorstore is None and not self._shared:
+            return [[] for _ in queries]
+        fetch_k = max(fetch_k, k)
+        doc_ids = [doc_id for source in sources for doc_id in self._ids.get(source, [])] if sources else None
+        results = []
+        for query, dense in zip(queries, self.search_by_vectors(vectors, fetch_k, sources)):
+            lexical = self.lexical.search(query, fetch_k, doc_ids, min_ratio=lexical_floor)
+            by_id = {doc.id: doc for doc in dense}
+            fused = reciprocal_rank_fusion([[doc.id for doc in dense], [doc_id for doc_id, _ in lexical]])
+            results.append([by_id.get(doc_id) or self._document(doc_id) for doc_id, _ in fused[:k]])
+        return results
+
+    def _document(self, doc_id: str) -> Document:
+        for store in self._shared.values():
+            position = store.docstore.ids.position(doc_id)
+            if position is not None:
+                return store.docstore.document(position)
+        return self.vectorstore.docstore.search(doc_id)
+
+    def hybrid_search(self, query: str, k: int = 3, sources: Optional[Iterable[str]] = None) -> List[Document]:
+        return self.hybrid_search_by_vector(query, self.embeddings.embed_query(query), k, sources)
+
+
+# Context windows (tokens) of models used through OpenRouter; others get DEFAULT_CONTEXT_TOKENS
+MODEL_CONTEXT_TOKENS = {
+    "meta-llama/llama-3.3-8b-instruct:free": 128_000,
+    "meta-llama/llama-3.3-70b-instruct": 128_000,
+    "meta-llama/llama-3.1-8b-instruct": 128_000,
+    "mistralai/mistral-7b-instruct": 32_768,
+    "google/gemma-2-9b-it": 8_192,
+    "openai/gpt-4o-mini": 128_000,
+}
+DEFAULT_CONTEXT_TOKENS = 8_192
+
+
+class ContextAssembler:
+    """Turns retrieved chunks into the context of one "stuff" prompt.
+
+    Chunks that overlap (the splitter's shared margins, or neighbouring
+    windows) are merged, near-duplicates are dropped, and the rest are taken
+    in relevance order while they fit ``budget_tokens``. The kept chunks are
+    then interleaved so the most relevant sit at the start and the end of the
+    context, where models use it best.
+    """
+
+    def __init__(
+        self,
+        budget_tokens: int = 3000,
+        fetch_k: int = 20,
+        duplicate_threshold: float = 0.8,
+        encoding_name: str = "cl100k_base",
+    ):
+        self.budget_tokens = budget_tokens
+        self.fetch_k = fetch_k
+        self.duplicate_threshold = duplicate_threshold
+        self.encoding_name = encoding_name
+        self._encoding: Any = None
+
+    @classmethod
+    def for_model(
+        cls,
+        model: str,
+        budget_tokens: Optional[int] = None,
+        reserve_tokens: int = 1500,
+        **kwargs: Any,
+    ) -> "ContextAssembler":
+        """Assembler whose budget also leaves ``reserve_tokens`` of ``model``'s window for the prompt and answer.
+
+        ``budget_tokens`` defaults to ``CONTEXT_TOKEN_BUDGET``.
+        """
+        if budget_tokens is None:
+            budget_tokens = int(os.getenv("CONTEXT_TOKEN_BUDGET", "3000"))
+        window = MODEL_CONTEXT_TOKENS.get(model, DEFAULT_CONTEXT_TOKENS)
+        return cls(budget_tokens=max(256, min(budget_tokens, window - reserve_tokens)), **kwargs)
+
+    def count_tokens(self, texts: List[str]) -> List[int]:
+        if self._encoding is None:
+            try:
+                self._encoding = get_token_encoding(self.encoding_name)
+            except Exception as e:
+                # tiktoken downloads encodings on first use; estimate rather than fail offline
+                logger.warning(f"Token encoding unavailable, estimating 4 characters per token: {str(e)}")
+                self._encoding = False
+        if self._encoding is False:
+            return [len(text) // 4 + 1 for text in texts]
+        return [len(tokens) for tokens in self._encoding.encode_ordinary_batch(texts)]
+
+    @staticmethod
+    def _overlap(first: str, second: str, min_chars: int = 20) -> int:
+        """Length of the longest suffix of ``first`` that ``second`` starts with (0 if under ``min_chars``)."""
+        probe = second[:min_chars]
+        if len(probe) < min_chars:
+            return 0
+        start = first.find(probe, max(0, len(first) - len(second)))
+        while start != -1:
+            if second.startswith(first[start:]):
+                return len(first) - start
+            start = first.find(probe, start + 1)
+        return 0
+
+    @staticmethod
+    def _shingles(text: str) -> set:
+        words = text.lower().split()
+        return {" ".join(words[i:i + 3]) for i in range(max(1, len(words) - 2))}
+
+    def _merge(self, kept: List[Document], doc: Document) -> bool:
+        """Fold ``doc`` into a kept chunk of the same source it overlaps with; False if none."""
+        for i, other in enumerate(kept):
+            if other.metadata.get("source") != doc.metadata.get("source"):
+                continue
+            if doc.page_content in other.page_content:
+                return True
+            if other.page_content in doc.page_content:
+                text = doc.page_content
+            elif self._overlap(other.page_content, doc.page_content):
+                text = other.page_content + doc.page_content[self._overlap(other.page_content, doc.page_content):]
+            elif self._overlap(doc.page_content, other.page_content):
+                text = doc.page_content + other.page_content[self._overlap(doc.page_content, other.page_content):]
+            else:
+                continue
+            metadata = dict(other.metadata)
+            if "start_index" in metadata and "start_index" in doc.metadata:
+                metadata["start_index"] = min(metadata["start_index"], doc.metadata["start_index"])
+                metadata["end_index"] = max(metadata["end_index"], doc.metadata["end_index"])
+            metadata.pop("tokens", None)
+            kept[i] = Document(page_content=text, metadata=metadata, id=other.id)
+            return True
+        return False
+
+    def assemble(self, docs: List[Document]) -> Tuple[List[Document], int]:
+        """Deduplicated chunks that fit the budget, in prompt order, and their total tokens; ``docs`` best first."""
+        kept: List[Document] = []
+        for doc in docs:
+            if not self._merge(kept, doc):
+                kept.append(doc)
+
+        unique: List[Document] = []
+        shingles: List[set] = []
+        for doc in kept:
+            doc_shingles = self._shingles(doc.page_content)
+            if any(len(doc_shingles & other) / len(doc_shingles | other) >= self.duplicate_threshold for other in shingles):
+                continue
+            unique.append(doc)
+            shingles.append(doc_shingles)
+
+        packed: List[Document] = []
+        total = 0
+        for doc, tokens in zip(unique, self.count_tokens([doc.page_content for doc in unique])):
+            # The stuff chain joins chunks with a blank line, one more token each
+            if packed and total + tokens + 1 > self.budget_tokens:
+                continue
+            packed.append(doc)
+            total += tokens + 1
+
+        # Best first, second best last, the weakest in the middle
+        ordered = packed[0::2] + packed[1::2][::-1]
+        return ordered, total
+
+
+BATCH_QA_PROMPT = """Use the following pieces of context to answer the numbered questions at the end. If you don't know an answer, just say that you don't know, don't try to make up an answer.
+
+{context}
+
+Questions:
+{questions}
+
+Answer every question in order. Start each answer on a new line with the question's number, like "1. ...".
+Helpful Answers:"""
+
+_NUMBERED_ANSWER = re.compile(r"^[ \t>*#_]*(?:answer\s*)?(\d+)\s*[.):]\**[ \t]*", re.IGNORECASE | re.MULTILINE)
+
+
+def split_numbered_answers(text: str, count: int) -> List[Optional[str]]:
+    """Answers 1..``count`` picked out of a reply to ``BATCH_QA_PROMPT`` (None where one is missing)."""
+    answers: List[Optional[str]] = [None] * count
+    marks = [m for m in _NUMBERED_ANSWER.finditer(text) if 1 <= int(m.group(1)) <= count]
+    for mark, following in zip(marks, marks[1:] + [None]):
+        index = int(mark.group(1)) - 1
+        answer = text[mark.end():following.start() if following else len(text)].strip()
+        if answers[index] is None and answer:
+            answers[index] = answer
+    return answers
+
+
+@dataclass
+class QAResult:
+    """Answer to one question with its sources and where the time went."""
+
+    answer: str
+    sources: List[Document]
+    retrieval_time: float = 0.0
+    generation_time: float = 0.0
+    cached: bool = False
+    context_tokens: int = 0
+    time_to_first_token: Optional[float] = None  # after retrieval; only when streamed
+
+
+class QAEngine:
+    """Question answering over a document corpus with the "stuff" chain built once.
+
+    Create one per corpus and keep it for the session; ``answer`` / ``aanswer``
+    only embed the question, search and run the prebuilt chain. Retrieval is
+    hybrid (dense + BM25) unless ``hybrid=False``. With an ``assembler`` the
+    top ``assembler.fetch_k`` chunks are retrieved and packed into its token
+    budget instead of stuffing exactly ``k``.
+    """
+
+    def __init__(
+        self,
+        corpus: DocumentCorpus,
+        llm: LLM,
+        k: int = 3,
+        response_cache: Optional[ResponseCache] = None,
+        namespace: Optional[str] = None,
+        hybrid: bool = True,
+        assembler: Optional[ContextAssembler] = None,
+    ):
+        self.corpus = corpus
+        self.llm = llm
+        self.k = k
+        self.hybrid = hybrid
+        self.assembler = assembler
+        self.response_cache = response_cache
+        self.namespace = namespace or str(id(corpus))
+        self.embeddings = corpus.embeddings
+        # Retrieval is done here (so k and the source filter can vary per call); only the prompt-filling chain is reused
+        from langchain.chains.combine_documents import create_stuff_documents_chain
+        from langchain.chains.question_answering.stuff_prompt import PROMPT_SELECTOR
+        self._combine_chain = create_stuff_documents_chain(llm, PROMPT_SELECTOR.get_prompt(llm))
+
+    def _embed_questions(self, questions: List[str]) -> List[List[float]]:
+        # One encoder pass for the whole batch, kept out of the chunk embedding cache
+        embed_queries = getattr(self.embeddings, "embed_queries", self.embeddings.embed_documents)
+        return embed_queries(questions)
+
+    def _cache_namespace(self, sources: Optional[Iterable[str]]) -> str:
+        return f"{self.namespace}|{'|'.join(sorted(sources))}" if sources else self.namespace
+
+    def _cached(self, question_vector: List[float], sources: Optional[Iterable[str]]) -> Optional[QAResult]:
+        if self.response_cache is None:
+            return None
+        cached = self.response_cache.get_similar(self._cache_namespace(sources), question_vector)
+        if cached is None:
+            return None
+        answer, source_docs = cached
+        return QAResult(answer=answer, sources=source_docs, cached=True)
+
+    def _remember(self, question_vector: List[float], sources: Optional[Iterable[str]], result: QAResult) -> None:
+        if self.response_cache is not None and not is_llm_error(result.answer):
+            self.response_cache.put_similar(self._cache_namespace(sources), question_vector, (result.answer, result.sources))
+
+    def _search_batch(
+        self, questions: List[str], question_vectors: List[List[float]], k: int, sources: Optional[List[str]]
+    ) -> List[List[Document]]:
+        if self.assembler is not None:
+            k = max(k, self.assembler.fetch_k)
+        with timed("retrieval_seconds", mode="hybrid" if self.hybrid else "dense"):
+            if self.hybrid:
+                return self.corpus.hybrid_search_by_vectors(questions, question_vectors, k, sources)
+            return self.corpus.search_by_vectors(question_vectors, k, sources)
+
+    def _assemble(self, docs: List[Document]) -> Tuple[List[Document], int]:
+        """Context chunks in prompt order and their token count (0 when not assembled)."""
+        if self.assembler is None:
+            return docs, 0
+        docs, tokens = self.assembler.assemble(docs)
+        metrics.observe("context_tokens", tokens)
+        return docs, tokens
+
+    def _retrieve(
+        self, question: str, question_vector: List[float], k: int, sources: Optional[List[str]]
+    ) -> Tuple[List[Document], int]:
+        """Context chunks for a question and their token count (0 when not assembled)."""
+        return self._assemble(self._search_batch([question], [question_vector], k, sources)[0])
+
+    def _pooled_prompt(self, questions: List[str], ranked: List[List[Document]]) -> Tuple[str, int]:
+        """``BATCH_QA_PROMPT`` over the questions' chunks, taken round-robin by rank, and its context tokens."""
+        pooled, seen = [], set()
+        for rank in range(max(len(docs) for docs in ranked)):
+            for docs in ranked:
+                if rank < len(docs) and docs[rank].id not in seen:
+                    seen.add(docs[rank].id)
+                    pooled.append(docs[rank])
+        docs, context_tokens = self._assemble(pooled)
+        numbered = "\n".join(f"{number}. {question}" for number, question in enumerate(questions, start=1))
+        context = "\n\n".join(doc.page_content for doc in docs)
+        return BATCH_QA_PROMPT.format(context=context, questions=numbered), context_tokens
+
+    async def aanswer(
+        self,
+        question: str,
+        k: Optional[int] = None,
+        sources: Optional[List[str]] = None,
+        on_token: Optional[Callable[[str], Awaitable[None]]] = None,
+    ) -> QAResult:
+        """Answer a question from the ``k`` most similar chunks, optionally only from some sources.
+
+        With ``on_token`` the answer is streamed: the callback gets the answer
+        so far after every received chunk.
+        """
+        start = time.perf_counter()
+        question_vector = await self.embeddings.aembed_query(question)
+        cached = self._cached(question_vector, sources)
+        if cached is not None:
+            cached.retrieval_time = time.perf_counter() - start
+            return cached
+
+        docs, context_tokens = await asyncio.to_thread(self._retrieve, question, question_vector, k or self.k, sources)
+        retrieved = time.perf_counter()
+        first_token = None
+        failed = False
+        if on_token is None:
+            answer = await self._combine_chain.ainvoke({"context": docs, "question": question})
+        else:
+            answer = ""
+            try:
+                async for chunk in self._combine_chain.astream({"context": docs, "question": question}):
+                    if first_token is None:
+                        first_token = time.perf_counter() - retrieved
+                    answer += chunk
+                    await on_token(answer)
+            except LLMStreamError as e:
+                # The cut-off answer is shown with the error but never cached
+                answer = f"{e.partial}\n\n{e.error}"
+                failed = True
+                await on_token(answer)
+        result = QAResult(
+            answer=answer,
+            sources=docs,
+            retrieval_time=retrieved - start,
+            generation_time=time.perf_counter() - retrieved,
+            context_tokens=context_tokens,
+            time_to_first_token=first_token,
+        )
+        if not failed:
+            self._remember(question_vector, sources, result)
+        return result
+
+    async def abatch_answer(
+        self,
+        questions: List[str],
+        k: Optional[int] = None,
+        sources: Optional[List[str]] = None,
+        combined: bool = False,
+    ) -> List[QAResult]:
+        """Answer several questions with one embedding batch and one vectorized index search.
+
+        The answers are then generated concurrently (the ``LLMScheduler``
+        limits and coalesces the calls), or with ``combined=True`` from a
+        single prompt holding every question and their pooled context; any
+        question missing from the combined reply is asked on its own.
+        """
+        start = time.perf_counter()
+        question_vectors = await asyncio.to_thread(self._embed_questions, questions)
+        results: List[Optional[QAResult]] = [self._cached(vector, sources) for vector in question_vectors]
+        pending = [i for i, result in enumerate(results) if result is None]
+        for result in results:
+            if result is not None:
+                result.retrieval_time = time.perf_counter() - start
+        if not pending:
+            return results
+
+        pending_questions = [questions[i] for i in pending]
+        ranked = await asyncio.to_thread(
+            self._search_batch, pending_questions, [question_vectors[i] for i in pending], k or self.k, sources
+        )
+        contexts = [self._assemble(docs) for docs in ranked]
+        retrieved = time.perf_counter()
+
+        answers: List[Optional[str]] = [None] * len(pending)
+        pooled_tokens = 0
+        if combined and len(pending) > 1:
+            prompt, pooled_tokens = self._pooled_prompt(pending_questions, ranked)
+            reply = await self.llm.ainvoke(prompt)
+            if not is_llm_error(reply):
+                answers = split_numbered_answers(reply, len(pending))
+        missing = [j for j, answer in enumerate(answers) if answer is None]
+        for j, answer in zip(missing, await asyncio.gather(*(
+            self._combine_chain.ainvoke({"context": contexts[j][0], "question": pending_questions[j]}) for j in missing
+        ))):
+            answers[j] = answer
+
+        generation_time = time.perf_counter() - retrieved
+        for j, i in enumerate(pending):
+            results[i] = QAResult(
+                answer=answers[j],
+                sources=contexts[j][0],
+                retrieval_time=retrieved - start,
+                generation_time=generation_time,
+                context_tokens=contexts[j][1] if j in missing else pooled_tokens,
+            )
+            self._remember(question_vectors[i], sources, results[i])
+        return results
+
+    def batch_answer(
+        self,
+        questions: List[str],
+        k: Optional[int] = None,
+        sources: Optional[List[str]] = None,
+        combined: bool = False,
+    ) -> List[QAResult]:
+        """Synchronous version of ``abatch_answer``; separate answers run on the chain's thread pool."""
+        start = time.perf_counter()
+        question_vectors = self._embed_questions(questions)
+        results: List[Optional[QAResult]] = [self._cached(vector, sources) for vector in question_vectors]
+        pending = [i for i, result in enumerate(results) if result is None]
+        for result in results:
+            if result is not None:
+                result.retrieval_time = time.perf_counter() - start
+        if not pending:
+            return results
+
+        pending_questions = [questions[i] for i in pending]
+        ranked = self._search_batch(pending_questions, [question_vectors[i] for i in pending], k or self.k, sources)
+        contexts = [self._assemble(docs) for docs in ranked]
+        retrieved = time.perf_counter()
+
+        answers: List[Optional[str]] = [None] * len(pending)
+        pooled_tokens = 0
+        if combined and len(pending) > 1:
+            prompt, pooled_tokens = self._pooled_prompt(pending_questions, ranked)
+            reply = self.llm.invoke(prompt)
+            if not is_llm_error(reply):
+                answers = split_numbered_answers(reply, len(pending))
+        missing = [j for j, answer in enumerate(answers) if answer is None]
+        if missing:
+            for j, answer in zip(missing, self._combine_chain.batch([
+                {"context": contexts[j][0], "question": pending_questions[j]} for j in missing
+            ])):
+                answers[j] = answer
+
+        generation_time = time.perf_counter() - retrieved
+        for j, i in enumerate(pending):
+            results[i] = QAResult(
+                answer=answers[j],
+                sources=contexts[j][0],
+                retrieval_time=retrieved - start,
+                generation_time=generation_time,
+                context_tokens=contexts[j][1] if j in missing else pooled_tokens,
+            )
+            self._remember(question_vectors[i], sources, results[i])
+        return results
+
+    def answer(self, question: str, k: Optional[int] = None, sources: Optional[List[str]] = None) -> QAResult:
+        """Synchronous version of ``aanswer``."""
+        start = time.perf_counter()
+        question_vector = self.embeddings.embed_query(question)
+        cached = self._cached(question_vector, sources)
+        if cached is not None:
+            cached.retrieval_time = time.perf_counter() - start
+            return cached
+
+        docs, context_tokens = self._retrieve(question, question_vector, k or self.k, sources)
+        retrieved = time.perf_counter()
+        answer = self._combine_chain.invoke({"context": docs, "question": question})
+        result = QAResult(
+            answer=answer,
+            sources=docs,
+            retrieval_time=retrieved - start,
+            generation_time=time.perf_counter() - retrieved,
+            context_tokens=context_tokens,
+        )
+        self._remember(question_vector, sources, result)
+        return result
+
+
+class SessionStore(ABC):
+    """Per-user session storage interface used by the Telegram bot.
+
+    Sessions are small dicts. The fields in ``FIELDS`` are stored as
+    structured columns by persistent backends and any other small keys as
+    JSON; large values go through ``put_blob``/``get_blob`` and are never
+    loaded by ``get``. Sessions expire ``ttl`` seconds after their last save.
+    """
+
+    FIELDS = ("status", "pdf_name", "char_count", "chunk_count", "doc_hash")
+    NEW_SESSION = {"status": "new"}
+
+    def __init__(self, ttl: float = 7 * 24 * 3600):
+        self.ttl = ttl
+        self._locks: "weakref.WeakValueDictionary[Any, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+    def lock(self, user_id: Any) -> asyncio.Lock:
+        """Lock serialising read-modify-write sequences on one user's session."""
+        lock = self._locks.get(user_id)
+        if lock is None:
+            lock = asyncio.Lock()
+            self._locks[user_id] = lock
+        return lock
+
+    @abstractmethod
+    def get(self, user_id: Any) -> Dict[str, Any]:
+        ...
+
+    @abstractmethod
+    def save(self, user_id: Any, session: Dict[str, Any]) -> None:
+        ...
+
+    @abstractmethod
+    def delete(self, user_id: Any) -> None:
+        ...
+
+    @abstractmethod
+    def put_blob(self, user_id: Any, key: str, value: bytes) -> None:
+        ...
+
+    @abstractmethod
+    def get_blob(self, user_id: Any, key: str) -> Optional[bytes]:
+        ...
+
+    @abstractmethod
+    def purge_expired(self) -> int:
+        """Drop expired sessions; returns how many were removed."""
+
+    def close(self) -> None:
+        pass
+
+
+class MemorySessionStore(SessionStore):
+    """In-process session store; fastest, but lost on restart."""
+
+    def __init__(self, ttl: float = 7 * 24 * 3600, max_sessions: int = 100_000):
+        super().__init__(ttl)
+        self.max_sessions = max_sessions
+        self._sessions: "OrderedDict[str, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+        self._blobs: Dict[Tuple[str, str], bytes] = {}
+        self._lock = threading.Lock()
+
+    def get(self, user_id: Any) -> Dict[str, Any]:
+        key = str(user_id)
+        with self._lock:
+            entry = self._sessions.get(key)
+            if entry is None or entry[0] < time.time():
+                return dict(self.NEW_SESSION)
+            self._sessions.move_to_end(key)
+            return dict(entry[1])
+
+    def contains(self, user_id: Any) -> bool:
+        entry = self._sessions.get(str(user_id))
+        return entry is not None and entry[0] >= time.time()
+
+    def save(self, user_id: Any, session: Dict[str, Any]) -> None:
+        key = str(user_id)
+        with self._lock:
+            self._sessions[key] = (time.time() + self.ttl, dict(session))
+            self._sessions.move_to_end(key)
+            while len(self._sessions) > self.max_sessions:
+                evicted, _ = self._sessions.popitem(last=False)
+                self._drop_blobs(evicted)
+
+    def delete(self, user_id: Any) -> None:
+        key = str(user_id)
+        with self._lock:
+            self._sessions.pop(key, None)
+            self._drop_blobs(key)
+
+    def _drop_blobs(self, key: str) -> None:
+        for blob_key in [blob_key for blob_key in self._blobs if blob_key[0] == key]:
+            del self._blobs[blob_key]
+
+    def put_blob(self, user_id: Any, key: str, value: bytes) -> None:
+        with self._lock:
+            self._blobs[(str(user_id), key)] = value
+
+    def get_blob(self, user_id: Any, key: str) -> Optional[bytes]:
+        return self._blobs.get((str(user_id), key))
+
+    def purge_expired(self) -> int:
+        now = time.time()
+        with self._lock:
+            expired = [key for key, (expires, _) in self._sessions.items() if expires < now]
+            for key in expired:
+                del self._sessions[key]
+                self._drop_blobs(key)
+        return len(expired)
+
+
+class SQLiteSessionStore(SessionStore):
+    """Persistent session store on SQLite in WAL mode (concurrent readers, one writer).
+
+    Each thread gets its own connection. Structured fields are columns, other
+    small keys a JSON column, and blobs live in a separate table.
+    """
+
+    def __init__(self, path: str = "user_sessions.sqlite3", ttl: float = 7 * 24 * 3600):
+        super().__init__(ttl)
+        self.path = path
+        self._local = threading.local()
+        db = self._db()
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            "user_id TEXT PRIMARY KEY, status TEXT, pdf_name TEXT, char_count INTEGER, "
+            "chunk_count INTEGER, doc_hash TEXT, extra TEXT, expires_at REAL NOT NULL)"
+        )
+        db.execute("CREATE INDEX IF NOT EXISTS sessions_expires_at ON sessions(expires_at)")
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS session_blobs ("
+            "user_id TEXT NOT NULL, key TEXT NOT NULL, value BLOB NOT NULL, PRIMARY KEY (user_id, key))"
+        )
+        db.commit()
+
+    def _db(self) -> sqlite3.Connection:
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30)
+            db.execute("PRAGMA journal_mode=WAL")
+            # WAL keeps committed data safe with NORMAL sync while avoiding an fsync per write
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+        return db
+
+    def get(self, user_id: Any) -> Dict[str, Any]:
+        row = self._db().execute(
+            f"SELECT {', '.join(self.FIELDS)}, extra FROM sessions WHERE user_id = ? AND expires_at >= ?",
+            (str(user_id), time.time()),
+        ).fetchone()
+        if row is None:
+            return dict(self.NEW_SESSION)
+        session = {field: value for field, value in zip(self.FIELDS, row) if value is not None}
+        if row[-1]:
+            session.update(json.loads(row[-1]))
+        return session
+
+    def save(self, user_id: Any, session: Dict[str, Any]) -> None:
+        extra = {key: value for key, value in session.items() if key not in self.FIELDS}
+        db = self._db()
+        with db:
+            db.execute(
+                f"INSERT OR REPLACE INTO sessions (user_id, {', '.join(self.FIELDS)}, extra, expires_at) "
+                f"VALUES ({', '.join('?' * (len(self.FIELDS) + 3))})",
+                (
+                    str(user_id),
+                    *(session.get(field) for field in self.FIELDS),
+                    json.dumps(extra) if extra else None,
+                    time.time() + self.ttl,
+                ),
+            )
+
+    def delete(self, user_id: Any) -> None:
+        db = self._db()
+        with db:
+            db.execute("DELETE FROM sessions WHERE user_id = ?", (str(user_id),))
+            db.execute("DELETE FROM session_blobs WHERE user_id = ?", (str(user_id),))
+
+    def put_blob(self, user_id: Any, key: str, value: bytes) -> None:
+        db = self._db()
+        with db:
+            db.execute("INSERT OR REPLACE INTO session_blobs VALUES (?, ?, ?)", (str(user_id), key, value))
+
+    def get_blob(self, user_id: Any, key: str) -> Optional[bytes]:
+        row = self._db().execute(
+            "SELECT value FROM session_blobs WHERE user_id = ? AND key = ?", (str(user_id), key)
+        ).fetchone()
+        return row[0] if row else None
+
+    def purge_expired(self) -> int:
+        db = self._db()
+        with db:
+            db.execute(
+                "DELETE FROM session_blobs WHERE user_id IN (SELECT user_id FROM sessions WHERE expires_at < ?)",
+                (time.time(),),
+            )
+            return db.execute("DELETE FROM sessions WHERE expires_at < ?", (time.time(),)).rowcount
+
+    def close(self) -> None:
+        db = getattr(self._local, "db", None)
+        if db is not None:
+            db.close()
+            self._local.db = None
+
+
+class TieredSessionStore(SessionStore):
+    """Write-through memory tier in front of a persistent store; reads are served from memory."""
+
+    def __init__(self, backend: SessionStore, max_cached: int = 100_000):
+        super().__init__(backend.ttl)
+        self.backend = backend
+        self.memory = MemorySessionStore(ttl=backend.ttl, max_sessions=max_cached)
+
+    def get(self, user_id: Any) -> Dict[str, Any]:
+        if self.memory.contains(user_id):
+            return self.memory.get(user_id)
+        session = self.backend.get(user_id)
+        if session != self.NEW_SESSION:
+            self.memory.save(user_id, session)
+        return session
+
+    def save(self, user_id: Any, session: Dict[str, Any]) -> None:
+        self.backend.save(user_id, session)
+        self.memory.save(user_id, session)
+
+    def delete(self, user_id: Any) -> None:
+        self.backend.delete(user_id)
+        self.memory.delete(user_id)
+
+    def put_blob(self, user_id: Any, key: str, value: bytes) -> None:
+        self.backend.put_blob(user_id, key, value)
+
+    def get_blob(self, user_id: Any, key: str) -> Optional[bytes]:
+        return self.backend.get_blob(user_id, key)
+
+    def purge_expired(self) -> int:
+        self.memory.purge_expired()
+        return self.backend.purge_expired()
+
+    def close(self) -> None:
+        self.backend.close()
+
+
+def create_session_store(url: str = "sqlite:user_sessions.sqlite3", ttl: float = 7 * 24 * 3600) -> SessionStore:
+    """Build a session store from a URL: ``memory`` or ``sqlite:<path>`` (cached in memory)."""
+    if url == "memory":
+        return MemorySessionStore(ttl=ttl)
+    if url.startswith("sqlite:"):
+        return TieredSessionStore(SQLiteSessionStore(url[len("sqlite:"):], ttl=ttl))
+    raise ValueError(f"Unsupported session store: {url}")
@@ -0,0 +1,192 @@
+"""Local stand-in for the OpenRouter chat completions endpoint.
+
+Run it and point the apps at it to exercise the LLM client offline:
+
+    python mock_openrouter.py --port 8808 --delay 0.5 --token-delay 0.02
+    OPENROUTER_BASE_URL=http://127.0.0.1:8808/api/v1/chat/completions python telegrambot.py
+
+Add --rate-limit and --fail-rate to see how the client copes with 429 and
+503 responses under load.
+"""
+import re
+import json
+import math
+import time
+import random
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+
+
+class MockOpenRouterHandler(BaseHTTPRequestHandler):
+    """Answers chat completion requests by echoing the tail of the prompt.
+
+    Requests with ``"stream": true`` get the answer word by word as
+    server-sent events, ``token_delay`` seconds apart. More than
+    ``rate_limit`` requests in one second are refused with 429 and a
+    ``Retry-After`` header, and a ``fail_rate`` fraction of the rest get 503.
+    With ``stream_fail_after`` set, streams end with an error event after
+    that many words, as when the upstream provider drops mid-answer.
+    """
+
+    protocol_version = "HTTP/1.1"  # keep-alive, like the real service
+    disable_nagle_algorithm = True  # headers and body are separate writes; don't wait for delayed ACKs
+    delay: float = 0.0
+    token_delay: float = 0.0
+    rate_limit: float = 0.0
+    fail_rate: float = 0.0
+    stream_fail_after: int = 0
+
+    def _rate_limited(self) -> Optional[int]:
+        """Seconds until the current one-second window ends, if this request is over the limit."""
+        if not self.rate_limit:
+            return None
+        server = self.server
+        with server.lock:
+            now = time.monotonic()
+            if now - server.window_start >= 1.0:
+                server.window_start, server.window_count = now, 0
+            server.window_count += 1
+            if server.window_count <= self.rate_limit:
+                return None
+            server.rate_limited += 1
+            return max(1, math.ceil(server.window_start + 1.0 - now))
+
+    def setup(self):
+        super().setup()
+        # One handler instance per TCP connection, so this counts connections, not requests
+        with self.server.lock:
+            self.server.connection_count += 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status: int, body: dict, headers: Optional[dict] = None):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        try:
+            request = json.loads(self.rfile.read(length) or b"{}")
+            prompt = request["messages"][-1]["content"]
+        except (ValueError, KeyError, IndexError):
+            self._send_json(400, {"error": {"message": "invalid request"}})
+            return
+
+        retry_after = self._rate_limited()
+        if retry_after is not None:
+            self._send_json(429, {"error": {"code": 429, "message": "Rate limit exceeded"}},
+                            {"Retry-After": str(retry_after)})
+            return
+        if self.fail_rate and random.random() < self.fail_rate:
+            with self.server.lock:
+                self.server.failures += 1
+            self._send_json(503, {"error": {"code": 503, "message": "Provider unavailable"}})
+            return
+
+        if self.delay:
+            time.sleep(self.delay)
+
+        with self.server.lock:
+            self.server.request_count += 1
+        content = f"Mock answer ({len(prompt)} prompt chars): {prompt[-200:]}"
+        if request.get("stream"):
+            self._send_stream(f"mock-{self.server.request_count}", request.get("model", "mock"), content)
+            return
+        self._send_json(200, {
+            "id": f"mock-{self.server.request_count}",
+            "model": request.get("model", "mock"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": len(prompt) // 4, "completion_tokens": len(content) // 4},
+        })
+
+
+    def _send_stream(self, completion_id: str, model: str, content: str):
+        # No Content-Length: the end of the stream is marked by closing the connection
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+
+        def event(delta: dict, finish_reason=None) -> bytes:
+            chunk = {"id": completion_id, "model": model,
+                     "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]}
+            return f"data: {json.dumps(chunk)}\n\n".encode("utf-8")
+
+        self.wfile.write(b": OPENROUTER PROCESSING\n\n")
+        for number, word in enumerate(re.findall(r"\S+\s*", content)):
+            if self.stream_fail_after and number == self.stream_fail_after:
+                self.wfile.write(b'data: {"error": {"code": 502, "message": "Provider disconnected"}}\n\n')
+                self.wfile.flush()
+                return
+            self.wfile.write(event({"content": word}))
+            self.wfile.flush()
+            if self.token_delay:
+                time.sleep(self.token_delay)
+        self.wfile.write(event({}, "stop"))
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+
+
+def start_mock_server(
+    host: str = "127.0.0.1",
+    port: int = 0,
+    delay: float = 0.0,
+    token_delay: float = 0.0,
+    rate_limit: float = 0.0,
+    fail_rate: float = 0.0,
+    stream_fail_after: int = 0,
+) -> ThreadingHTTPServer:
+    """Start the mock server on a background thread and return it (``server.url`` is the endpoint).
+
+    ``server.request_count`` counts answered requests; ``server.rate_limited``
+    and ``server.failures`` count the 429 and 503 responses, and
+    ``server.connection_count`` the TCP connections accepted.
+    """
+    handler = type("ConfiguredHandler", (MockOpenRouterHandler,), {
+        "delay": delay, "token_delay": token_delay, "rate_limit": rate_limit, "fail_rate": fail_rate,
+        "stream_fail_after": stream_fail_after,
+    })
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.request_count = server.rate_limited = server.failures = server.connection_count = 0
+    server.window_start, server.window_count = time.monotonic(), 0
+    server.url = f"http://{host}:{server.server_address[1]}/api/v1/chat/completions"
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8808)
+    parser.add_argument("--delay", type=float, default=0.0, help="seconds to wait before answering")
+    parser.add_argument("--token-delay", type=float, default=0.0, help="seconds between streamed words")
+    parser.add_argument("--rate-limit", type=float, default=0.0, help="requests per second before answering 429 (0 = unlimited)")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="fraction of requests answered with 503")
+    parser.add_argument("--stream-fail-after", type=int, default=0, help="words streamed before an error event (0 = never)")
+    args = parser.parse_args()
+
+    server = start_mock_server(
+        args.host, args.port, args.delay, args.token_delay, args.rate_limit, args.fail_rate, args.stream_fail_after,
+    )
+    print(f"Mock OpenRouter listening on {server.url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
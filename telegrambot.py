@@ -1,17 +1,25 @@
+import time
+STARTED = time.perf_counter()  # taken before the heavy imports below to measure import-to-ready time
+
 import os
 import asyncio
 import logging
-import shelve
-from typing import Dict, Any
+import threading
+import weakref
+from collections import OrderedDict
+from typing import Dict, Any, Iterable, List, Optional, Tuple
 from io import BytesIO
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest, RetryAfter
 from telegram.ext import (
     Application, CommandHandler, MessageHandler, 
     CallbackQueryHandler, ContextTypes, filters
 )
-from langchain.chains import RetrievalQA
 from dotenv import load_dotenv
-from core import OpenRouterLLM, PDFProcessor
+from core import (
+    OpenRouterLLM, PDFProcessor, IndexStore, DocumentSummarizer, DocumentCorpus, ResponseCache, QAEngine, ContextAssembler, IngestionScheduler, QueueFullError,
+    SessionStore, ingest_pdf_job, create_session_store, close_async_clients, log_startup_time, start_metrics_server,
+)
 
 # Load environment variables
 load_dotenv()
@@ -27,19 +35,164 @@ logger = logging.getLogger(__name__)
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
 OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY")
 
-# Session cache
-SESSION_CACHE = "user_sessions.db"
-
-# Initialize PDFProcessor
-pdf_processor = PDFProcessor()
+# Session store ("memory" or "sqlite:<path>")
+SESSION_STORE = os.getenv("SESSION_STORE", "sqlite:user_sessions.sqlite3")
+SESSION_TTL = float(os.getenv("SESSION_TTL", str(7 * 24 * 3600)))
+
+# Telegram allows about one edit per second per chat; streamed answers are edited no more often
+STREAM_EDIT_INTERVAL = float(os.getenv("TELEGRAM_STREAM_EDIT_INTERVAL", "1.0"))
+
+# A message with several lines is answered as a batch, one question per line
+MAX_BATCH_QUESTIONS = int(os.getenv("TELEGRAM_MAX_BATCH_QUESTIONS", "10"))
+
+# Prometheus metrics and profiling switches are served on this port when set
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+
+# PDFProcessor, the per-document index store, the shared LLM client, the session store and the
+# ingestion scheduler; built by init_services() from main(), since ingestion workers are spawned
+# processes that re-import this module and must not build a bot of their own
+pdf_processor: Optional[PDFProcessor] = None
+index_store: Optional[IndexStore] = None
+response_cache: Optional[ResponseCache] = None
+llm: Optional[OpenRouterLLM] = None
+summarizer: Optional[DocumentSummarizer] = None
+session_store: Optional[SessionStore] = None
+ingestion: Optional[IngestionScheduler] = None
+
+# Per-user corpus of their PDFs (name -> doc hash it was built for) and the QA engine over it,
+# least recently used dropped first
+user_corpora: "OrderedDict[int, Tuple[DocumentCorpus, Dict[str, str], QAEngine]]" = OrderedDict()
+MAX_USER_CORPORA = 64
+# Corpora are built on worker threads: one build per user at a time, and the LRU bookkeeping under a lock.
+# A built corpus is never changed, so answers can search it while the next one is built
+user_corpora_lock = threading.Lock()
+corpus_build_locks: "weakref.WeakValueDictionary[int, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+def init_services() -> None:
+    """Build the bot's shared objects."""
+    global pdf_processor, index_store, response_cache, llm, summarizer, session_store, ingestion
+    pdf_processor = PDFProcessor()
+    index_store = IndexStore(pdf_processor.embeddings)
+    response_cache = ResponseCache(ttl=float(os.getenv("RESPONSE_CACHE_TTL", "3600")))
+    llm = OpenRouterLLM(api_key=OPENROUTER_API_KEY or "", response_cache=response_cache)
+    summarizer = DocumentSummarizer(llm)
+    session_store = create_session_store(SESSION_STORE, ttl=SESSION_TTL)
+    # Extraction, chunking and embedding run in worker processes so the event loop stays responsive
+    ingestion = IngestionScheduler(
+        max_workers=int(os.getenv("INGEST_WORKERS", "2")),
+        max_queue=int(os.getenv("INGEST_QUEUE_SIZE", "16")),
+    )
+
+def session_documents(session: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """PDFs in a session; sessions saved before multi-PDF support only have the single doc_hash."""
+    if "documents" in session:
+        return session["documents"]
+    if session.get("doc_hash"):
+        return [{name: session.get(name) for name in ("pdf_name", "doc_hash", "char_count", "chunk_count")}]
+    return []
+
+def processing_names(session: Dict[str, Any]) -> List[str]:
+    """PDFs of a session still being processed; sessions saved before uploads could overlap hold one name."""
+    processing = session.get("processing") or []
+    return [processing] if isinstance(processing, str) else list(processing)
+
+def without_dependents(documents: List[Dict[str, Any]], removed: Iterable[str]) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    """Split ``documents`` into those kept and those dropped when the ``removed`` indexes go.
+
+    A PDF indexed with DEDUP=on lacks the chunks it shared with its
+    ``dedup_basis``; once one of those indexes leaves the session, it is
+    dropped too so it can be indexed again in full.
+    """
+    removed = set(removed)
+    kept, dropped = list(documents), []
+    while True:
+        gone = [doc for doc in kept if removed & set(doc.get("dedup_basis") or ())]
+        if not gone:
+            return kept, dropped
+        for doc in gone:
+            kept.remove(doc)
+            dropped.append(doc)
+            removed.add(doc["doc_hash"])
+
+def get_qa_engine(user_id: int, documents: List[Dict[str, Any]]) -> Optional[QAEngine]:
+    """QA engine over all of a user's PDFs; rebuilt only when the set of PDFs changed."""
+    wanted = {doc["pdf_name"]: doc["doc_hash"] for doc in documents}
+    with user_corpora_lock:
+        entry = user_corpora.get(user_id)
+        if entry is not None and entry[1] == wanted:
+            user_corpora.move_to_end(user_id)
+            return entry[2]
+
+    # Copy-on-write: an answer may still be searching the current corpus on another thread,
+    # so a changed set of PDFs gets a new corpus that replaces it
+    corpus = DocumentCorpus(pdf_processor.embeddings)
+    loaded = []
+    for name, doc_hash in wanted.items():
+        vectorstore = index_store.load(doc_hash)
+        if vectorstore is None:
+            logger.warning(f"Index {doc_hash} for {name} is missing")
+            continue
+        # The memory-mapped index is shared with other users' corpora; only BM25 postings are copied
+        corpus.add_vectorstore(name, vectorstore, index_store.load_lexical(doc_hash))
+        loaded.append(doc_hash)
+
+    if not len(corpus):
+        with user_corpora_lock:
+            user_corpora.pop(user_id, None)
+        return None
+
+    engine = QAEngine(
+        corpus, llm, response_cache=response_cache, namespace="|".join(sorted(loaded)),
+        assembler=ContextAssembler.for_model(llm.model),
+    )
+    with user_corpora_lock:
+        user_corpora[user_id] = (corpus, wanted, engine)
+        user_corpora.move_to_end(user_id)
+        while len(user_corpora) > MAX_USER_CORPORA:
+            user_corpora.popitem(last=False)
+    return engine
+
+def corpus_build_lock(user_id: int) -> asyncio.Lock:
+    lock = corpus_build_locks.get(user_id)
+    if lock is None:
+        lock = corpus_build_locks[user_id] = asyncio.Lock()
+    return lock
+
+async def load_qa_engine(user_id: int, documents: List[Dict[str, Any]]) -> Optional[QAEngine]:
+    """Run ``get_qa_engine`` on a worker thread: opening indexes and rebuilding BM25 postings
+    must not stall other users' updates on the event loop."""
+    async with corpus_build_lock(user_id):
+        return await asyncio.to_thread(get_qa_engine, user_id, documents)
+
+class ThrottledEditor:
+    """Edits one message with a growing text at most every ``interval`` seconds, backing off on RetryAfter."""
+
+    def __init__(self, message, interval: float = STREAM_EDIT_INTERVAL):
+        self.message = message
+        self.interval = interval
+        self._next_edit = 0.0
+        self._last_text = None
+
+    async def update(self, text: str) -> None:
+        now = time.monotonic()
+        if now < self._next_edit or text == self._last_text:
+            return
+        self._next_edit = now + self.interval
+        try:
+            # Partial answers are sent as plain text since half-written Markdown may not parse
+            await self.message.edit_text(text[:4096])
+            self._last_text = text
+        except RetryAfter as e:
+            retry_after = e.retry_after.total_seconds() if hasattr(e.retry_after, "total_seconds") else e.retry_after
+            self._next_edit = time.monotonic() + retry_after
+        except BadRequest as e:
+            logger.debug(f"Skipped streaming edit: {str(e)}")
 
 def get_session(user_id: int) -> Dict[str, Any]:
-    with shelve.open(SESSION_CACHE) as db:
-        return db.get(str(user_id), {"status": "new"})
+    return session_store.get(user_id)
 
 def save_session(user_id: int, session_data: Dict[str, Any]):
-    with shelve.open(SESSION_CACHE) as db:
-        db[str(user_id)] = session_data
+    session_store.save(user_id, session_data)
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = update.effective_user.id
@@ -69,11 +222,12 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
 • `/start` - Start the bot
 • `/help` - Show this help message
 • `/status` - Check current session status
+• `/remove <file name>` - Remove one PDF from your session
 • `/clear` - Clear current PDF session
 
 **Features:**
-📤 **Upload PDF:** Send any PDF file (up to 20MB)
-❓ **Ask Questions:** Type any question about your PDF
+📤 **Upload PDF:** Send any PDF file (up to 20MB); send more to ask across all of them
+❓ **Ask Questions:** Type any question about your PDF, or several at once, one per line
 📋 **Get Summary:** Use summary buttons or type "summarize"
 
 **Examples:**
@@ -102,15 +256,16 @@ async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     elif status == "processing":
         status_text = "🔄 Processing your PDF. Please wait..."
     elif status == "ready":
-        pdf_name = session.get("pdf_name", "Unknown")
-        char_count = session.get("char_count", 0)
-        chunk_count = session.get("chunk_count", 0)
+        documents = session_documents(session)
+        document_lines = "\n".join(
+            f"📄 **{doc['pdf_name']}** - {doc.get('char_count', 0):,} characters, {doc.get('chunk_count', 0)} chunks"
+            for doc in documents
+        )
+        processing = f"\n🔄 Processing {', '.join(processing_names(session))}..." if session.get("processing") else ""
         status_text = f"""
 ✅ **Session Ready!**
 
-📄 **PDF:** {pdf_name}
-📊 **Characters:** {char_count:,}
-📦 **Chunks:** {chunk_count}
+{document_lines}{processing}
 
 You can now ask questions or request summaries!
         """
@@ -121,9 +276,69 @@ You can now ask questions or request summaries!
 
 async def clear_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = update.effective_user.id
-    save_session(user_id, {"status": "waiting_for_pdf"})
+    ingestion.cancel(user_id)
+    async with session_store.lock(user_id):
+        save_session(user_id, {"status": "waiting_for_pdf"})
+    # Wait for a build in progress so it cannot put the corpus back afterwards
+    async with corpus_build_lock(user_id):
+        with user_corpora_lock:
+            user_corpora.pop(user_id, None)
     await update.message.reply_text("🗑️ Session cleared! Send me a new PDF to analyze.", parse_mode='Markdown')
 
+async def remove_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    user_id = update.effective_user.id
+    name = " ".join(context.args or []).strip()
+
+    async with session_store.lock(user_id):
+        session = get_session(user_id)
+        documents = session_documents(session)
+        removed = [doc for doc in documents if doc["pdf_name"] == name]
+        if not name or not removed:
+            names = ", ".join(doc["pdf_name"] for doc in documents) or "none"
+            await update.message.reply_text(f"❓ Usage: /remove <file name>\n\nYour PDFs: {names}")
+            return
+        remaining, dropped = without_dependents(
+            [doc for doc in documents if doc["pdf_name"] != name], [doc["doc_hash"] for doc in removed],
+        )
+        save_session(user_id, ready_session(session, remaining))
+
+    dropped_names = ", ".join(doc["pdf_name"] for doc in dropped)
+    if dropped_names:
+        await update.message.reply_text(f"🗑️ Removed {name}. {dropped_names} shared passages with it; please send them again.")
+    else:
+        await update.message.reply_text(f"🗑️ Removed {name}.")
+
+def ready_session(session: Dict[str, Any], documents: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Session for a set of indexed PDFs; the most recently added one is used for summaries."""
+    processing = processing_names(session)
+    if not documents:
+        return {"status": "processing", "processing": processing} if processing else {"status": "waiting_for_pdf"}
+    new_session = {"status": "ready", "documents": documents, **documents[-1]}
+    if processing:
+        new_session["processing"] = processing
+    return new_session
+
+async def finish_processing(user_id: int, pdf_name: str, document: Optional[Dict[str, Any]]) -> Optional[List[str]]:
+    """Record the outcome of processing ``pdf_name``; returns None if /clear cancelled it meanwhile,
+    otherwise the names of PDFs dropped because they were deduplicated against a replaced one."""
+    async with session_store.lock(user_id):
+        session = get_session(user_id)
+        processing = processing_names(session)
+        if pdf_name not in processing:
+            return None
+        # Other uploads may still be in flight; only this one is done
+        processing.remove(pdf_name)
+        session["processing"] = processing
+        documents = session_documents(session)
+        replaced = [doc["doc_hash"] for doc in documents if doc["pdf_name"] == pdf_name]
+        if document is not None and document["doc_hash"] in replaced:
+            replaced = []
+        documents, dropped = without_dependents([doc for doc in documents if doc["pdf_name"] != pdf_name], replaced)
+        if document is not None:
+            documents.append(document)
+        save_session(user_id, ready_session(session, documents))
+        return [doc["pdf_name"] for doc in dropped]
+
 async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = update.effective_user.id
     document = update.message.document
@@ -132,44 +347,61 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         await update.message.reply_text("❌ File too large! Please send a PDF smaller than 20MB.")
         return
 
-    save_session(user_id, {"status": "processing", "pdf_name": document.file_name})
+    async with session_store.lock(user_id):
+        session = get_session(user_id)
+        processing = processing_names(session)
+        if document.file_name in processing:
+            await update.message.reply_text(f"⏳ {document.file_name} is already being processed. Please wait for it to finish.")
+            return
+        # PDFs already in the session stay usable while the new one is processed
+        if not session_documents(session) and not processing:
+            session = {"status": "processing", "pdf_name": document.file_name}
+        session["processing"] = processing + [document.file_name]
+        save_session(user_id, session)
     processing_msg = await update.message.reply_text("🔄 **Processing your PDF...**\n\n⏳ Downloading file...", parse_mode='Markdown')
 
     try:
         file = await context.bot.get_file(document.file_id)
         pdf_bytes = await file.download_as_bytearray()
-        
-        await processing_msg.edit_text("🔄 **Processing your PDF...**\n\n✅ Downloaded\n⏳ Extracting text...", parse_mode='Markdown')
-        text = pdf_processor.extract_text_from_pdf(bytes(pdf_bytes))
-
-        if not text.strip():
-            await processing_msg.edit_text("❌ **Error:** Could not extract text from PDF.\nMake sure your PDF contains readable text (not just images).")
-            save_session(user_id, {"status": "waiting_for_pdf"})
-            return
-
-        await processing_msg.edit_text("🔄 **Processing your PDF...**\n\n✅ Downloaded\n✅ Text extracted\n⏳ Creating chunks...", parse_mode='Markdown')
-        chunks = pdf_processor.split_text(text)
-
-        await processing_msg.edit_text("🔄 **Processing your PDF...**\n\n✅ Downloaded\n✅ Text extracted\n✅ Chunks created\n⏳ Building vector database...", parse_mode='Markdown')
-        vectorstore = pdf_processor.create_vector_store(chunks)
-
-        if not vectorstore:
-            await processing_msg.edit_text("❌ **Error:** Could not create vector database. Please try again.")
-            save_session(user_id, {"status": "waiting_for_pdf"})
-            return
-
-        llm = OpenRouterLLM(api_key=OPENROUTER_API_KEY)
-        
-        session_data = {
-            "status": "ready",
+        doc_hash = IndexStore.document_hash(bytes(pdf_bytes))
+
+        # With DEDUP=on, chunks already indexed from the session's other PDFs are skipped;
+        # a PDF of the same name is being replaced, so neither it nor what was deduplicated against it counts
+        documents = session_documents(get_session(user_id))
+        others = [doc for doc in documents if doc["pdf_name"] != document.file_name]
+        replaced = [doc["doc_hash"] for doc in documents if doc["pdf_name"] == document.file_name]
+        basis = sorted({doc["doc_hash"] for doc in without_dependents(others, replaced)[0]}) if pdf_processor.dedup else []
+
+        # A PDF we have already indexed in full skips extraction and embedding entirely,
+        # and so does one already indexed against the same basis
+        index_hash = doc_hash
+        info = index_store.load_info(doc_hash)
+        if info is None and basis:
+            index_hash = IndexStore.deduplicated_hash(doc_hash, basis)
+            info = index_store.load_info(index_hash)
+        if info is not None:
+            char_count, chunk_count = info["char_count"], info["chunk_count"]
+        else:
+            char_count, chunk_count = await build_index(
+                processing_msg, user_id, bytes(pdf_bytes), index_hash, document.file_name, basis,
+            )
+            if char_count is None:
+                await finish_processing(user_id, document.file_name, None)
+                return
+
+        new_document = {
             "pdf_name": document.file_name,
-            "char_count": len(text),
-            "chunk_count": len(chunks),
-            "full_text": text,
-            "vectorstore": vectorstore,
-            "llm": llm
+            "char_count": char_count,
+            "chunk_count": chunk_count,
+            "doc_hash": index_hash,
         }
-        save_session(user_id, session_data)
+        if index_hash != doc_hash:
+            new_document["dedup_basis"] = basis
+        # A /clear sent while the PDF was processing wins over the finished upload
+        dropped = await finish_processing(user_id, document.file_name, new_document)
+        if dropped is None:
+            await processing_msg.edit_text("🛑 PDF processing cancelled.")
+            return
 
         keyboard = [
             [InlineKeyboardButton("❓ Ask Question", callback_data="ask_question")],
@@ -182,17 +414,51 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 ✅ **PDF Ready for Analysis!**
 
 📄 **File:** {document.file_name}
-📊 **Characters:** {len(text):,}
-📦 **Chunks:** {len(chunks)}
+📊 **Characters:** {char_count:,}
+📦 **Chunks:** {chunk_count}
+📚 **PDFs in session:** {len(session_documents(get_session(user_id)))}
+{f"🗑️ **Send again:** {', '.join(dropped)} (they shared passages with the replaced file)" if dropped else ""}
 
 **What would you like to do?**
         """
         await processing_msg.edit_text(success_text, parse_mode='Markdown', reply_markup=reply_markup)
 
+    except asyncio.CancelledError:
+        # /clear already reset the session
+        await processing_msg.edit_text("🛑 PDF processing cancelled.")
+    except QueueFullError:
+        await processing_msg.edit_text("⏳ The bot is busy processing other PDFs (or yours is already queued). Please try again in a moment.")
+        await finish_processing(user_id, document.file_name, None)
     except Exception as e:
         logger.error(f"Document processing error: {str(e)}")
         await processing_msg.edit_text(f"❌ **Error processing PDF:** {str(e)}\n\nPlease try again with a different file.")
-        save_session(user_id, {"status": "waiting_for_pdf"})
+        await finish_processing(user_id, document.file_name, None)
+
+async def build_index(processing_msg, user_id: int, pdf_bytes: bytes, doc_hash: str, pdf_name: str, basis: List[str] = ()):
+    """Extract, chunk and embed a new PDF into the index store, skipping chunks near-identical to
+    the ``basis`` indexes; returns (char_count, chunk_count)."""
+    async def on_queued(position: int) -> None:
+        await processing_msg.edit_text(f"🔄 **Processing your PDF...**\n\n✅ Downloaded\n⏳ You are #{position} in queue...", parse_mode='Markdown')
+
+    async def on_started() -> None:
+        await processing_msg.edit_text("🔄 **Processing your PDF...**\n\n✅ Downloaded\n⏳ Extracting text, creating chunks and building vector database...", parse_mode='Markdown')
+
+    info = await ingestion.run(
+        user_id, ingest_pdf_job, pdf_bytes, doc_hash, index_store.root, pdf_name, basis,
+        on_queued=on_queued, on_started=on_started,
+    )
+
+    if info.get("error") == "no_text":
+        await processing_msg.edit_text("❌ **Error:** Could not extract text from PDF.\nMake sure your PDF contains readable text (scanned pages need OCR to be enabled on the server).")
+        return None, None
+    if info.get("error") == "duplicate":
+        await processing_msg.edit_text(f"📝 Every passage of {pdf_name} is already in your other PDFs, so it was not added.")
+        return None, None
+    if info.get("error"):
+        await processing_msg.edit_text("❌ **Error:** Could not create vector database. Please try again.")
+        return None, None
+
+    return info["char_count"], info["chunk_count"]
 
 async def handle_question(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = update.effective_user.id
@@ -208,15 +474,32 @@ async def handle_question(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         await handle_summary_request(update, context, "formal")
         return
 
+    qa_engine = await load_qa_engine(user_id, session_documents(session))
+    if qa_engine is None:
+        save_session(user_id, {"status": "waiting_for_pdf"})
+        await update.message.reply_text("❌ Your PDF index is no longer available. Please send the PDF again.")
+        return
+
+    questions = [line.strip() for line in question.splitlines() if line.strip()]
+    if len(questions) > 1:
+        await handle_batch_questions(update, qa_engine, questions)
+        return
+
     thinking_msg = await update.message.reply_text(f"🤔 **Question:** {question}\n\n⏳ Searching for answer...")
 
+    editor = ThrottledEditor(thinking_msg)
+
+    async def on_token(answer_so_far: str) -> None:
+        await editor.update(f"❓ Question: {question}\n\n💡 Answer:\n{answer_so_far} ▌")
+
     try:
-        qa_chain = RetrievalQA.from_chain_type(
-            llm=session['llm'],
-            chain_type="stuff",
-            retriever=session['vectorstore'].as_retriever(search_kwargs={"k": 3})
+        result = await qa_engine.aanswer(question, k=3, on_token=on_token)
+        answer = result.answer
+        logger.info(
+            f"Answered in {result.retrieval_time * 1000:.0f} ms retrieval + {result.generation_time:.2f} s generation "
+            f"(first token after {result.time_to_first_token or 0:.2f} s) with {result.context_tokens} context tokens "
+            f"(cached={result.cached}); response cache: {response_cache.stats()}"
         )
-        answer = qa_chain.run(question)
         response_text = f"""
 ❓ **Question:** {question}
 
@@ -232,6 +515,34 @@ async def handle_question(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         logger.error(f"Question handling error: {str(e)}")
         await thinking_msg.edit_text(f"❌ Error getting answer: {str(e)}\n\nPlease try rephrasing your question.")
 
+async def handle_batch_questions(update: Update, qa_engine: QAEngine, questions: List[str]) -> None:
+    """Answer one question per line: the batch shares one embedding call and one index search."""
+    if len(questions) > MAX_BATCH_QUESTIONS:
+        await update.message.reply_text(
+            f"❌ Please send at most {MAX_BATCH_QUESTIONS} questions at once (one per line)."
+        )
+        return
+
+    thinking_msg = await update.message.reply_text(f"🤔 **{len(questions)} questions**\n\n⏳ Searching for answers...")
+    try:
+        results = await qa_engine.abatch_answer(questions, k=3)
+        logger.info(
+            f"Answered {len(questions)} questions in {results[0].retrieval_time * 1000:.0f} ms retrieval + "
+            f"{max(result.generation_time for result in results):.2f} s generation "
+            f"({sum(result.cached for result in results)} cached); response cache: {response_cache.stats()}"
+        )
+        # One message per answer keeps each under Telegram's 4096-character limit
+        for number, (question, result) in enumerate(zip(questions, results), start=1):
+            response_text = f"❓ Question {number}/{len(questions)}: {question}\n\n💡 Answer:\n{result.answer}"[:4096]
+            if number == 1:
+                await thinking_msg.edit_text(response_text)
+            else:
+                await update.message.reply_text(response_text)
+
+    except Exception as e:
+        logger.error(f"Batch question handling error: {str(e)}")
+        await thinking_msg.edit_text(f"❌ Error getting answers: {str(e)}\n\nPlease try again.")
+
 async def handle_summary_request(update: Update, context: ContextTypes.DEFAULT_TYPE, tone: str) -> None:
     user_id = update.effective_user.id
     session = get_session(user_id)
@@ -241,11 +552,6 @@ async def handle_summary_request(update: Update, context: ContextTypes.DEFAULT_T
             await update.callback_query.answer("Please upload a PDF first!")
         return
 
-    tone_prompts = {
-        "formal": "Please provide a formal, professional summary of this document:",
-        "casual": "Give me a friendly, easy-to-understand summary of this document:",
-        "bullet": "Summarize this document using clear, concise bullet points:"
-    }
     tone_emojis = {"formal": "🎩", "casual": "😊", "bullet": "📌"}
 
     if update.callback_query:
@@ -255,8 +561,8 @@ async def handle_summary_request(update: Update, context: ContextTypes.DEFAULT_T
         thinking_msg = await update.message.reply_text(f"{tone_emojis[tone]} **Generating {tone} summary...**\n\n⏳ Please wait...")
 
     try:
-        prompt = f"{tone_prompts[tone]}\n\n{session['full_text'][:4000]}..."
-        summary = session['llm'](prompt)
+        full_text = index_store.load_text(session.get("doc_hash", ""))
+        summary = await summarizer.asummarize(full_text, tone)
         response_text = f"""
 {tone_emojis[tone]} **{tone.title()} Summary:**
 
@@ -296,6 +602,20 @@ async def handle_unknown(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
     logger.error(f"Exception while handling an update: {context.error}")
 
+async def post_init(application: Application) -> None:
+    log_startup_time("bot ready", STARTED)
+    if METRICS_PORT:
+        start_metrics_server(METRICS_PORT)
+    logger.info(f"Purged {session_store.purge_expired()} expired sessions")
+    # Questions need the embedding model too; load it now rather than on the first message
+    pdf_processor.preload(STARTED)
+
+async def post_shutdown(application: Application) -> None:
+    await close_async_clients()
+    session_store.purge_expired()
+    session_store.close()
+    ingestion.shutdown()
+
 def main():
     if not TELEGRAM_TOKEN:
         logger.error("TELEGRAM_TOKEN not provided!")
@@ -305,12 +625,23 @@ def main():
         logger.error("OPENROUTER_API_KEY not found in environment variables!")
         return
 
-    application = Application.builder().token(TELEGRAM_TOKEN).build()
+    init_services()
+
+    # Handlers await the LLM instead of blocking, so let updates from different users run concurrently
+    application = (
+        Application.builder()
+        .token(TELEGRAM_TOKEN)
+        .concurrent_updates(True)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
     
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("help", help_command))
     application.add_handler(CommandHandler("status", status_command))
     application.add_handler(CommandHandler("clear", clear_command))
+    application.add_handler(CommandHandler("remove", remove_command))
     application.add_handler(MessageHandler(filters.Document.PDF, handle_document))
     application.add_handler(CallbackQueryHandler(button_callback))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_unknown))
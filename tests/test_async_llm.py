@@ -0,0 +1,161 @@
+import asyncio
+
+import pytest
+from langchain_community.embeddings import DeterministicFakeEmbedding
+from langchain_core.documents import Document
+
+import core
+from core import (
+    OpenRouterLLM, LLMScheduler, LLMStreamError, DocumentCorpus, QAEngine, ResponseCache, close_async_clients, is_llm_error,
+)
+from mock_openrouter import start_mock_server
+
+
+@pytest.fixture
+def server():
+    server = start_mock_server()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def llm(server):
+    return OpenRouterLLM(api_key="test", base_url=server.url, scheduler=LLMScheduler(max_concurrency=4))
+
+
+def test_acall_reuses_one_connection(server, llm):
+    async def run():
+        answers = [await llm._acall(f"question {i}") for i in range(5)]
+        await close_async_clients()
+        return answers
+
+    answers = asyncio.run(run())
+
+    assert [answer.endswith(f"question {i}") for i, answer in enumerate(answers)] == [True] * 5
+    assert server.request_count == 5
+    assert server.connection_count == 1
+
+
+def test_concurrent_acalls_stay_within_pool(server, llm):
+    async def run():
+        answers = await asyncio.gather(*(llm._acall(f"question {i}") for i in range(12)))
+        await close_async_clients()
+        return answers
+
+    answers = asyncio.run(run())
+
+    assert all(answer.startswith("Mock answer") for answer in answers)
+    assert server.request_count == 12
+    assert server.connection_count <= llm.max_concurrency
+
+
+def test_astream_yields_the_full_answer(server, llm):
+    async def run():
+        parts = [chunk.text async for chunk in llm._astream("stream this")]
+        answer = await llm._acall("stream this")
+        await close_async_clients()
+        return parts, answer
+
+    parts, answer = asyncio.run(run())
+
+    assert len(parts) > 1
+    assert "".join(parts) == answer
+
+
+def test_one_client_per_event_loop(server, llm):
+    async def use_client():
+        await llm._acall("hello")
+        first = core._get_async_client(llm.max_concurrency)
+        assert core._get_async_client(llm.max_concurrency) is first
+        return first
+
+    loop_a, loop_b = asyncio.new_event_loop(), asyncio.new_event_loop()
+    try:
+        client_a = loop_a.run_until_complete(use_client())
+        client_b = loop_b.run_until_complete(use_client())
+        assert client_a is not client_b
+        assert core._async_clients[loop_a] is client_a
+        assert core._async_clients[loop_b] is client_b
+
+        loop_a.run_until_complete(close_async_clients())
+        assert client_a.is_closed
+        assert loop_a not in core._async_clients
+        assert not client_b.is_closed
+    finally:
+        loop_b.run_until_complete(close_async_clients())
+        loop_a.close()
+        loop_b.close()
+    assert client_b.is_closed
+
+
+def test_closed_client_is_replaced(server, llm):
+    async def run():
+        await llm._acall("first")
+        first = core._get_async_client(llm.max_concurrency)
+        await close_async_clients()
+        answer = await llm._acall("second")
+        second = core._get_async_client(llm.max_concurrency)
+        await close_async_clients()
+        return first, second, answer
+
+    first, second, answer = asyncio.run(run())
+
+    assert first is not second
+    assert first.is_closed and second.is_closed
+    assert answer.endswith("second")
+    assert server.connection_count == 2
+
+
+@pytest.fixture
+def failing_server():
+    server = start_mock_server(stream_fail_after=3)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_stream_failing_midway_raises_with_the_partial_answer(failing_server):
+    llm = OpenRouterLLM(api_key="test", base_url=failing_server.url, scheduler=LLMScheduler(max_concurrency=4))
+
+    async def run():
+        parts = []
+        try:
+            with pytest.raises(LLMStreamError) as raised:
+                async for chunk in llm._astream("stream this"):
+                    parts.append(chunk.text)
+        finally:
+            await close_async_clients()
+        return parts, raised.value
+
+    parts, error = asyncio.run(run())
+
+    assert len(parts) == 3
+    assert error.partial == "".join(parts)
+    assert is_llm_error(error.error) and "Provider disconnected" in error.error
+
+
+def test_cut_off_streamed_answer_is_not_cached(failing_server):
+    cache = ResponseCache(ttl=60)
+    llm = OpenRouterLLM(api_key="test", base_url=failing_server.url, scheduler=LLMScheduler(max_concurrency=4))
+    corpus = DocumentCorpus(DeterministicFakeEmbedding(size=32))
+    corpus.add_documents("a.pdf", [Document(page_content="The valve is inspected every quarter.", metadata={})])
+    engine = QAEngine(corpus, llm, response_cache=cache, namespace="a")
+    streamed = []
+
+    async def on_token(answer):
+        streamed.append(answer)
+
+    async def run():
+        try:
+            first = await engine.aanswer("How often is the valve inspected?", on_token=on_token)
+            second = await engine.aanswer("How often is the valve inspected?", on_token=on_token)
+        finally:
+            await close_async_clients()
+        return first, second
+
+    first, second = asyncio.run(run())
+
+    assert "Provider disconnected" in first.answer and streamed[-1] == first.answer
+    assert not second.cached
+    assert failing_server.request_count == 2
@@ -0,0 +1,112 @@
+import random
+
+import fitz  # PyMuPDF
+import numpy as np
+import pytest
+from langchain_community.embeddings import DeterministicFakeEmbedding
+
+from core import ChunkDeduplicator, DocumentCorpus, IndexStore, PDFProcessor
+
+WORDS = "safety audit valve pressure inspection report quarterly incident pipeline maintenance crew".split()
+
+
+def make_pdf(pages: int, version: int = 0) -> bytes:
+    """A report with a running header and footer; each ``version`` changes a few words per page."""
+    rng, edits = random.Random(0), random.Random(version)
+    doc = fitz.open()
+    for number in range(pages):
+        words = [rng.choice(WORDS) for _ in range(300)]
+        for _ in range(3 if version else 0):
+            words[edits.randrange(len(words))] = edits.choice(WORDS)
+        body = (f"Example Industries - Annual Report - Confidential\n\n{' '.join(words)}\n\n"
+                f"Page {number + 1} of {pages} | Ref. 2024-{version + 1:04d}")
+        page = doc.new_page()
+        page.insert_textbox(fitz.Rect(50, 50, page.rect.width - 50, page.rect.height - 50), body, fontsize=9)
+    data = doc.tobytes()
+    doc.close()
+    return data
+
+
+@pytest.fixture(scope="module")
+def processor():
+    processor = PDFProcessor(cache_dir=None, dedup="on")
+    processor.embeddings = DeterministicFakeEmbedding(size=64)
+    return processor
+
+
+def chunks(vectorstore):
+    return [vectorstore.docstore.search(doc_id) for doc_id in vectorstore.index_to_docstore_id.values()]
+
+
+def test_dedup_is_off_by_default(monkeypatch):
+    monkeypatch.delenv("DEDUP", raising=False)
+    assert not PDFProcessor(cache_dir=None).dedup
+
+
+@pytest.mark.parametrize("mode", ["on", "off"])
+def test_dedup_setting_is_read_when_the_processor_is_created(monkeypatch, mode):
+    monkeypatch.setenv("DEDUP", mode)
+    monkeypatch.setenv("DEDUP_THRESHOLD", "0.75")
+    processor = PDFProcessor(cache_dir=None)
+
+    assert processor.dedup == (mode == "on")
+    assert processor.dedup_threshold == 0.75
+    # Arguments still win over the environment
+    assert PDFProcessor(cache_dir=None, dedup="off" if mode == "on" else "on").dedup == (mode != "on")
+
+
+def test_chunks_are_cut_from_the_kept_text(processor):
+    result = processor.ingest_stream(make_pdf(6), {"source": "a.pdf"}, keep_text=True)
+
+    assert result.boilerplate_chars > 0
+    assert "Confidential" not in result.text
+    position = 0
+    for doc in chunks(result.vectorstore):
+        found = result.text.find(doc.page_content, max(0, position - 200))
+        assert found >= 0
+        position = found + len(doc.page_content)
+
+
+def test_chunks_of_known_signatures_are_not_embedded_again(processor):
+    first = processor.ingest_stream(make_pdf(6), {"source": "v1.pdf"})
+    assert first.signatures.shape == (first.chunk_count, ChunkDeduplicator().num_perm)
+
+    second = processor.ingest_stream(make_pdf(6, version=1), {"source": "v2.pdf"}, known_signatures=first.signatures)
+
+    assert second.duplicate_chunks > first.chunk_count // 2
+    assert len(second.signatures) == second.chunk_count
+
+
+def test_signatures_are_saved_beside_the_index(processor, tmp_path):
+    result = processor.ingest_stream(make_pdf(4), {"source": "a.pdf"}, keep_text=True)
+    store = IndexStore(processor.embeddings, root=str(tmp_path))
+    store.save("ab" * 32, result.vectorstore, result.text, {"chunk_count": result.chunk_count},
+               signatures=result.signatures)
+
+    assert np.array_equal(store.load_signatures("ab" * 32), result.signatures)
+
+
+def test_signatures_of_an_index_saved_without_them_are_computed_once(processor, tmp_path):
+    result = processor.ingest_stream(make_pdf(4), {"source": "a.pdf"}, keep_text=True)
+    store = IndexStore(processor.embeddings, root=str(tmp_path))
+    store.save("cd" * 32, result.vectorstore, result.text, {"chunk_count": result.chunk_count})
+
+    computed = store.load_signatures("cd" * 32)
+
+    assert np.array_equal(computed, result.signatures)
+    assert (tmp_path / ("cd" * 32) / IndexStore.SIGNATURES).exists()
+    assert store.load_signatures("ef" * 32) is None
+
+
+def test_corpus_signatures_follow_its_documents(processor):
+    first = processor.ingest_stream(make_pdf(3), {"source": "a.pdf"})
+    second = processor.ingest_stream(make_pdf(3, version=5), {"source": "b.pdf"})
+    corpus = DocumentCorpus(processor.embeddings)
+    assert corpus.signatures() is None
+
+    corpus.add_vectorstore("a.pdf", first.vectorstore, first.lexical_index, first.signatures)
+    corpus.add_vectorstore("b.pdf", second.vectorstore, second.lexical_index, second.signatures)
+    assert len(corpus.signatures()) == first.chunk_count + second.chunk_count
+
+    corpus.remove("a.pdf")
+    assert np.array_equal(corpus.signatures(), second.signatures)
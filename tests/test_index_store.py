@@ -0,0 +1,72 @@
+import pytest
+from langchain_community.embeddings import DeterministicFakeEmbedding
+from langchain_community.vectorstores import FAISS
+from langchain_core.documents import Document
+
+from core import (
+    DocumentCorpus, IndexConfig, IndexStore, MappedDocstore, ReadOnlyIndexError, optimize_vectorstore, writable_vectorstore,
+)
+
+DOC_HASH = "ab" * 32
+
+
+@pytest.fixture
+def embeddings():
+    return DeterministicFakeEmbedding(size=64)
+
+
+@pytest.fixture(params=[("flat", "float32"), ("flat", "int8"), ("hnsw", "float32"), ("hnsw", "float16")])
+def loaded(request, embeddings, tmp_path):
+    index_type, dtype = request.param
+    texts = [f"chunk {i} about topic {i}" for i in range(50)]
+    vectorstore = FAISS.from_texts(texts, embeddings, metadatas=[{"source": "a.pdf"}] * len(texts))
+    vectorstore = optimize_vectorstore(vectorstore, IndexConfig(index_type=index_type, vector_dtype=dtype))
+    store = IndexStore(embeddings, root=str(tmp_path))
+    store.save(DOC_HASH, vectorstore, "".join(texts), {"char_count": 1, "chunk_count": len(texts)})
+    loaded = store.load(DOC_HASH)
+    assert isinstance(loaded.docstore, MappedDocstore)
+    return loaded
+
+
+def test_writable_copy_of_a_loaded_store_can_be_appended_to(loaded):
+    copy = writable_vectorstore(loaded)
+    copy.add_texts(["a new chunk"], metadatas=[{"source": "b.pdf"}])
+
+    assert copy.index.ntotal == 51
+    assert loaded.index.ntotal == 50
+    assert copy.similarity_search("chunk 7 about topic 7", k=1)[0].page_content == "chunk 7 about topic 7"
+
+
+def test_corpus_built_on_a_loaded_store_can_grow(loaded, embeddings):
+    corpus = DocumentCorpus(embeddings, vectorstore=loaded)
+    corpus.add_documents("b.pdf", [Document(page_content="hello there", metadata={})])
+
+    assert len(corpus) == 51
+    assert loaded.index.ntotal == 50
+    assert corpus.search("hello there", 1)[0].page_content == "hello there"
+
+
+def test_stores_that_are_not_mapped_are_used_as_they_are(embeddings):
+    vectorstore = FAISS.from_texts(["one", "two"], embeddings)
+    assert writable_vectorstore(vectorstore) is vectorstore
+
+
+def test_index_config_reads_the_environment_when_created(monkeypatch):
+    monkeypatch.setenv("VECTOR_INDEX", "hnsw")
+    monkeypatch.setenv("VECTOR_INDEX_EF_SEARCH", "128")
+    config = IndexConfig()
+    assert (config.index_type, config.ef_search) == ("hnsw", 128)
+
+    monkeypatch.delenv("VECTOR_INDEX")
+    assert IndexConfig().index_type == "auto"
+
+
+def test_index_store_root_defaults_to_index_dir(monkeypatch, embeddings, tmp_path):
+    monkeypatch.setenv("INDEX_DIR", str(tmp_path / "from-env"))
+    assert IndexStore(embeddings).root == str(tmp_path / "from-env")
+
+
+def test_deleting_from_a_loaded_store_is_refused(loaded):
+    with pytest.raises(ReadOnlyIndexError, match="writable_vectorstore"):
+        loaded.docstore.delete([loaded.index_to_docstore_id[0]])
+    assert loaded.index.ntotal == 50
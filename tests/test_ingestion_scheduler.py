@@ -0,0 +1,72 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from core import IngestionScheduler, QueueFullError
+
+
+@pytest.fixture
+def scheduler():
+    scheduler = IngestionScheduler(max_workers=1, max_queue=1, position_update_interval=0.01)
+    # Threads stand in for the worker processes so jobs need no embedding model
+    scheduler._executor.shutdown()
+    scheduler._executor = ThreadPoolExecutor(max_workers=1)
+    yield scheduler
+    scheduler.shutdown()
+
+
+def test_cancelled_running_job_keeps_its_slot_until_the_worker_finishes(scheduler):
+    started, finish = threading.Event(), threading.Event()
+
+    def blocking_job():
+        started.set()
+        finish.wait(5)
+        return "done"
+
+    async def run():
+        first = asyncio.create_task(scheduler.run("alice", blocking_job))
+        while not started.is_set():
+            await asyncio.sleep(0.01)
+        assert scheduler.cancel("alice")
+        with pytest.raises(asyncio.CancelledError):
+            await first
+
+        # The worker is still busy, so the next job has to queue behind it
+        assert scheduler._running == 1
+        second = asyncio.create_task(scheduler.run("bob", lambda: "second"))
+        await asyncio.sleep(0.05)
+        assert scheduler.queue_position("bob") == 1
+        with pytest.raises(QueueFullError):
+            await scheduler.run("carol", lambda: "third")
+
+        finish.set()
+        assert await asyncio.wait_for(second, 5) == "second"
+        await asyncio.sleep(0)
+        assert scheduler._running == 0
+
+    asyncio.run(run())
+
+
+def test_cancelled_waiting_job_frees_its_place(scheduler):
+    finish = threading.Event()
+
+    async def run():
+        first = asyncio.create_task(scheduler.run("alice", lambda: finish.wait(5)))
+        await asyncio.sleep(0.05)
+        second = asyncio.create_task(scheduler.run("bob", lambda: "second"))
+        await asyncio.sleep(0.05)
+        assert scheduler.queue_depth == 1
+
+        scheduler.cancel("bob")
+        with pytest.raises(asyncio.CancelledError):
+            await second
+        assert scheduler.queue_depth == 0
+
+        finish.set()
+        assert await first is True
+        await asyncio.sleep(0)
+        assert scheduler._running == 0
+
+    asyncio.run(run())
@@ -0,0 +1,202 @@
+import asyncio
+import threading
+import time
+from email.utils import formatdate
+
+import pytest
+
+from core import (
+    OpenRouterLLM, LLMScheduler, PrioritySlots, TokenBucket, PRIORITY_INTERACTIVE, PRIORITY_BACKGROUND,
+    close_async_clients, is_llm_error,
+)
+from mock_openrouter import start_mock_server
+
+
+@pytest.fixture
+def make_server():
+    servers = []
+
+    def make(**options):
+        server = start_mock_server(**options)
+        servers.append(server)
+        return server
+
+    yield make
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def make_llm(server, **scheduler_options) -> OpenRouterLLM:
+    scheduler_options.setdefault("backoff_base", 0.001)
+    return OpenRouterLLM(api_key="test", base_url=server.url, scheduler=LLMScheduler(**scheduler_options))
+
+
+def run(factory):
+    """Run ``factory()`` on a fresh event loop and close that loop's HTTP client afterwards."""
+    async def main():
+        try:
+            return await factory()
+        finally:
+            await close_async_clients()
+    return asyncio.run(main())
+
+
+def test_priority_slots_serve_lowest_priority_first_then_fifo():
+    async def main():
+        slots = PrioritySlots(1)
+        await slots.acquire()
+        order = []
+
+        async def waiter(name, priority):
+            await slots.acquire(priority)
+            order.append(name)
+            slots.release()
+
+        waiters = [
+            asyncio.create_task(waiter(name, priority)) for name, priority in [
+                ("summary-1", PRIORITY_BACKGROUND), ("question-1", PRIORITY_INTERACTIVE),
+                ("summary-2", PRIORITY_BACKGROUND), ("question-2", PRIORITY_INTERACTIVE),
+            ]
+        ]
+        await asyncio.sleep(0)
+        assert slots.waiting == 4
+        slots.release()
+        await asyncio.gather(*waiters)
+        return order
+
+    assert asyncio.run(main()) == ["question-1", "question-2", "summary-1", "summary-2"]
+
+
+def test_priority_slots_pass_a_slot_on_when_a_waiter_is_cancelled():
+    async def main():
+        slots = PrioritySlots(1)
+        await slots.acquire()
+        cancelled = asyncio.create_task(slots.acquire(PRIORITY_INTERACTIVE))
+        later = asyncio.create_task(slots.acquire(PRIORITY_BACKGROUND))
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        slots.release()
+        await asyncio.wait_for(later, 1)
+        assert slots.waiting == 0
+
+    asyncio.run(main())
+
+
+def test_token_bucket_spaces_requests_after_the_burst():
+    bucket = TokenBucket(rate=10.0, capacity=2)
+    waits = [bucket.reserve() for _ in range(4)]
+    assert waits[:2] == [0.0, 0.0]
+    assert waits[2] == pytest.approx(0.1, abs=0.02)
+    assert waits[3] == pytest.approx(0.2, abs=0.02)
+
+
+def test_identical_async_prompts_share_one_upstream_request(make_server):
+    server = make_server(delay=0.2)
+    llm = make_llm(server)
+
+    answers = run(lambda: asyncio.gather(*(llm._acall("same question") for _ in range(5))))
+
+    assert len(set(answers)) == 1 and not is_llm_error(answers[0])
+    assert server.request_count == 1
+    assert llm.scheduler.coalesced == 4
+
+
+def test_identical_sync_prompts_share_one_upstream_request(make_server):
+    server = make_server(delay=0.2)
+    llm = make_llm(server)
+    answers = []
+    threads = [threading.Thread(target=lambda: answers.append(llm._call("same question"))) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(answers) == 4 and len(set(answers)) == 1
+    assert server.request_count == 1
+    assert llm.scheduler.coalesced == 3
+
+
+def test_sync_calls_share_the_concurrency_cap(make_server):
+    server = make_server(delay=0.2)
+    llm = make_llm(server, max_concurrency=2)
+    answers = []
+    threads = [threading.Thread(target=lambda i=i: answers.append(llm._call(f"question {i}"))) for i in range(4)]
+
+    started = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+
+    assert len(answers) == 4 and not any(is_llm_error(answer) for answer in answers)
+    # Two at a time: the second pair waits for the first
+    assert elapsed >= 0.4
+    assert llm.scheduler.waiting == 0
+
+
+def test_different_prompts_are_not_coalesced(make_server):
+    server = make_server(delay=0.1)
+    llm = make_llm(server)
+
+    run(lambda: asyncio.gather(llm._acall("first"), llm._acall("second")))
+
+    assert server.request_count == 2
+    assert llm.scheduler.coalesced == 0
+
+
+def test_retry_after_is_honoured(make_server):
+    # One request per second: the second is refused with Retry-After of at least one second
+    server = make_server(rate_limit=1)
+    llm = make_llm(server, max_retries=3)
+
+    async def main():
+        await llm._acall("first")
+        started = time.monotonic()
+        answer = await llm._acall("second")
+        return answer, time.monotonic() - started
+
+    answer, elapsed = run(main)
+
+    assert not is_llm_error(answer)
+    assert server.rate_limited == 1
+    assert llm.scheduler.retries == 1
+    assert elapsed >= 0.9
+
+
+def test_retry_delay_waits_at_least_retry_after():
+    scheduler = LLMScheduler(backoff_base=0.001, backoff_max=30.0)
+    assert scheduler.retry_delay(0, "2") >= 2.0
+    assert scheduler.retry_delay(0, formatdate(time.time() + 5, usegmt=True)) >= 3.0
+    assert scheduler.retry_delay(0, "not a date") <= 0.001
+    # Retry-After never pushes a wait past the backoff cap
+    assert scheduler.retry_delay(0, "3600") == 30.0
+
+
+def test_backoff_stops_after_the_retry_cap(make_server):
+    server = make_server(fail_rate=1.0)
+    llm = make_llm(server, max_retries=2)
+
+    answer = run(lambda: llm._acall("always fails"))
+
+    assert is_llm_error(answer) and "503" in answer
+    assert server.failures == 3
+    assert llm.scheduler.retries == 2
+
+
+def test_sync_backoff_stops_after_the_retry_cap(make_server):
+    server = make_server(fail_rate=1.0)
+    llm = make_llm(server, max_retries=1)
+
+    answer = llm._call("always fails")
+
+    assert is_llm_error(answer) and "503" in answer
+    assert server.failures == 2
+    assert llm.scheduler.retries == 1
+
+
+def test_retry_backoff_grows_exponentially_up_to_the_cap():
+    scheduler = LLMScheduler(backoff_base=1.0, backoff_max=4.0)
+    for attempt, ceiling in [(0, 1.0), (1, 2.0), (2, 4.0), (5, 4.0)]:
+        assert all(0.0 <= scheduler.retry_delay(attempt) <= ceiling for _ in range(50))
@@ -0,0 +1,46 @@
+import httpx
+import pytest
+
+from core import metrics, sampling_profiler, start_metrics_server
+
+
+@pytest.fixture
+def base_url():
+    server = start_metrics_server(0)
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+def test_listens_on_localhost_by_default():
+    server = start_metrics_server(0)
+    try:
+        assert server.server_address[0] == "127.0.0.1"
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_metrics_endpoint(base_url):
+    metrics.inc("chunks_total", 3)
+    response = httpx.get(f"{base_url}/metrics")
+    assert response.status_code == 200
+    assert "pdfqa_chunks_total" in response.text
+
+
+@pytest.mark.parametrize("seconds", ["-1", "0", "abc", "nan", "inf"])
+def test_bad_profile_duration_is_rejected_without_starting_the_sampler(base_url, seconds):
+    response = httpx.get(f"{base_url}/debug/profile", params={"seconds": seconds})
+    assert response.status_code == 400
+    assert not sampling_profiler.running
+
+
+def test_profile_stops_the_sampler_when_done(base_url):
+    response = httpx.get(f"{base_url}/debug/profile", params={"seconds": "0.1", "format": "top"})
+    assert response.status_code == 200
+    assert "samples" in response.text
+    assert not sampling_profiler.running
+
+
+def test_bad_cprofile_report_arguments_are_rejected(base_url):
+    assert httpx.get(f"{base_url}/debug/cprofile", params={"limit": "many"}).status_code == 400
@@ -0,0 +1,25 @@
+import pytest
+
+from core import SessionStore, create_session_store
+
+
+class IncompleteStore(SessionStore):
+    def get(self, user_id):
+        return dict(self.NEW_SESSION)
+
+
+def test_incomplete_backend_fails_when_created():
+    with pytest.raises(TypeError, match="abstract"):
+        IncompleteStore()
+
+
+@pytest.mark.parametrize("url", ["memory", "sqlite:{tmp}/sessions.sqlite3"])
+def test_backends_round_trip_a_session(url, tmp_path):
+    store = create_session_store(url.format(tmp=tmp_path))
+    try:
+        store.save(1, {"status": "ready", "pdf_name": "a.pdf", "processing": ["b.pdf"]})
+        assert store.get(1) == {"status": "ready", "pdf_name": "a.pdf", "processing": ["b.pdf"]}
+        store.delete(1)
+        assert store.get(1) == SessionStore.NEW_SESSION
+    finally:
+        store.close()
@@ -0,0 +1,138 @@
+import asyncio
+from collections import OrderedDict
+from types import SimpleNamespace
+
+import pytest
+from langchain_community.embeddings import DeterministicFakeEmbedding
+from langchain_community.vectorstores import FAISS
+
+import telegrambot
+from core import IndexStore, MemorySessionStore, OpenRouterLLM
+
+USER_ID = 42
+
+
+class Message:
+    def __init__(self):
+        self.texts = []
+
+    async def reply_text(self, text, **kwargs):
+        self.texts.append(text)
+        return self
+
+    async def edit_text(self, text, **kwargs):
+        self.texts.append(text)
+
+
+def upload(name: str):
+    """An update carrying the PDF ``name`` and a context whose download returns its bytes."""
+    message = Message()
+    message.document = SimpleNamespace(file_name=name, file_size=1000, file_id=name)
+
+    async def download_as_bytearray():
+        return bytearray(name.encode())
+
+    async def get_file(file_id):
+        return SimpleNamespace(download_as_bytearray=download_as_bytearray)
+
+    update = SimpleNamespace(effective_user=SimpleNamespace(id=USER_ID), message=message)
+    return update, SimpleNamespace(bot=SimpleNamespace(get_file=get_file))
+
+
+@pytest.fixture
+def bot(monkeypatch):
+    monkeypatch.setattr(telegrambot, "session_store", MemorySessionStore())
+    monkeypatch.setattr(telegrambot, "ingestion", SimpleNamespace(cancel=lambda user_id: False))
+    monkeypatch.setattr(telegrambot, "pdf_processor", SimpleNamespace(dedup=False))
+    monkeypatch.setattr(telegrambot, "index_store", SimpleNamespace(load_info=lambda doc_hash: None))
+    releases = {}
+
+    async def build_index(processing_msg, user_id, pdf_bytes, doc_hash, pdf_name, basis=()):
+        await releases.setdefault(pdf_name, asyncio.Event()).wait()
+        return 100, 3
+
+    monkeypatch.setattr(telegrambot, "build_index", build_index)
+    return releases
+
+
+def test_overlapping_uploads_both_end_up_in_the_session(bot):
+    async def main():
+        first, second = upload("first.pdf"), upload("second.pdf")
+        first_task = asyncio.create_task(telegrambot.handle_document(*first))
+        await asyncio.sleep(0.01)
+        second_task = asyncio.create_task(telegrambot.handle_document(*second))
+        await asyncio.sleep(0.01)
+
+        # The first upload finishes after the second one started
+        bot.setdefault("first.pdf", asyncio.Event()).set()
+        await asyncio.wait_for(first_task, 5)
+        assert "PDF Ready" in first[0].message.texts[-1]
+        assert telegrambot.get_session(USER_ID)["processing"] == ["second.pdf"]
+
+        bot.setdefault("second.pdf", asyncio.Event()).set()
+        await asyncio.wait_for(second_task, 5)
+        assert "PDF Ready" in second[0].message.texts[-1]
+
+    asyncio.run(main())
+    session = telegrambot.get_session(USER_ID)
+    assert [doc["pdf_name"] for doc in telegrambot.session_documents(session)] == ["first.pdf", "second.pdf"]
+    assert not session.get("processing")
+
+
+def test_the_same_pdf_is_not_processed_twice_at_once(bot):
+    async def main():
+        first, again = upload("report.pdf"), upload("report.pdf")
+        first_task = asyncio.create_task(telegrambot.handle_document(*first))
+        await asyncio.sleep(0.01)
+        await asyncio.wait_for(telegrambot.handle_document(*again), 5)
+        assert "already being processed" in again[0].message.texts[-1]
+
+        bot.setdefault("report.pdf", asyncio.Event()).set()
+        await asyncio.wait_for(first_task, 5)
+        assert "PDF Ready" in first[0].message.texts[-1]
+
+    asyncio.run(main())
+    assert [doc["pdf_name"] for doc in telegrambot.session_documents(telegrambot.get_session(USER_ID))] == ["report.pdf"]
+
+
+@pytest.fixture
+def indexed(monkeypatch, tmp_path):
+    """Two PDFs saved in a temporary index store, and the session documents that name them."""
+    embeddings = DeterministicFakeEmbedding(size=32)
+    store = IndexStore(embeddings, root=str(tmp_path))
+    documents = []
+    for name in ("a.pdf", "b.pdf"):
+        texts = [f"{name} chunk {i}" for i in range(5)]
+        doc_hash = IndexStore.document_hash(name.encode())
+        store.save(doc_hash, FAISS.from_texts(texts, embeddings, metadatas=[{"source": name}] * 5), "", {"chunk_count": 5})
+        documents.append({"pdf_name": name, "doc_hash": doc_hash})
+    monkeypatch.setattr(telegrambot, "index_store", store)
+    monkeypatch.setattr(telegrambot, "pdf_processor", SimpleNamespace(embeddings=embeddings, dedup=False))
+    monkeypatch.setattr(telegrambot, "llm", OpenRouterLLM(api_key="test"))
+    monkeypatch.setattr(telegrambot, "response_cache", None)
+    monkeypatch.setattr(telegrambot, "user_corpora", OrderedDict())
+    return documents
+
+
+def test_a_changed_document_set_gets_a_new_corpus(indexed):
+    first = telegrambot.get_qa_engine(USER_ID, indexed[:1])
+    assert telegrambot.get_qa_engine(USER_ID, indexed[:1]) is first
+
+    both = telegrambot.get_qa_engine(USER_ID, indexed)
+
+    # The first engine may still be answering; its corpus is left as it was
+    assert both.corpus is not first.corpus
+    assert first.corpus.sources == ["a.pdf"] and len(first.corpus) == 5
+    assert sorted(both.corpus.sources) == ["a.pdf", "b.pdf"]
+
+
+def test_clear_waits_for_a_running_corpus_build(bot, indexed):
+    async def main():
+        build = asyncio.create_task(telegrambot.load_qa_engine(USER_ID, indexed))
+        await asyncio.sleep(0)
+        update = SimpleNamespace(effective_user=SimpleNamespace(id=USER_ID), message=Message())
+        await telegrambot.clear_command(update, None)
+        assert build.done() and build.result() is not None
+
+    asyncio.run(main())
+    assert USER_ID not in telegrambot.user_corpora